@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures accepts/s during a connection storm, and the p99 round trip
+latency of peers that were connected before the storm started, for a
+few values of Listener.acceptbudget.
+
+    python benchmarks/acceptstorm.py [seconds] [stormers]
+"""
+
+import sys
+import time
+import socket
+import multiprocessing
+
+import pyev
+
+from esocket.ipv4 import TCPListener
+from esocket.connectionhandler import ConnectionHandler
+
+PINGERS = 50
+
+
+class EchoServer(ConnectionHandler):
+
+    def connected(self, caller, data):
+        pass
+
+    def data(self, caller, data):
+        caller.send(caller.recv(-1))
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        pass
+
+    def timeout(self, caller, data):
+        pass
+
+
+def ping(port, start, stop, results):
+    # Round trips on connections made before the storm
+    socks = [socket.create_connection(('127.0.0.1', port))
+             for i in range(PINGERS)]
+    start.wait()
+
+    rtts = []
+    while not stop.is_set():
+        for sock in socks:
+            t = time.perf_counter()
+            sock.sendall(b'ping\n')
+            sock.recv(16)
+            rtts.append(time.perf_counter() - t)
+
+    for sock in socks:
+        sock.close()
+    results.put(rtts)
+
+
+def storm(port, start, stop, results):
+    # Connect and disconnect as fast as possible
+    start.wait()
+
+    count = 0
+    while not stop.is_set():
+        try:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.close()
+            count += 1
+        except OSError:
+            pass
+    results.put(count)
+
+
+def run(budget, seconds, stormers):
+    loop = pyev.Loop()
+    accepted = [0]
+
+    def onpeer(caller, data):
+        accepted[0] += 1
+        return True
+
+    listener = TCPListener(loop, EchoServer, {'onpeer': onpeer})
+    listener.acceptbudget = budget
+    listener.listen('127.0.0.1', 0, backlog=1024)
+    port = listener.address[1]
+
+    start = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    pings = multiprocessing.Queue()
+    storms = multiprocessing.Queue()
+
+    procs = [multiprocessing.Process(target=ping,
+                                     args=(port, start, stop, pings))]
+    procs += [multiprocessing.Process(target=storm,
+                                      args=(port, start, stop, storms))
+              for i in range(stormers)]
+    for proc in procs:
+        proc.start()
+
+    def begin(watcher, event):
+        if listener.peers >= PINGERS:
+            watcher.stop()
+            accepted[0] = 0
+            start.set()
+            end.start()
+
+    def finish(watcher, event):
+        stop.set()
+        loop.unloop()
+
+    poll = pyev.Timer(0, 0.01, loop, begin)
+    end = pyev.Timer(seconds, 0, loop, finish)
+    poll.start()
+    loop.loop()
+
+    # Keep serving until the clients are done
+    drain = pyev.Timer(0.5, 0, loop, lambda w, e: loop.unloop())
+    drain.start()
+    loop.loop()
+
+    rtts = sorted(pings.get())
+    for i in range(stormers):
+        storms.get()
+    for proc in procs:
+        proc.join()
+
+    listener.close()
+    p99 = rtts[int(len(rtts) * 0.99)] if rtts else float('nan')
+    return accepted[0] / seconds, p99
+
+
+if __name__ == '__main__':
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    stormers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    print('{:>10} {:>12} {:>14}'.format('budget', 'accepts/s', 'p99 rtt (ms)'))
+    for budget in (1, 16, 64, 1024, sys.maxsize):
+        rate, p99 = run(budget, seconds, stormers)
+        name = 'unbounded' if budget == sys.maxsize else budget
+        print('{:>10} {:>12.0f} {:>14.3f}'.format(name, rate, p99 * 1000))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measures short-lived request/response connections with and without a
+BufferPool on the loop. Each client connects, sends a request, reads
+the response and closes, and a new one takes its place.
+
+    python benchmarks/bufferpool.py [requests] [concurrency] [rounds]
+"""
+
+import sys
+import time
+
+import pyev
+
+import esocket.eventloop
+from esocket.ipv4 import TCPConnection, TCPListener
+from esocket.connectionhandler import ConnectionHandler
+from esocket.framing import DelimiterFramer
+
+REQUEST = b'GET /' + b'x' * 200 + b'\n'
+RESPONSE = b'y' * 2000 + b'\n'
+
+
+class Server(ConnectionHandler):
+
+    def connected(self, caller, data):
+        pass
+
+    def frame(self, caller, data):
+        caller.send(RESPONSE)
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        pass
+
+
+class Client(ConnectionHandler):
+
+    def __init__(self, bench):
+        self.bench = bench
+
+    def connected(self, caller, data):
+        caller.framer = DelimiterFramer()
+        caller.send(REQUEST)
+
+    def frame(self, caller, data):
+        caller.close()
+
+    def disconnected(self, caller, data):
+        self.bench.done()
+
+    def error(self, caller, data):
+        print('Client Error: {}'.format(data))
+
+
+class Bench(object):
+
+    def __init__(self, loop, port, requests):
+        self.loop = loop
+        self.port = port
+        self.remaining = requests
+        self.running = 0
+
+    def start(self):
+        self.remaining -= 1
+        self.running += 1
+        conn = TCPConnection(self.loop, Client(self))
+        conn.connect('127.0.0.1', self.port)
+
+    def done(self):
+        self.running -= 1
+        if self.remaining:
+            self.start()
+        elif not self.running:
+            self.loop.unloop()
+
+
+def run(requests, concurrency, pooled):
+    loop = pyev.Loop()
+    eloop = esocket.eventloop.wrap(loop)
+    eloop.bufferpool = pooled
+
+    listener = TCPListener(loop, Server, {'onpeer': lambda c, d: True})
+    listener.framer = DelimiterFramer()
+    listener.listen('127.0.0.1', 0, backlog=1024)
+
+    bench = Bench(loop, listener.address[1], requests)
+    start = time.perf_counter()
+    for i in range(min(concurrency, requests)):
+        bench.start()
+    loop.loop()
+    elapsed = time.perf_counter() - start
+
+    listener.close()
+    return requests / elapsed, eloop.bufferpool
+
+
+if __name__ == '__main__':
+
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    # Alternate the runs and keep the best of each
+    best = {False: 0, True: 0}
+    for i in range(rounds):
+        for pooled in (False, True):
+            rate, pool = run(requests, concurrency, pooled)
+            best[pooled] = max(best[pooled], rate)
+
+    print('{} requests, {} at a time'.format(requests, concurrency))
+    print('  unpooled: {:10.0f} requests/s'.format(best[False]))
+    print('    pooled: {:10.0f} requests/s'.format(best[True]))
+    print('      pool: {hits} hits, {misses} misses, {evictions} evictions, '
+          '{pooled} bytes pooled'.format(**pool.snapshot()))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measures the memory held per idle peer connection of a listener, at
+a number of peer counts.
+
+    python benchmarks/memory.py [count ...]
+
+Every peer needs a file descriptor, so counts above the open file
+limit (ulimit -n) are skipped. The peers are made from one end of a
+socketpair, the other end is closed and the loop is never run, so
+only the connection objects are measured, not the kernel sockets.
+"""
+
+import gc
+import sys
+import socket
+import resource
+import tracemalloc
+
+import pyev
+
+from esocket.ipv4 import TCPListener
+from esocket.connectionhandler import ConnectionHandler
+
+COUNTS = (10000, 100000, 1000000)
+
+
+class IdleHandler(ConnectionHandler):
+    # A handler without a __dict__, so only the connection is measured
+    __slots__ = ()
+
+    def connected(self, caller, data):
+        pass
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        pass
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def measure(count):
+    loop = pyev.Loop()
+    listener = TCPListener(loop, IdleHandler)
+
+    gc.collect()
+    tracemalloc.start()
+    traced = tracemalloc.get_traced_memory()[0]
+    resident = rss()
+
+    for i in range(count):
+        peer, other = socket.socketpair()
+        other.close()
+        listener.adopt(peer)
+
+    gc.collect()
+    traced = tracemalloc.get_traced_memory()[0] - traced
+    resident = rss() - resident
+    tracemalloc.stop()
+
+    listener.closepeers()
+    return traced / count, resident / count
+
+
+if __name__ == '__main__':
+
+    counts = [int(c) for c in sys.argv[1:]] or COUNTS
+    limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+    print('{:>10} {:>16} {:>16}'.format('peers', 'traced B/peer',
+                                        'rss B/peer'))
+    for count in counts:
+        if count + 64 > limit:
+            print('{:>10} skipped, ulimit -n is {}'.format(count, limit))
+            continue
+        traced, resident = measure(count)
+        print('{:>10} {:>16.0f} {:>16.0f}'.format(count, traced, resident))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the cost of metrics on the echo path, running the same
+pipelined echo workload against a listener with and without metrics.
+
+    python benchmarks/metrics.py [messages] [connections] [rounds]
+"""
+
+import sys
+import time
+
+import pyev
+
+from esocket.ipv4 import TCPConnection, TCPListener
+from esocket.connectionhandler import ConnectionHandler
+from esocket.framing import DelimiterFramer
+
+MESSAGE = b'x' * 100 + b'\n'
+PIPELINE = 16
+
+
+class EchoServer(ConnectionHandler):
+
+    def connected(self, caller, data):
+        pass
+
+    def frame(self, caller, data):
+        caller.send(data)
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        pass
+
+    def timeout(self, caller, data):
+        pass
+
+
+class Client(ConnectionHandler):
+    # Keeps PIPELINE messages in flight until its share is echoed
+
+    def __init__(self, bench, count):
+        self.bench = bench
+        self.remaining = count
+        self.outstanding = 0
+
+    def fill(self, caller):
+        while self.remaining and self.outstanding < PIPELINE:
+            self.remaining -= 1
+            self.outstanding += 1
+            caller.send(MESSAGE)
+
+    def connected(self, caller, data):
+        caller.framer = DelimiterFramer()
+        self.fill(caller)
+
+    def frame(self, caller, data):
+        self.outstanding -= 1
+        self.fill(caller)
+        if not self.outstanding:
+            caller.close()
+            self.bench.finished()
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        print('Client Error: {}'.format(data))
+
+    def timeout(self, caller, data):
+        pass
+
+
+class Bench(object):
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.running = 0
+
+    def finished(self):
+        self.running -= 1
+        if not self.running:
+            self.loop.unloop()
+
+
+def run(messages, connections, metrics):
+    loop = pyev.Loop()
+    listener = TCPListener(loop, EchoServer, {'onpeer': lambda c, d: True})
+    listener.framer = DelimiterFramer()
+    listener.metrics = metrics
+    listener.listen('127.0.0.1', 0, backlog=1024)
+    port = listener.address[1]
+
+    bench = Bench(loop)
+    bench.running = connections
+    for i in range(connections):
+        conn = TCPConnection(loop, Client(bench, messages // connections))
+        conn.metrics = metrics
+        conn.connect('127.0.0.1', port)
+
+    start = time.perf_counter()
+    loop.loop()
+    elapsed = time.perf_counter() - start
+
+    listener.close()
+    return (messages // connections) * connections / elapsed
+
+
+if __name__ == '__main__':
+
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    # Alternate the runs and keep the best of each, so both see the
+    # same machine conditions.
+    best = {False: 0, True: 0}
+    for i in range(rounds):
+        for metrics in (False, True):
+            rate = run(messages, connections, metrics)
+            best[metrics] = max(best[metrics], rate)
+
+    print('{} messages over {} connections'.format(messages, connections))
+    print('   metrics off: {:10.0f} messages/s'.format(best[False]))
+    print('    metrics on: {:10.0f} messages/s'.format(best[True]))
+    print('      overhead: {:9.1f}%'.format(
+        (1 - best[True] / best[False]) * 100))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the request rate of a line based request/reply client
+against a local echo server, opening a new connection per request
+and with connections from a ConnectionPool.
+
+    python benchmarks/pool.py [requests] [concurrency]
+"""
+
+import sys
+import time
+import multiprocessing
+
+import pyev
+
+from esocket.ipv4 import TCPConnection, TCPListener
+from esocket.connectionhandler import ConnectionHandler
+from esocket.framing import DelimiterFramer
+from esocket.pool import ConnectionPool
+
+
+class EchoServer(ConnectionHandler):
+
+    def connected(self, caller, data):
+        pass
+
+    def frame(self, caller, data):
+        caller.send(data)
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        pass
+
+    def timeout(self, caller, data):
+        pass
+
+
+def server(ready):
+    loop = pyev.Loop()
+    listener = TCPListener(loop, EchoServer, {'onpeer': lambda c, d: True})
+    listener.framer = DelimiterFramer()
+    listener.listen('127.0.0.1', 0, backlog=1024)
+    ready.put(listener.address[1])
+    loop.loop()
+
+
+class Client(ConnectionHandler):
+    # Sends a request when connected and starts the next request
+    # when the reply arrives.
+
+    def __init__(self, bench):
+        self.bench = bench
+
+    def connected(self, caller, data):
+        caller.framer = DelimiterFramer()
+        caller.send(b'request\n')
+
+    def frame(self, caller, data):
+        self.bench.done(caller)
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        print('Client Error: {}'.format(data))
+
+    def timeout(self, caller, data):
+        pass
+
+
+class Bench(object):
+
+    def __init__(self, loop, port, requests, pool):
+        self.loop = loop
+        self.port = port
+        self.remaining = requests
+        self.outstanding = 0
+        self.pool = pool
+
+    def request(self):
+        self.remaining -= 1
+        self.outstanding += 1
+        if self.pool is None:
+            conn = TCPConnection(self.loop, Client(self))
+            conn.connect('127.0.0.1', self.port)
+        else:
+            self.pool.acquire('127.0.0.1', self.port, Client(self))
+
+    def done(self, conn):
+        self.outstanding -= 1
+        if self.pool is None:
+            conn.close()
+        else:
+            self.pool.release(conn)
+
+        if self.remaining:
+            self.request()
+        elif not self.outstanding:
+            self.loop.unloop()
+
+
+def run(port, requests, concurrency, pooled):
+    loop = pyev.Loop()
+    pool = ConnectionPool(loop, maxsize=concurrency) if pooled else None
+    bench = Bench(loop, port, requests, pool)
+
+    start = time.perf_counter()
+    for i in range(concurrency):
+        bench.request()
+    loop.loop()
+    elapsed = time.perf_counter() - start
+
+    if pool is not None:
+        pool.close()
+    return requests / elapsed
+
+
+if __name__ == '__main__':
+
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    ready = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=server, args=(ready,), daemon=True)
+    proc.start()
+    port = ready.get()
+
+    print('{} requests, {} at a time'.format(requests, concurrency))
+    for name, pooled in (('unpooled', False), ('pooled', True)):
+        rate = run(port, requests, concurrency, pooled)
+        print('{:>10}: {:10.0f} requests/s'.format(name, rate))
+
+    proc.terminate()
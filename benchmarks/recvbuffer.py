@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Feeds pipelined lines through the echo server path (recvchunk + send
+on a PeerConnection) and reports the throughput with the old
+slice-and-reassign receivebuffer and with esocket.buffer.ReceiveBuffer.
+
+    python benchmarks/recvbuffer.py [lines]
+"""
+
+import sys
+import time
+import socket
+import threading
+
+import pyev
+
+from esocket.buffer import ReceiveBuffer
+from esocket.connection import PeerConnection
+from esocket.connectionhandler import ConnectionHandler
+
+
+class LegacyReceiveBuffer(object):
+    # The receivebuffer as it was before esocket.buffer, every read
+    # copies the remaining data into a new bytearray.
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def __len__(self):
+        return len(self._buf)
+
+    def recv(self, sock, count):
+        data = sock.recv(count)
+        self._buf.extend(data)
+        return len(data)
+
+    def extend(self, data):
+        self._buf.extend(data)
+
+    def read(self, count=-1):
+        if count < 0 or count > len(self._buf):
+            count = len(self._buf)
+        data = self._buf[:count]
+        self._buf = self._buf[count:]
+        return bytes(data)
+
+    def index(self, sub, start=0):
+        return self._buf.index(sub, start)
+
+    def clear(self):
+        self._buf = bytearray()
+
+
+class EchoServer(ConnectionHandler):
+
+    def connected(self, caller, data):
+        pass
+
+    def data(self, caller, data):
+        # Unlike the example server, answer every complete line
+        # in the buffer since the client pipelines its requests.
+        while True:
+            try:
+                line = caller.recvchunk(b'\n')
+            except ValueError:
+                break
+            caller.send(line)
+
+    def disconnected(self, caller, data):
+        caller.data.unloop()
+
+    def error(self, caller, data):
+        print('Peer Error: {}'.format(data))
+
+    def timeout(self, caller, data):
+        pass
+
+
+def client(sock, payload):
+    # Write every line at once and read back the echo
+    writer = threading.Thread(target=sock.sendall, args=(payload,))
+    writer.start()
+
+    received = 0
+    while received < len(payload):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        received += len(chunk)
+
+    writer.join()
+    sock.close()
+
+
+def run(buffercls, payload):
+    loop = pyev.Loop()
+    ours, theirs = socket.socketpair()
+
+    sock = socket.socket(ours.family, ours.type, ours.proto,
+                         fileno=ours.detach())
+    peer = PeerConnection(loop, sock, EchoServer())
+    peer._recvbuf = buffercls()
+    peer.data = loop
+    peer._start()
+
+    thread = threading.Thread(target=client, args=(theirs, payload))
+
+    start = time.perf_counter()
+    thread.start()
+    loop.loop()
+    thread.join()
+
+    return len(payload) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    payload = b''.join(b'line %d of the pipelined request stream\n' % i
+                       for i in range(count))
+
+    print('{} lines, {} bytes'.format(count, len(payload)))
+    for name, cls in (('before', LegacyReceiveBuffer),
+                      ('after', ReceiveBuffer)):
+        print('{:>8}: {:12.0f} bytes/s'.format(name, run(cls, payload)))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the peer registry of a listener at a large number of peers:
+adding and removing peers, tagging them into groups, and finding the
+peers of a group or an address, against scanning every peer.
+
+    python benchmarks/registry.py [peers] [groups]
+
+The peers are plain objects with the attributes the registry uses,
+so no sockets are needed and any number of peers can be measured.
+"""
+
+import sys
+import time
+import random
+
+from esocket.registry import PeerRegistry
+
+MESSAGES = 1000
+SCANS = 20
+
+
+class Peer(object):
+    # Stands in for a PeerConnection, with the tags it has kept on
+    # the peer as a handler without a registry would.
+    __slots__ = ('_peerid', '_peeraddress', 'tags')
+
+    def __init__(self):
+        self.tags = set()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def addall(registry, peers):
+    for i, peer in enumerate(peers):
+        registry.add(peer, ('10.0.{}.{}'.format(i >> 8 & 255, i & 255),
+                            1024 + (i >> 16)))
+
+
+def removeall(registry, peers):
+    for peer in peers:
+        registry.remove(peer)
+
+
+def tagall(registry, peers, groups):
+    for i, peer in enumerate(peers):
+        registry.tag(peer, i % groups)
+        peer.tags.add(i % groups)
+
+
+def route(registry, tags):
+    count = 0
+    for tag in tags:
+        for peer in registry.group(tag):
+            count += 1
+    return count
+
+
+def scan(registry, tags):
+    count = 0
+    for tag in tags:
+        for peer in registry:
+            if tag in peer.tags:
+                count += 1
+    return count
+
+
+def findall(registry, addresses):
+    for address in addresses:
+        registry.find(address)
+
+
+def scanfind(registry, addresses):
+    for address in addresses:
+        for peer in registry:
+            if peer._peeraddress == address:
+                break
+
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    groups = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    peers = [Peer() for i in range(count)]
+    registry = PeerRegistry()
+    rng = random.Random(1)
+
+    elapsed, result = timed(addall, registry, peers)
+    print('{} peers in {} groups'.format(count, groups))
+    print('           add: {:10.0f} peers/s'.format(count / elapsed))
+
+    elapsed, result = timed(tagall, registry, peers, groups)
+    print('           tag: {:10.0f} peers/s'.format(count / elapsed))
+
+    tags = [rng.randrange(groups) for i in range(MESSAGES)]
+    elapsed, routed = timed(route, registry, tags)
+    print('   route group: {:10.1f} us/message, {} peers/message'.format(
+        elapsed / MESSAGES * 1e6, routed // MESSAGES))
+
+    elapsed, scanned = timed(scan, registry, tags[:SCANS])
+    print('    scan peers: {:10.1f} us/message'.format(
+        elapsed / SCANS * 1e6))
+
+    addresses = [rng.choice(peers)._peeraddress for i in range(MESSAGES)]
+    elapsed, result = timed(findall, registry, addresses)
+    print('  find address: {:10.2f} us/lookup, index built on first use'
+          .format(elapsed / MESSAGES * 1e6))
+    elapsed, result = timed(findall, registry, addresses)
+    print('  find address: {:10.2f} us/lookup'.format(
+        elapsed / MESSAGES * 1e6))
+
+    elapsed, result = timed(scanfind, registry, addresses[:SCANS])
+    print('  scan address: {:10.2f} us/lookup'.format(
+        elapsed / SCANS * 1e6))
+
+    elapsed, result = timed(removeall, registry, peers)
+    print('        remove: {:10.0f} peers/s, {} left in {} groups'.format(
+        count / elapsed, len(registry), len(list(registry.groups()))))
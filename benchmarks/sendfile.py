@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the throughput of sending a file over loopback with
+sendfile(), against reading it in pieces and sending them with send()
+paced by the resume_writing event. First checks that a segment
+running past the end of the file sends what the file has from its
+offset, and then reports ShortFileError.
+
+    python benchmarks/sendfile.py [megabytes]
+"""
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import multiprocessing
+
+import pyev
+
+from esocket.ipv4 import TCPConnection, TCPListener
+from esocket.error import ShortFileError
+from esocket.connectionhandler import ConnectionHandler
+
+CHUNK_SIZE = 1048576
+
+
+def receiver(port, total):
+    # Read and count everything, then close
+    sock = socket.create_connection(('127.0.0.1', port))
+    buf = bytearray(CHUNK_SIZE)
+    received = 0
+    while received < total:
+        count = sock.recv_into(buf)
+        if not count:
+            break
+        received += count
+    sock.close()
+
+
+class Sender(ConnectionHandler):
+
+    def __init__(self):
+        self.mode = None
+        self.fileobj = None
+        self.loop = None
+        self.start = None
+        self.elapsed = None
+
+    def connected(self, caller, data):
+        self.start = time.perf_counter()
+        if self.mode == 'sendfile':
+            caller.sendfile(self.fileobj)
+        else:
+            self.fileobj.seek(0)
+            self.resume_writing(caller, 0)
+
+    def resume_writing(self, caller, data):
+        # Send pieces until the sendqueue is full
+        while not caller._writepaused:
+            chunk = self.fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            caller.send(chunk)
+
+    def pause_writing(self, caller, data):
+        pass
+
+    def disconnected(self, caller, data):
+        self.elapsed = time.perf_counter() - self.start
+        self.loop.unloop()
+
+    def data(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        pass
+
+    def timeout(self, caller, data):
+        pass
+
+
+class ShortSender(ConnectionHandler):
+    # Sends a segment reaching past the end of the file
+
+    def __init__(self, fileobj, offset, count):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.count = count
+        self.failure = None
+
+    def connected(self, caller, data):
+        caller.sendfile(self.fileobj, self.offset, self.count)
+
+    def data(self, caller, data):
+        pass
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        self.failure = data
+
+
+class Collector(ConnectionHandler):
+    # Keeps everything received until the connection is closed, or
+    # has been idle for a second
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.received = bytearray()
+
+    def connected(self, caller, data):
+        caller.timeout = 1
+
+    def timeout(self, caller, data):
+        caller.close()
+
+    def data(self, caller, data):
+        self.received += caller.recv(data)
+
+    def disconnected(self, caller, data):
+        self.loop.unloop()
+
+    def error(self, caller, data):
+        pass
+
+
+def shortfile(listenercls, connection, **kwargs):
+    """
+    Send 800 bytes from offset 500 of a 1000 byte file with a listener
+    of listenercls to a connection made by connection(loop, handler),
+    and check that the last 500 bytes arrive before ShortFileError.
+    """
+
+    content = os.urandom(1000)
+    with tempfile.TemporaryFile() as fileobj:
+        fileobj.write(content)
+        fileobj.flush()
+        fileobj.seek(0)
+
+        loop = pyev.Loop()
+        sender = ShortSender(fileobj, 500, 800)
+        collector = Collector(loop)
+
+        listener = listenercls(loop, lambda: sender,
+                               events={'onpeer': lambda c, d: True},
+                               **kwargs)
+        listener.listen('127.0.0.1', 0)
+        conn = connection(loop, collector)
+        conn.connect('127.0.0.1', listener.address[1])
+        loop.loop()
+        listener.close()
+
+        assert bytes(collector.received) == content[500:], \
+            'sent the wrong part of the file'
+        assert isinstance(sender.failure, ShortFileError), \
+            'expected ShortFileError, got {!r}'.format(sender.failure)
+        assert sender.failure.missing == 300
+        assert fileobj.tell() == 0, 'moved the file position'
+
+
+def run(fileobj, size, mode):
+    loop = pyev.Loop()
+    sender = Sender()
+    sender.mode = mode
+    sender.fileobj = fileobj
+    sender.loop = loop
+
+    listener = TCPListener(loop, lambda: sender, {'onpeer': lambda c, d: True})
+    listener.listen('127.0.0.1', 0)
+
+    proc = multiprocessing.Process(target=receiver,
+                                   args=(listener.address[1], size))
+    proc.start()
+    loop.loop()
+    proc.join()
+    listener.close()
+
+    return size / sender.elapsed
+
+
+if __name__ == '__main__':
+
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    size = megabytes * 1048576
+
+    shortfile(TCPListener, TCPConnection)
+    print('short file: ok')
+
+    with tempfile.TemporaryFile() as fileobj:
+        piece = os.urandom(CHUNK_SIZE)
+        for i in range(megabytes):
+            fileobj.write(piece)
+        fileobj.flush()
+
+        print('{} MB over loopback'.format(megabytes))
+        for mode in ('send', 'sendfile'):
+            rate = run(fileobj, size, mode)
+            print('{:>10}: {:8.0f} MB/s'.format(mode, rate / 1048576))
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Measures TLS over loopback with a self-signed certificate, made with
+the openssl command: full and resumed handshakes per second, and the
+throughput of bulk transfers compared to plain TCP. First checks that
+sendfile() of a segment running past the end of the file encrypts
+what the file has from its offset, and then reports ShortFileError.
+
+    python benchmarks/tls.py [handshakes] [megabytes]
+"""
+
+import os
+import ssl
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+import pyev
+
+from esocket.ipv4 import TCPConnection, TCPListener
+from esocket.tls import TLSConnection, TLSListener, SessionCache
+from esocket.connectionhandler import ConnectionHandler
+
+from sendfile import shortfile
+
+CHUNK = b'x' * 65536
+
+
+def contexts():
+    # A server context with a new self-signed certificate, and a
+    # client context trusting it.
+    tmp = tempfile.mkdtemp()
+    cert = os.path.join(tmp, 'cert.pem')
+    key = os.path.join(tmp, 'key.pem')
+    try:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-keyout', key, '-out', cert, '-days', '1',
+             '-subj', '/CN=localhost'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        server = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server.load_cert_chain(cert, key)
+        client = ssl.create_default_context(cafile=cert)
+    finally:
+        shutil.rmtree(tmp)
+
+    return server, client
+
+
+class Server(ConnectionHandler):
+    # Answers every request with the size asked for, and counts
+    # what it is sent.
+
+    def connected(self, caller, data):
+        pass
+
+    def data(self, caller, data):
+        request = caller.recv(data)
+        if request[:4] == b'SEND':
+            size = int(request[4:])
+            while size > 0:
+                caller.send(CHUNK[:size])
+                size -= len(CHUNK)
+        else:
+            caller.send(b'ok')
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        pass
+
+
+class Handshaker(ConnectionHandler):
+    # Connects count times in a row, exchanging one message each time
+
+    def __init__(self, bench):
+        self.bench = bench
+
+    def connected(self, caller, data):
+        if caller.resumed:
+            self.bench.resumed += 1
+        caller.send(b'hi')
+
+    def data(self, caller, data):
+        caller.recv(data)
+        caller.close()
+
+    def disconnected(self, caller, data):
+        self.bench.next()
+
+    def error(self, caller, data):
+        print('Client Error: {}'.format(data))
+
+
+class Handshakes(object):
+
+    def __init__(self, loop, port, context, count, sessions):
+        self.loop = loop
+        self.port = port
+        self.context = context
+        self.remaining = count
+        self.sessions = sessions
+        self.resumed = 0
+
+    def next(self):
+        if self.remaining:
+            self.remaining -= 1
+            conn = TLSConnection(self.loop, Handshaker(self), self.context)
+            conn.sessions = self.sessions
+            conn.connect('localhost', self.port)
+        else:
+            self.loop.unloop()
+
+
+class Receiver(ConnectionHandler):
+
+    def __init__(self, loop, size):
+        self.loop = loop
+        self.size = size
+        self.received = 0
+
+    def connected(self, caller, data):
+        self.start = time.perf_counter()
+        caller.send('SEND{}'.format(self.size).encode())
+
+    def data(self, caller, data):
+        self.received += len(caller.recv(data))
+        if self.received >= self.size:
+            self.elapsed = time.perf_counter() - self.start
+            caller.close()
+            self.loop.unloop()
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        print('Client Error: {}'.format(data))
+
+
+def handshakes(count, resume):
+    server, client = contexts()
+    loop = pyev.Loop()
+    listener = TLSListener(loop, Server, server, {'onpeer': lambda c, d: True})
+    listener.listen('127.0.0.1', 0)
+
+    bench = Handshakes(loop, listener.address[1], client, count,
+                       SessionCache() if resume else None)
+
+    # Resumed handshakes start from the session of a first connection
+    if resume:
+        bench.remaining += 1
+        bench.next()
+        loop.loop()
+        bench.remaining = count
+        bench.resumed = 0
+
+    start = time.perf_counter()
+    bench.next()
+    loop.loop()
+    elapsed = time.perf_counter() - start
+
+    listener.close()
+    return count / elapsed, bench.resumed
+
+
+def throughput(size, tls):
+    loop = pyev.Loop()
+    receiver = Receiver(loop, size)
+    accept = {'onpeer': lambda c, d: True}
+
+    if tls:
+        server, client = contexts()
+        listener = TLSListener(loop, Server, server, accept)
+        conn = TLSConnection(loop, receiver, client)
+    else:
+        listener = TCPListener(loop, Server, accept)
+        conn = TCPConnection(loop, receiver)
+
+    listener.listen('127.0.0.1', 0)
+    conn.connect('localhost', listener.address[1])
+    loop.loop()
+
+    listener.close()
+    return size / receiver.elapsed / 1e6
+
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    size = int(sys.argv[2]) * 1000000 if len(sys.argv) > 2 else 500000000
+
+    server, client = contexts()
+    shortfile(TLSListener, lambda loop, handler: TLSConnection(
+        loop, handler, client, hostname='localhost'), context=server)
+    print('short file: ok')
+
+    print('{} sequential handshakes'.format(count))
+    for name, resume in (('full', False), ('resumed', True)):
+        rate, resumed = handshakes(count, resume)
+        print('{:>10}: {:8.0f} handshakes/s, {} resumed'.format(name, rate,
+                                                                 resumed))
+
+    print('{} MB transfers'.format(size // 1000000))
+    print('       tcp: {:8.0f} MB/s'.format(throughput(size, False)))
+    print('       tls: {:8.0f} MB/s'.format(throughput(size, True)))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the datagrams per second a UDPEndpoint receives from a
+number of sender processes, with different receive budgets.
+
+    python benchmarks/udp.py [datagrams] [senders]
+"""
+
+import sys
+import time
+import socket
+import multiprocessing
+
+import pyev
+
+from esocket.ipv4 import UDPEndpoint
+from esocket.connectionhandler import DatagramHandler
+
+PAYLOAD = b'metric.name:1|c' + b' ' * 85
+
+
+def sender(port, count):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for i in range(count):
+        try:
+            sock.sendto(PAYLOAD, ('127.0.0.1', port))
+        except OSError:
+            pass
+    sock.close()
+
+
+class Counter(DatagramHandler):
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    def connected(self, sock, data):
+        pass
+
+    def datagram(self, sock, data, addr):
+        if not self.count:
+            self.first = time.perf_counter()
+        self.count += 1
+        self.last = time.perf_counter()
+
+    def error(self, sock, data):
+        pass
+
+    def disconnected(self, sock, data):
+        pass
+
+
+def run(datagrams, senders, budget):
+    loop = pyev.Loop()
+    counter = Counter(loop)
+    endpoint = UDPEndpoint(loop, counter)
+    endpoint.recvbudget = budget
+    endpoint.bind('127.0.0.1', 0)
+    endpoint._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+
+    procs = [multiprocessing.Process(target=sender,
+                                     args=(endpoint.address[1],
+                                           datagrams // senders))
+             for i in range(senders)]
+    for proc in procs:
+        proc.start()
+
+    # Stop once the senders are done and nothing has arrived for a bit
+    def check(watcher, event):
+        if not any(proc.is_alive() for proc in procs) and \
+                counter.last is not None and \
+                time.perf_counter() - counter.last > 0.2:
+            loop.unloop()
+
+    timer = pyev.Timer(0.1, 0.1, loop, check)
+    timer.start()
+    loop.loop()
+    endpoint.close()
+
+    elapsed = counter.last - counter.first
+    return counter.count / elapsed if elapsed else 0, counter.count
+
+
+if __name__ == '__main__':
+
+    datagrams = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    senders = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    print('{} datagrams from {} senders'.format(datagrams, senders))
+    for budget in (1, 16, 256):
+        rate, count = run(datagrams, senders, budget)
+        print('budget {:>4}: {:10.0f} datagrams/s, {:5.1f}% received'.format(
+            budget, rate, count * 100.0 / datagrams))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Compares the round trip time of small request/response exchanges
+over loopback TCP and over Unix stream and seqpacket sockets.
+
+    python benchmarks/unix.py [roundtrips]
+"""
+
+import sys
+import time
+
+import pyev
+import _socket as socket
+
+from esocket.ipv4 import TCPConnection, TCPListener
+from esocket.unix import UnixConnection, UnixListener
+from esocket.connectionhandler import ConnectionHandler
+from esocket.framing import DelimiterFramer
+
+MESSAGE = b'x' * 100 + b'\n'
+
+
+class EchoServer(ConnectionHandler):
+
+    def connected(self, caller, data):
+        pass
+
+    def frame(self, caller, data):
+        caller.send(data)
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        pass
+
+
+class Client(ConnectionHandler):
+    # Sends the next message once the previous one is back
+
+    def __init__(self, loop, count):
+        self.loop = loop
+        self.remaining = count
+
+    def connected(self, caller, data):
+        self.start = time.perf_counter()
+        caller.send(MESSAGE)
+
+    def frame(self, caller, data):
+        self.remaining -= 1
+        if self.remaining:
+            caller.send(MESSAGE)
+        else:
+            self.elapsed = time.perf_counter() - self.start
+            caller.close()
+            self.loop.unloop()
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        print('Client Error: {}'.format(data))
+
+
+def run(transport, roundtrips):
+    loop = pyev.Loop()
+    client = Client(loop, roundtrips)
+    accept = {'onpeer': lambda c, d: True}
+
+    if transport == 'tcp':
+        listener = TCPListener(loop, EchoServer, accept)
+        listener.listen('127.0.0.1', 0)
+        conn = TCPConnection(loop, client)
+        address = ('127.0.0.1', listener.address[1])
+    else:
+        type = socket.SOCK_STREAM
+        if transport == 'seqpacket':
+            type = socket.SOCK_SEQPACKET
+        listener = UnixListener(loop, EchoServer, accept, type=type)
+        listener.listen('\0esocket-bench-unix')
+        conn = UnixConnection(loop, client, type=type)
+        address = ('\0esocket-bench-unix',)
+
+    # Stream sockets need the messages cut out of the stream, packet
+    # sockets keep them whole.
+    if transport != 'seqpacket':
+        listener.framer = DelimiterFramer()
+        conn.framer = DelimiterFramer()
+    conn.connect(*address)
+
+    loop.loop()
+    listener.close()
+    return client.elapsed / roundtrips
+
+
+if __name__ == '__main__':
+
+    roundtrips = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    print('{} round trips of {} bytes'.format(roundtrips, len(MESSAGE)))
+    for transport in ('tcp', 'stream', 'seqpacket'):
+        rtt = run(transport, roundtrips)
+        print('{:>10}: {:7.2f} us per round trip'.format(transport,
+                                                          rtt * 1e6))
@@ -16,13 +16,34 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-
-import pyev
+import threading
+import _socket as socket
+from collections import deque
 
 import esocket.error
-from esocket.baseesocket import BaseEsocket
+from esocket.baseesocket import BaseEsocket, Handled
+from esocket.buffer import ReceiveBuffer, SendQueue, FileSegment
+from esocket.eventloop import EV_READ, EV_WRITE
+
+# The initial number of bytes requested from the socket per read, and
+# the bounds the connection adapts it within.
+RECV_SIZE = 4096
+RECV_MINSIZE = 1024
+RECV_MAXSIZE = 262144
+
+# The most bytes read from the socket per readiness event before other
+# connections on the loop get their turn.
+RECV_BUDGET = 1048576
+
+# Sendqueue sizes at which the handler is asked to pause and resume
+# writing.
+WRITE_HIGH = 65536
+WRITE_LOW = 16384
+
+# Guards making the queue of send_threadsafe() on first use
+_safelock = threading.Lock()
 
-class BaseConnection(BaseEsocket):
+class BaseConnection(Handled, BaseEsocket):
     """
     A basic connection socket.
 
@@ -38,100 +59,375 @@ class BaseConnection(BaseEsocket):
     * Error - Dispatched when an error occured
     * Timeout - Dispatched if a timeout occured
     * Data - Dispatched when new data has arrived
+    * Frame - Dispatched for every complete frame instead of Data,
+      when the connection has a framer
+    * Pause_writing - Dispatched when the sendqueue grows past
+      writehigh
+    * Resume_writing - Dispatched when the sendqueue is back down to
+      writelow
+    * Draining - Dispatched when the listener of a peer is draining
     """
 
+    __slots__ = ('_handler', '_esend', '_erecv', '_streaming', '_sendbuf',
+                 '_safequeue', '_safescheduled', '_closedrained',
+                 '_coalesce', '_corked', '_flushdeferred', '_writehigh',
+                 '_writelow', '_writepaused', '_readhigh', '_readpauses',
+                 '_recvfull', '_upstream', '_recvbuf', '_recvsize',
+                 '_recvbudget', '_framer', '_readwaiter', '_drainwaiter')
+
     def __init__(self, eloop, sock, connhandler):
 
         super().__init__(eloop, sock)
         self._handler = connhandler
 
-        self._esend = pyev.Io(self._socket, pyev.EV_WRITE,
-                              self._eloop, self._sendhandler)
-
-        self._erecv = pyev.Io(self._socket, pyev.EV_READ,
-                              self._eloop, self._recvhandler)
-
-        self._sendbuf = bytearray()
-        self._sendsize = 0
-        self._recvbuf = bytearray()
-        self._recvsize = 0
+        # Most sends fit in the socket, so the send watcher is only
+        # made once the socket has been full.
+        self._esend = None
+        self._erecv = self._eloop.io(self._socket, EV_READ,
+                                     self._recvhandler)
+
+        # Packet sockets keep the boundaries of every send and read.
+        # The buffers hold no storage until data is queued or read,
+        # and the queue for other threads is made on first use.
+        self._streaming = sock.type != socket.SOCK_SEQPACKET
+        self._sendbuf = self._newsendqueue()
+        self._safequeue = None
+        self._safescheduled = False
+        self._closedrained = False
+        self._coalesce = False
+        self._corked = False
+        self._flushdeferred = False
+
+        # Flow control, see writehigh, readhigh and upstream
+        self._writehigh = WRITE_HIGH
+        self._writelow = WRITE_LOW
+        self._writepaused = False
+        self._readhigh = None
+        self._readpauses = 0
+        self._recvfull = False
+        self._upstream = None
+        self._recvbuf = ReceiveBuffer(pool=self._eloop.bufferpool)
+        self._recvsize = RECV_SIZE
+        self._recvbudget = RECV_BUDGET
+        self._framer = None
+
+        # Futures of coroutines waiting in read() or drain()
+        self._readwaiter = None
+        self._drainwaiter = None
 
 #-----------------------------------------------------------------------
 # Private Methods
 #-----------------------------------------------------------------------
 
-    def _hcall(self, event, data):
-        # hcall invokes the specified event method in the
-        # connectionhandler, supplies it with the caller (self)
-        # and data and returns a boolean value.
-        try:
-            return bool(getattr(self._handler, event)(self, data))
-        except:
+    def _enqueue(self, data):
+        # Add data to the sendqueue, returns False if it does not fit.
+        # Only the data held in memory counts, not queued files.
+        sendbuf = self._sendbuf
+        if sendbuf.buffered + len(data) > self._maxsend:
+            self._dispatcherror(esocket.error.SendOverflowError())
             return False
 
+        sendbuf.append(data)
+        size = sendbuf.buffered
+
+        m = self._metrics
+        if m is not None and size > m.queuehigh:
+            m.queuehigh = size
+
+        if not self._writepaused and self._writehigh is not None and \
+                size > self._writehigh:
+            self._writepaused = True
+            if self._upstream is not None:
+                self._upstream.pausereading()
+            self._dispatchpausewriting(size)
+        return True
+
+    def _sendwatcher(self):
+        # Returns the send watcher, making it on first use
+        if self._esend is None:
+            self._esend = self._eloop.io(self._socket, EV_WRITE,
+                                         self._sendhandler)
+        return self._esend
+
+    def _sendwaiting(self):
+        # True while the send watcher waits for the socket to drain
+        return self._esend is not None and self._esend.active
+
+    def _resumewriting(self):
+        self._writepaused = False
+        if self._upstream is not None:
+            self._upstream.resumereading()
+        self._dispatchresumewriting(self._sendbuf.buffered)
+
+    def _updatereading(self):
+        # Read from the socket unless reading has been paused or the
+        # receivebuffer is full.
+        if not self._active:
+            return
+
+        if self._readpauses or self._recvfull:
+            self._erecv.stop()
+        else:
+            self._erecv.start()
+
+    def _checkrecvfull(self):
+        # Stop reading while the application leaves readhigh bytes
+        # in the receivebuffer, so the kernel pushes back on the peer.
+        full = self._readhigh is not None and self._recvbuf is not None \
+            and len(self._recvbuf) >= self._readhigh
+        if full != self._recvfull:
+            self._recvfull = full
+            self._updatereading()
+
+    def _sendsoon(self):
+        # Start sending newly queued data, now or when the connection
+        # is uncorked or the loop iteration ends.
+        if self._corked:
+            return
+
+        if self._coalesce:
+            if not self._flushdeferred:
+                self._flushdeferred = True
+                self._eloop.defer(self._deferredflush)
+        else:
+            self._sendhandler(None, None)
+
+    def _deferredflush(self):
+        self._flushdeferred = False
+        if self._sendbuf and not self._corked and not self._sendwaiting():
+            self._sendhandler(None, None)
+
+    def _setcork(self, cork):
+        # TCP_CORK makes the kernel hold back partial segments
+        if hasattr(socket, 'TCP_CORK') and \
+                self.type == socket.SOCK_STREAM and \
+                self.family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                self._socket.setsockopt(socket.IPPROTO_TCP,
+                                        socket.TCP_CORK, int(cork))
+            except socket.error:
+                pass
+
+    def _sendsafe(self):
+        # Runs on the loop, queues everything sent from other threads
+        # and sends it with as few calls as possible.
+        self._safescheduled = False
+        queue = self._safequeue
+
+        if self._sendbuf is None:
+            queue.clear()
+            return
+
+        pending = bool(self._sendbuf)
+        for i in range(len(queue)):
+            self._enqueue(queue.popleft())
+
+        if not pending and self._sendbuf:
+            self._sendsoon()
+
+    def _closesafe(self):
+        # Runs on the loop, closes once the data sent so far is out
+        if self._safequeue:
+            self._sendsafe()
+
+        if self._sendbuf:
+            self._closedrained = True
+        else:
+            self.close()
+
+    def _teardown(self):
+        # Close the socket, release the buffers and watchers and
+        # dispatch the disconnected event. The event objects are
+        # stopped and released before the socket is closed.
+        self.timeout = None
+        if self._esend is not None:
+            self._esend.stop()
+        self._erecv.stop()
+        self._esend = None
+        self._erecv = None
+
+        self._close()
+
+        # Release the buffers, but keep any unread data around
+        # for recv() and read().
+        self._sendbuf.clear()
+        self._sendbuf = None
+        if not self._recvbuf:
+            self._recvbuf.clear()
+            self._recvbuf = None
+
+        # Let the upstream connection read again
+        if self._writepaused:
+            self._writepaused = False
+            if self._upstream is not None:
+                self._upstream.resumereading()
+
+        # After a close, set as inactive, wake up any waiting
+        # coroutines and dispatch the disconnected event
+        if self._active:
+            self._eloop.release()
+        self._active = False
+        self._wakeup(self._readwaiter)
+        self._wakeup(self._drainwaiter)
+        self._readwaiter = None
+        self._drainwaiter = None
+        self._dispatchdisconnected()
+
+    def _newsendqueue(self):
+        # Returns the sendqueue of the connection. Transports which
+        # write more than the bytes queued override it.
+        return SendQueue(packets=not self._streaming)
+
+    def _recvinto(self, size):
+        # Read up to size bytes into the receivebuffer, returning the
+        # number read. Transports reading more than bytes override it.
+        return self._recvbuf.recv(self._socket, size)
+
+    def _wakeup(self, waiter):
+        # Resume a coroutine waiting on the future waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
 #-----------------------------------------------------------------------
 # Private Event handlers and dispatchers
 #-----------------------------------------------------------------------
 
     def _sendhandler(self, watcher, event):
-        # Sendhandler tries to send as much of the sendbuffer to the
+        # Sendhandler tries to send as much of the sendqueue to the
         # socket as possible. If unable to send or there is still data
         # left after the send, start the sending event and continue
         # sending at the next opportunity.
         # When there is nothing left, stop the event
 
+        m = self._metrics
+        short = None
+
         try:
-            # Send as much of the sendbuffer as possible
-            sent = self._socket.send(self._sendbuf)
-        except socket.error as e:
+            # Send as much of the sendqueue as possible
+            sent = self._sendbuf.send(self._socket)
+            if sent:
+                if self._etimeout is not None:
+                    self._etimeout.refresh()
+                if self._writepaused and \
+                        self._sendbuf.buffered <= self._writelow:
+                    self._resumewriting()
+
+            if m is not None:
+                m.sendcalls += 1
+                m.bytesout += sent
+                if self._sendbuf:
+                    m.partialwrites += 1
+        except (BlockingIOError, InterruptedError):
+            if m is not None:
+                m.sendcalls += 1
+                m.eagain += 1
+        except socket.error:
             # An error means we sent nothing.
-            sent = 0
+            pass
+        except esocket.error.ShortFileError as e:
+            short = e
         finally:
-            assert(not sent < 0)
-            if sent:
-                self._sendbuf = self._sendbuf[sent:]
-                self._sendsize -= sent
-
-            if not self._sendsize and watcher is not None:
+            if not self._sendbuf and watcher is not None:
                 # We sent everything, stop the event for now
                 self._esend.stop()
-            elif self._sendsize and watcher is None:
+                if self._drainwaiter is not None:
+                    self._wakeup(self._drainwaiter)
+                    self._drainwaiter = None
+                if self._closedrained:
+                    self.close()
+            elif self._sendbuf and watcher is None:
                 # Data left, start the send event
-                self._esend.start()
+                self._sendwatcher().start()
+
+        if short is not None:
+            # A file ended before its segment, the peer can not be
+            # given what it was promised.
+            self._dispatcherror(short)
+            self.close()
 
     def _recvhandler(self, watcher, event):
         # Recvhandler reads in any data available from the socket
-        # and stores it in the recvbuffer. Then it signals the
-        # ConnectionHandlers 'data' event, passing a copy of the
-        # sendbuffer. The handler can view the data, but must call
-        # recv() to remove the data. If the peer closes the socket,
-        # recvhandler will close this end of the socket and
+        # directly into the recvbuffer, until the socket is drained
+        # or the read budget for this event is spent. Then it signals
+        # the ConnectionHandlers 'data' event, passing the size of the
+        # recvbuffer. The handler can view the data with peek(), but
+        # must call recv() to remove the data. If the peer closes the
+        # socket, recvhandler will close this end of the socket and
         # dispatching disconnected events.
+        #
+        # The size of each read adapts to the peer, doubling when a
+        # read fills the request and halving when it uses less than
+        # a quarter of it.
 
-        data = bytes()
+        received = 0
+        calls = 0
+        again = False
+        closed = False
 
         try:
-            data = self._socket.recv(4096)
-            if data:
-                self._recvsize += len(data)
-                if self._recvsize > self._maxrecv:
-                    raise error.ReceiveOverflowError
-                else:
-                    self._recvbuf.extend(data)
-
-        except error.ReceiveOverflowError as e:
+            while received < self._recvbudget:
+                size = min(self._recvsize,
+                           self._maxrecv - len(self._recvbuf))
+                if size <= 0:
+                    raise esocket.error.ReceiveOverflowError()
+
+                calls += 1
+                count = self._recvinto(size)
+                if not count:
+                    # data available but no data means peer closed socket.
+                    closed = True
+                    break
+
+                received += count
+                if count == self._recvsize:
+                    if self._recvsize < RECV_MAXSIZE:
+                        self._recvsize = min(self._recvsize * 2,
+                                             RECV_MAXSIZE)
+                elif count < self._recvsize >> 2:
+                    if self._recvsize > RECV_MINSIZE:
+                        self._recvsize = max(self._recvsize >> 1,
+                                             RECV_MINSIZE)
+
+                if count < size and self._streaming:
+                    # A short read means the socket has been drained,
+                    # no need to wait for it to say so. That does not
+                    # hold for packets, which are read one per call.
+                    break
+
+                if self._readhigh is not None and \
+                        len(self._recvbuf) >= self._readhigh:
+                    break
+
+        except (BlockingIOError, InterruptedError):
+            again = True
+
+        except esocket.error.ReceiveOverflowError as e:
             self._dispatcherror(e)
 
-        finally:
-            if not data:
-                # data available but no data means peer closed socket.
-                if self._recvsize:
-                    # Trigger dataevent if there is anything in the
-                    # receive buffer
-                    self._dispatchdata(len(self._recvbuf))
-                self.close()
-            else:
+        except socket.error as e:
+            self._dispatcherror(e)
+            closed = True
+
+        if received and self._etimeout is not None:
+            self._etimeout.refresh()
+
+        m = self._metrics
+        if m is not None:
+            m.recvcalls += calls
+            m.bytesin += received
+            if again:
+                m.eagain += 1
+
+        if closed:
+            if self._recvbuf:
+                # Trigger dataevent if there is anything in the
+                # receive buffer
                 self._dispatchdata(len(self._recvbuf))
+            self.close()
+        elif received and self._active:
+            self._dispatchdata(len(self._recvbuf))
+            if self._readhigh is not None:
+                self._checkrecvfull()
 
     def _timeouthandler(self, watcher, event):
         self._dispatchtimeout()
@@ -155,8 +451,40 @@ class BaseConnection(BaseEsocket):
     def _dispatchtimeout(self, data=None):
         self._hcall('timeout', data)
 
+    def _dispatchpausewriting(self, data=None):
+        self._hcall('pause_writing', data)
+
+    def _dispatchresumewriting(self, data=None):
+        self._hcall('resume_writing', data)
+
+    def _dispatchdraining(self, data=None):
+        return self._hcall('draining', data)
+
     def _dispatchdata(self, data=None):
-        self._hcall('data', data)
+        if self._framer is None:
+            self._hcall('data', data)
+        else:
+            self._dispatchframes()
+
+        if self._readwaiter is not None:
+            self._wakeup(self._readwaiter)
+            self._readwaiter = None
+
+    def _dispatchframes(self):
+        # Cut frames from the receivebuffer one at a time and dispatch
+        # them, leaving the rest in the buffer if a handler closes the
+        # connection. Data which can not be framed closes it.
+        while self._active and self._framer is not None:
+            try:
+                frame = self._framer.frame(self._recvbuf)
+            except esocket.error.FrameError as e:
+                self._dispatcherror(e)
+                self.close()
+                return
+
+            if frame is None:
+                break
+            self._hcall('frame', frame)
 
 #-----------------------------------------------------------------------
 # Public Properties
@@ -165,34 +493,140 @@ class BaseConnection(BaseEsocket):
     @property
     def timeout(self):
         """
-        Setting a socket timeout will trigger a timeout event every
-        specified seconds. Set to None to disable.
+        Setting a socket timeout will trigger a timeout event after
+        the connection has been idle for the specified seconds, and
+        then every specified seconds for as long as it stays idle.
+        Sending or receiving data restarts the timeout. Set to None
+        to disable.
+
+        The timeouts of all connections on a loop share the loops
+        TimerWheel, which has a resolution of 0.1 seconds.
         """
 
         if self._etimeout is not None:
-            return self._etimeout.repeat
+            return self._etimeout.timeout
         else:
             return None
 
     @timeout.setter
     def timeout(self, seconds):
-        if seconds is None:
-            if self._etimeout is not None:
-                self._etimeout.stop()
-                self._etimeout = None
-        else:
-            if self._etimeout is not None:
-                self._etimeout.stop()
-
-            self._etimeout = pyev.Timer(seconds, seconds,
-                                        self._eloop,
-                                        self._timeouthandler)
+        if self._etimeout is not None:
+            self._etimeout.cancel()
+            self._etimeout = None
 
-            self._etimeout.start()
+        if seconds is not None:
+            self._etimeout = self._eloop.timerwheel.add(
+                seconds, self._timeouthandler)
 
     def timeoutrestart(self):
+        """
+        Restart the timeout, as if data was just sent or received.
+        """
+
         if self._etimeout is not None:
-            self.etimeout.again()
+            self._etimeout.refresh()
+
+    @property
+    def framer(self):
+        """
+        The framer from esocket.framing used to cut received data into
+        frames for the 'frame' event, or None (default) to dispatch
+        'data' events instead.
+        """
+
+        return self._framer
+
+    @framer.setter
+    def framer(self, framer):
+        self._framer = framer
+
+    @property
+    def recvsize(self):
+        """
+        The number of bytes requested from the socket per read.
+
+        The connection adapts this to the peer, growing it for peers
+        that keep the socket full and shrinking it for idle ones.
+        """
+
+        return self._recvsize
+
+    @recvsize.setter
+    def recvsize(self, size):
+        self._recvsize = min(max(size, RECV_MINSIZE), RECV_MAXSIZE)
+
+    @property
+    def recvbudget(self):
+        """
+        The most bytes read from the socket per readiness event. When
+        the budget is spent, the remaining data is read on the next
+        loop iteration so other connections get their turn.
+        """
+
+        return self._recvbudget
+
+    @recvbudget.setter
+    def recvbudget(self, size):
+        self._recvbudget = size
+
+    @property
+    def coalesce(self):
+        """
+        When True, data sent is not written right away but at the end
+        of the loop iteration, so a handler sending many small pieces
+        writes them with a single call. False by default.
+        """
+
+        return self._coalesce
+
+    @coalesce.setter
+    def coalesce(self, coalesce):
+        self._coalesce = coalesce
+        if not coalesce and self._sendbuf and not self._sendwaiting() \
+                and not self._corked:
+            self._sendhandler(None, None)
+
+    @property
+    def readhigh(self):
+        """
+        When set, the connection stops reading from the socket while
+        the receivebuffer holds readhigh bytes or more, and starts
+        again when recv() takes it below. This leaves the data in the
+        kernel, and TCP makes the peer slow down. It must be larger
+        than anything the application waits for in the buffer. None
+        (default) disables it.
+        """
+
+        return self._readhigh
+
+    @readhigh.setter
+    def readhigh(self, size):
+        self._readhigh = size
+        self._checkrecvfull()
+
+    @property
+    def upstream(self):
+        """
+        A connection feeding this one, such as the client side of a
+        proxy. It is paused with pausereading() while the sendqueue of
+        this connection is above writehigh.
+        """
+
+        return self._upstream
+
+    @upstream.setter
+    def upstream(self, conn):
+        if self._writepaused:
+            if self._upstream is not None:
+                self._upstream.resumereading()
+            if conn is not None:
+                conn.pausereading()
+        self._upstream = conn
+
+    @property
+    def isreading(self):
+        """ Returns True if the connection is reading from the socket """
+        return self._active and self._erecv.active
 
 #-----------------------------------------------------------------------
 # Public Methods
@@ -200,54 +634,165 @@ class BaseConnection(BaseEsocket):
 
     def close(self):
         if self._active:
-            self._close()
-
-            # Stop and release the event objects
-            self.timeout = None
-            self._esend.stop()
-            self._erecv.stop()
-            self._esend = None
-            self._erecv = None
-
-            # Release the buffers
-            self._sendbuf = None
-            self._recvbuf = None
-
-            # After a close, set as inactive and
-            # dispatch the disconnected event
-            self._active = False
-            self._dispatchdisconnected()
+            self._teardown()
 
     def send(self, data):
         """
         Send data to the connected peer. Will raise an error if the
         amount of data exceeds the size of the sendbuffer.
+
+        The data is queued by reference and not copied, so a mutable
+        buffer such as a bytearray must not be changed after it has
+        been passed to send().
         """
-        try:
-            self._sendsize += len(data)
-            if self._sendsize > self._maxsend:
-                raise error.SendOverflowError()
-            self._sendbuf.extend(data)
 
-            # Call the sendhandler and attempt to send the
-            # data immediately.
+        pending = bool(self._sendbuf)
+
+        # Attempt to send the data immediately, unless earlier
+        # data is still waiting for the socket to become writable.
+        if self._enqueue(data) and not pending:
+            self._sendsoon()
+
+    def sendfile(self, fileobj, offset=0, count=None):
+        """
+        Send count bytes of a file, starting at offset, or the rest
+        of the file if count is None. The file is queued after the data
+        sent so far, and sent without copying it through Python with
+        os.sendfile() as the socket becomes writable. Files which do
+        not support sendfile are mapped with mmap, or read a piece at
+        a time.
+
+        fileobj is a file object or a file descriptor, and must stay
+        open until it has been sent. The position of the file is not
+        used or changed. A file which ends before count bytes have
+        been sent dispatches ShortFileError and closes the connection.
+        """
+
+        segment = FileSegment(fileobj, offset, count)
+
+        pending = bool(self._sendbuf)
+        self._sendbuf.appendsegment(segment)
+        if not pending and self._sendbuf:
+            self._sendsoon()
+
+    def flush(self):
+        """
+        Send the queued data now, even when the connection is corked
+        or coalescing. A corked connection stays corked.
+        """
+
+        if self._sendbuf and not self._sendwaiting():
             self._sendhandler(None, None)
 
-        except error.SendOverflowError as e:
-            self._dispatcherror(e)
+        if self._corked:
+            # Toggling TCP_CORK pushes out a partial segment
+            self._setcork(False)
+            self._setcork(True)
+
+    def cork(self):
+        """
+        Hold back the data sent until uncork() or flush() is called,
+        so it goes out in as few calls and segments as possible. TCP
+        connections also set TCP_CORK where the platform has it.
+        """
+
+        if not self._corked:
+            self._corked = True
+            self._setcork(True)
+
+    def uncork(self):
+        """
+        Send the data held back since cork() and go back to sending
+        as data is sent.
+        """
+
+        if self._corked:
+            self._corked = False
+            if self._sendbuf and not self._sendwaiting():
+                self._sendhandler(None, None)
+            self._setcork(False)
+
+    def pausereading(self):
+        """
+        Stop reading from the socket until resumereading() is called.
+        Calls nest, reading resumes after as many resumereading()
+        calls as there were pausereading() calls.
+        """
+
+        self._readpauses += 1
+        self._updatereading()
+
+    def resumereading(self):
+        """
+        Undo a pausereading() call.
+        """
+
+        if self._readpauses:
+            self._readpauses -= 1
+            self._updatereading()
+
+    def send_threadsafe(self, data):
+        """
+        Send data to the connected peer from any thread. The data is
+        sent from the loop, together with everything else sent with
+        send_threadsafe() since the loop last got to it, and is
+        dropped if the connection is not open, or has been closed by
+        then.
+        """
+
+        queue = self._safequeue
+        if queue is None:
+            with _safelock:
+                if self._safequeue is None:
+                    self._safequeue = deque()
+            queue = self._safequeue
+
+        queue.append(data)
+        if not self._safescheduled:
+            self._safescheduled = True
+            try:
+                self._eloop.call_soon_threadsafe(self._sendsafe)
+            except RuntimeError:
+                # Nothing holds the loop, so the connection is closed
+                self._safescheduled = False
+                queue.clear()
+
+    def close_threadsafe(self):
+        """
+        Close the connection from any thread, once the data sent so
+        far, including with send_threadsafe(), has been written. Does
+        nothing if the connection is not open.
+        """
+
+        try:
+            self._eloop.call_soon_threadsafe(self._closesafe)
+        except RuntimeError:
+            pass
 
     def recv(self, count):
         """
         Get <count> bytes from the sockets receivebuffer.
         """
-        if count > self._recvsize or count < 0:
-            count = self._recvsize
 
-        recved = self._recvbuf[:count]
-        self._recvbuf = self._recvbuf[count:]
-        self._recvsize -= count
+        if self._framer is not None:
+            self._framer.reset()
+        data = self._recvbuf.read(count)
+
+        if self._recvfull:
+            self._checkrecvfull()
+        return data
+
+    def peek(self, count=-1):
+        """
+        Get a memoryview of up to <count> bytes from the sockets
+        receivebuffer without removing them. A negative count returns
+        everything received so far.
+
+        The view shares memory with the receivebuffer and is only
+        valid until the next call to recv() or the next data event.
+        """
 
-        return bytes(recved)
+        return self._recvbuf.peek(count)
 
     def recvchunk(self, term):
         """
@@ -259,3 +804,80 @@ class BaseConnection(BaseEsocket):
         """
 
         return self.recv(self._recvbuf.index(term)+len(term))
+
+#-----------------------------------------------------------------------
+# Public Coroutines
+#-----------------------------------------------------------------------
+
+    # The coroutines need an asyncio loop, and allow a connection to be
+    # used without a connectionhandler. Only one coroutine at a time
+    # may wait for data.
+
+    async def _waitdata(self):
+        if self._readwaiter is not None:
+            raise RuntimeError('another coroutine is already '
+                               'waiting for data')
+
+        # Waiting for more data needs reading, even past readhigh
+        if self._recvfull:
+            self._recvfull = False
+            self._updatereading()
+
+        self._readwaiter = self._eloop.future()
+        try:
+            await self._readwaiter
+        finally:
+            self._readwaiter = None
+
+    async def read(self, count=-1):
+        """
+        Get up to <count> bytes from the sockets receivebuffer,
+        waiting for data to arrive if it is empty. Returns an empty
+        bytes object once the connection is closed and drained.
+        """
+
+        while not self._recvbuf:
+            if not self._active:
+                return bytes()
+            await self._waitdata()
+
+        return self.recv(count)
+
+    async def readuntil(self, term=b'\n'):
+        """
+        Get a chunk of data from the socket, up to and including the
+        terminator specified, waiting for more data until it arrives.
+
+        Raises IncompleteReadError if the connection is closed before
+        the terminator is found, and ReceiveOverflowError if the
+        receivebuffer fills up without it.
+        """
+
+        start = 0
+        while True:
+            if self._recvbuf:
+                index = self._recvbuf.find(term, start)
+                if index >= 0:
+                    return self.recv(index + len(term))
+
+                # Only search new data when more has arrived
+                start = max(0, len(self._recvbuf) - len(term) + 1)
+                if len(self._recvbuf) >= self._maxrecv:
+                    raise esocket.error.ReceiveOverflowError()
+
+            if not self._active:
+                partial = self.recv(-1) if self._recvbuf else bytes()
+                raise esocket.error.IncompleteReadError(partial)
+
+            await self._waitdata()
+
+    async def drain(self):
+        """
+        Wait until everything in the sendqueue has been written to
+        the socket, or until the connection is closed.
+        """
+
+        while self._active and self._sendbuf:
+            if self._drainwaiter is None:
+                self._drainwaiter = self._eloop.future()
+            await self._drainwaiter
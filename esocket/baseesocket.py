@@ -23,9 +23,11 @@
 """
 
 import sys
+import time
 import _socket as socket
 
-import pyev
+import esocket.eventloop
+from esocket.metrics import Metrics
 
 class BaseEsocket(object):
     """
@@ -35,21 +37,31 @@ class BaseEsocket(object):
     * Connected - Called when the socket is ready for actions
     * Disconnected - Fired when socket can not perform any more actions
     * Error - Fired when an error occured while performing actions
+
+    Esockets keep their state in __slots__, so a subclass must declare
+    the attributes it adds in __slots__ of its own to stay compact.
     """
 
+    __slots__ = ('_socket', '_eloop', '_active', '_events', '_data',
+                 '_etimeout', '_maxsend', '_maxrecv', '_metrics')
+
     def __init__(self, eloop, sock):
         self._socket = sock
         self._socket.setblocking(False)
 
-        self._eloop = eloop
+        # The loop is either a pyev or an asyncio loop, the esocket
+        # talks to it through an EventLoop wrapper.
+        self._eloop = esocket.eventloop.wrap(eloop)
         self._active = False
 
-        self._eventmap = {}
+        # Event callbacks, the dict is only made once one is set
+        self._events = None
 
         self._data = None
         self._etimeout = None
         self._maxsend = sys.maxsize
         self._maxrecv = sys.maxsize
+        self._metrics = None
 
 #-----------------------------------------------------------------------
 # Private Methods
@@ -68,11 +80,41 @@ class BaseEsocket(object):
             self._socket.close()
 
     # Callhandler for events
+    def _setevent(self, event, fn):
+        if self._events is None:
+            if fn is None:
+                return
+            self._events = {}
+        self._events[event] = fn
+
+    def _getevent(self, event):
+        if self._events is None:
+            return None
+        return self._events.get(event)
+
     def _ecall(self, event, data):
+        events = self._events
+        if events is None:
+            return False
+
+        callback = events.get(event)
+        if callback is None:
+            return False
+
+        p = self._eloop._profiler
+        if p is not None:
+            start = time.perf_counter()
+            p._enter(self, event, callback, start)
+
         try:
-            return bool(self._eventmap.get(event)(self, data))
+            return bool(callback(self, data))
         except:
+            if self._metrics is not None:
+                self._metrics.exceptions += 1
             return False
+        finally:
+            if p is not None:
+                p._leave(time.perf_counter() - start)
 
     def _dispatchconnected(self, data=None):
         return self._ecall('connected', data)
@@ -102,6 +144,11 @@ class BaseEsocket(object):
         """ Returns the Esocket protocol"""
         return self._socket.proto
 
+    @property
+    def address(self):
+        """ Returns the address the Esocket is bound to """
+        return self._socket.getsockname()
+
     @property
     def isactive(self):
         """
@@ -191,24 +238,118 @@ class BaseEsocket(object):
 
     @property
     def onconnected(self):
-        return self._eventmap.get('connected')
+        return self._getevent('connected')
 
     @onconnected.setter
     def onconnected(self, fn):
-        self._eventmap['connected'] = fn
+        self._setevent('connected', fn)
 
     @property
     def ondisconnected(self):
-        return self._eventmap.get('disconnected')
+        return self._getevent('disconnected')
 
     @ondisconnected.setter
     def ondisconnected(self, fn):
-        self._eventmap['disconnected'] = fn
+        self._setevent('disconnected', fn)
 
     @property
     def onerror(self):
-        return self._eventmap.get('error')
+        return self._getevent('error')
 
     @onerror.setter
     def onerror(self, fn):
-        self._eventmap['error'] = fn
+        self._setevent('error', fn)
+
+
+class Handled(object):
+    """
+    The parts shared by the esockets which dispatch their events to a
+    handler object, connections and datagram endpoints: calling the
+    handler, the write watermarks and the metrics. The classes using
+    it declare _handler, _writehigh and _writelow in their __slots__.
+    """
+
+    __slots__ = ()
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _hcall(self, event, *args):
+        # hcall invokes the specified event method in the handler,
+        # supplies it with the caller (self) and the arguments and
+        # returns a boolean value. Connections used through the
+        # coroutine api may have no handler.
+        if self._handler is None:
+            return False
+
+        m = self._metrics
+        p = self._eloop._profiler
+        if m is None and p is None:
+            try:
+                return bool(getattr(self._handler, event)(self, *args))
+            except:
+                return False
+
+        start = time.perf_counter()
+        if p is not None:
+            p._enter(self, event, self._handler, start)
+
+        try:
+            return bool(getattr(self._handler, event)(self, *args))
+        except:
+            if m is not None:
+                m.exceptions += 1
+            return False
+        finally:
+            elapsed = time.perf_counter() - start
+            if m is not None:
+                m.observe(event, elapsed)
+            if p is not None:
+                p._leave(elapsed)
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def writehigh(self):
+        """
+        When more than writehigh bytes are waiting to be sent, the
+        handlers pause_writing event is dispatched, until the queue is
+        down to writelow bytes and resume_writing is dispatched. A
+        connection also pauses its upstream connection meanwhile.
+        None disables it.
+        """
+
+        return self._writehigh
+
+    @writehigh.setter
+    def writehigh(self, size):
+        self._writehigh = size
+
+    @property
+    def writelow(self):
+        """ See writehigh """
+        return self._writelow
+
+    @writelow.setter
+    def writelow(self, size):
+        self._writelow = size
+
+    @property
+    def metrics(self):
+        """
+        The Metrics of the esocket, see esocket.metrics. Set to True
+        to start counting, or to None (default) to stop.
+        """
+
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        if metrics is True:
+            metrics = Metrics()
+        elif not metrics:
+            metrics = None
+        self._metrics = metrics
@@ -0,0 +1,651 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Buffer types used by the esocket connections.
+"""
+
+import os
+import mmap
+import array
+import stat
+import errno
+import _socket as socket
+from collections import deque
+from itertools import islice
+
+import esocket.error
+
+# A drained receivebuffer keeps its storage for the next read as long
+# as it is no larger than this.
+RETAIN_SIZE = 16384
+
+# The storage of an empty receivebuffer, shared until the first read
+_EMPTY = b''
+
+# The most buffers a single sendmsg() call may be given.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# The most bytes of a file segment sent per call, and read per call
+# from files which can be neither sent with sendfile() nor mapped.
+SENDFILE_MAX = 0x7ffff000
+READ_SIZE = 262144
+
+# sendfile() errors meaning the file or socket does not support it
+_NOSENDFILE = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK,
+               errno.ESPIPE)
+
+class ReceiveBuffer(object):
+    """
+    A receivebuffer which is filled at the back and consumed from
+    the front.
+
+    The unread data lives between a read and a write offset in a
+    preallocated bytearray. Sockets read directly into the free space
+    behind the data with recv_into(), and reading from the buffer only
+    advances the read offset, so consuming n bytes in any number of
+    reads costs O(n) in total.
+
+    Views returned by peek() share memory with the buffer and are
+    only valid until the buffer is read from or filled again. Once
+    drained, the buffer keeps storage of up to retain bytes, unless
+    it has a BufferPool, which it borrows its storage from and gives
+    it back to as soon as it is drained.
+    """
+
+    __slots__ = ('_buf', '_pos', '_end', '_pool', 'retain')
+
+    def __init__(self, retain=RETAIN_SIZE, pool=None):
+        self._buf = _EMPTY
+        self._pos = 0
+        self._end = 0
+        self._pool = pool
+        self.retain = retain
+
+    def __len__(self):
+        return self._end - self._pos
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _reserve(self, count):
+        # Make room for at least count bytes behind the unread data,
+        # either by moving the data to the front of the buffer or by
+        # moving it to a larger one. Data is only moved within the
+        # buffer when the consumed space is at least as large as the
+        # data, which keeps the total cost of moving it linear.
+        if len(self._buf) - self._end >= count:
+            return
+
+        size = self._end - self._pos
+        if self._pos >= size and len(self._buf) - size >= count:
+            with memoryview(self._buf) as view:
+                view[:size] = view[self._pos:self._end]
+        else:
+            newsize = max(size + count, len(self._buf) * 2)
+            if self._pool is None:
+                buf = bytearray(newsize)
+            else:
+                buf = self._pool.acquire(newsize)
+            with memoryview(self._buf) as view:
+                buf[:size] = view[self._pos:self._end]
+            self._release()
+            self._buf = buf
+
+        self._pos = 0
+        self._end = size
+
+    def _consume(self, end):
+        # Advance the read offset to end, rewinding both offsets
+        # once everything has been read.
+        if end < self._end:
+            self._pos = end
+        else:
+            self._pos = 0
+            self._end = 0
+            if self._pool is not None or len(self._buf) > self.retain:
+                self._release()
+
+    def _release(self):
+        # Let go of the storage, giving it back to the pool
+        if self._pool is not None and self._buf is not _EMPTY:
+            self._pool.release(self._buf)
+        self._buf = _EMPTY
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def recv(self, sock, count):
+        """
+        Read up to <count> bytes from sock directly into the buffer
+        and return the number of bytes read. Socket errors, including
+        BlockingIOError, are passed on to the caller.
+        """
+
+        self._reserve(count)
+
+        with memoryview(self._buf) as view:
+            received = sock.recv_into(view[self._end:], count)
+
+        self._end += received
+        return received
+
+    def recvmsg(self, sock, count, ancbufsize=0, flags=0):
+        """
+        Like recv(), but with recvmsg_into(), returning the number of
+        bytes read along with the ancillary data and the flags of the
+        message.
+        """
+
+        self._reserve(count)
+
+        with memoryview(self._buf) as view:
+            received, ancdata, msgflags, address = sock.recvmsg_into(
+                [view[self._end:self._end+count]], ancbufsize, flags)
+
+        self._end += received
+        return received, ancdata, msgflags
+
+    def fill(self, read, count):
+        """
+        Like recv(), but reading with read(count, buffer), which puts
+        up to count bytes in buffer and returns the number it put
+        there, like SSLObject.read().
+        """
+
+        self._reserve(count)
+
+        with memoryview(self._buf) as view:
+            received = read(count, view[self._end:self._end+count])
+
+        self._end += received
+        return received
+
+    def extend(self, data):
+        """
+        Append data to the end of the buffer.
+        """
+
+        with memoryview(data) as view:
+            count = view.nbytes
+            if not count:
+                # An empty buffer may still be the shared b''
+                return
+            self._reserve(count)
+            self._buf[self._end:self._end+count] = view.cast('B')
+
+        self._end += count
+
+    def peek(self, count=-1):
+        """
+        Returns a memoryview of up to <count> unread bytes without
+        consuming them. A negative count returns all unread bytes.
+        """
+
+        if count < 0 or self._pos + count > self._end:
+            end = self._end
+        else:
+            end = self._pos + count
+
+        return memoryview(self._buf)[self._pos:end]
+
+    def read(self, count=-1):
+        """
+        Consume and return up to <count> bytes from the buffer.
+        A negative count reads everything.
+        """
+
+        pos = self._pos
+        if count < 0 or pos + count > self._end:
+            end = self._end
+        else:
+            end = pos + count
+
+        data = bytes(self._buf[pos:end])
+        self._consume(end)
+        return data
+
+    def skip(self, count):
+        """
+        Discard up to <count> bytes from the front of the buffer.
+        """
+
+        if count < 0 or self._pos + count > self._end:
+            self._consume(self._end)
+        else:
+            self._consume(self._pos + count)
+
+    def find(self, sub, start=0):
+        """
+        Returns the offset of sub relative to the unread data,
+        searching from offset start, or -1 if it is not found.
+        """
+
+        index = self._buf.find(sub, self._pos + start, self._end)
+        if index < 0:
+            return index
+        return index - self._pos
+
+    def index(self, sub, start=0):
+        """
+        Like find(), but raises ValueError when sub is not found.
+        """
+
+        return self._buf.index(sub, self._pos + start, self._end) - self._pos
+
+    def clear(self):
+        """
+        Discard all data in the buffer.
+        """
+
+        self._release()
+        self._pos = 0
+        self._end = 0
+
+
+class FileSegment(object):
+    """
+    count bytes of a file from offset, queued in a SendQueue.
+
+    Regular files are sent with os.sendfile(), straight from the page
+    cache to the socket. Files which do not support it are mapped with
+    mmap and sent from the mapping, and files which can not be mapped
+    either, like pipes, are read a piece at a time as the socket
+    drains. A count of None sends everything up to the end of the
+    file. When sendfile is False, the file is mapped or read even if
+    it could be sent with sendfile(), for transports which have to see
+    the data, like TLS.
+
+    The segment holds a reference to the file object, which must not
+    be closed before the segment has been sent.
+    """
+
+    __slots__ = ('_file', '_fd', '_offset', '_count', '_map', '_mapstart',
+                 '_chunk', '_regular')
+
+    def __init__(self, fileobj, offset=0, count=None, sendfile=True):
+        self._file = fileobj
+        self._fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self._offset = offset
+        self._map = None
+        self._chunk = None
+
+        st = os.fstat(self._fd)
+        regular = self._regular = stat.S_ISREG(st.st_mode)
+        if count is None:
+            if not regular:
+                raise ValueError('count is required for non-regular files')
+            count = max(0, st.st_size - offset)
+        self._count = count
+
+        if not regular or not sendfile or not hasattr(os, 'sendfile'):
+            self._fallback()
+
+    def __len__(self):
+        return self._count
+
+    def _fallback(self):
+        # Map the rest of the segment, the mapping has to start at a
+        # multiple of the allocation granularity.
+        start = self._offset - self._offset % mmap.ALLOCATIONGRANULARITY
+        try:
+            self._map = mmap.mmap(self._fd, self._offset - start + self._count,
+                                  access=mmap.ACCESS_READ, offset=start)
+        except (OSError, ValueError):
+            # Not mappable, read it instead
+            self._chunk = b''
+            return
+        self._mapstart = start
+
+    def advance(self, count):
+        """
+        Skip the first count bytes, which have been sent.
+        """
+
+        self._offset += count
+        self._count -= count
+        if self._chunk:
+            self._chunk = self._chunk[count:]
+
+    def send(self, sock):
+        """
+        Send as much of the segment as the socket accepts and return
+        the number of bytes sent. A file ending before the segment
+        does raises ShortFileError.
+        """
+
+        if self._map is not None:
+            start = self._offset - self._mapstart
+            with memoryview(self._map) as view:
+                return sock.send(view[start:start + self._count])
+
+        if self._chunk is not None:
+            if not self._chunk:
+                size = min(self._count, READ_SIZE)
+                if self._regular:
+                    # Read from the offset, leaving the file position
+                    self._chunk = os.pread(self._fd, size, self._offset)
+                else:
+                    self._chunk = os.read(self._fd, size)
+                if not self._chunk:
+                    raise esocket.error.ShortFileError(self._count)
+            return sock.send(self._chunk)
+
+        try:
+            sent = os.sendfile(sock.fileno(), self._fd, self._offset,
+                               min(self._count, SENDFILE_MAX))
+        except OSError as e:
+            if e.errno not in _NOSENDFILE:
+                raise
+            self._fallback()
+            return self.send(sock)
+
+        if not sent:
+            raise esocket.error.ShortFileError(self._count)
+        return sent
+
+    def close(self):
+        """
+        Release the mapping of the file, if any.
+        """
+
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class FDSegment(object):
+    """
+    File descriptors passed over a Unix socket with SCM_RIGHTS,
+    queued in a SendQueue.
+
+    The descriptors travel with the first byte of data, which can
+    not be empty. The segment sends duplicates of the descriptors,
+    so the caller may close its own as soon as they are queued.
+    """
+
+    __slots__ = ('_view', '_fds')
+
+    def __init__(self, fds, data=b'\0'):
+        view = memoryview(data)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        if not view:
+            raise ValueError('file descriptors must be sent with data')
+
+        self._view = view
+        self._fds = array.array('i')
+        try:
+            for fd in fds:
+                if not isinstance(fd, int):
+                    fd = fd.fileno()
+                self._fds.append(os.dup(fd))
+        except:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self._view)
+
+    def advance(self, count):
+        """
+        Skip the first count bytes, which have been sent along with
+        the descriptors.
+        """
+
+        self._view = self._view[count:]
+        self.close()
+
+    def send(self, sock):
+        """
+        Send as much of the data as the socket accepts, with the
+        descriptors if they have not been sent yet, and return the
+        number of bytes sent.
+        """
+
+        if not self._fds:
+            return sock.send(self._view)
+
+        return sock.sendmsg([self._view], [(socket.SOL_SOCKET,
+                                            socket.SCM_RIGHTS, self._fds)])
+
+    def close(self):
+        """
+        Close the duplicates of the descriptors not sent yet.
+        """
+
+        for fd in self._fds:
+            os.close(fd)
+        del self._fds[:]
+
+
+class SendQueue(object):
+    """
+    A sendqueue holding the buffers passed to it by reference.
+
+    Queued buffers are written with a single sendmsg() call, and a
+    partial write only advances into the first unsent buffer, so the
+    cost of sending is proportional to the bytes actually written.
+
+    Since buffers are not copied, a mutable buffer must not be
+    modified after it has been queued.
+
+    Segments, like a FileSegment or an FDSegment, may be queued
+    between the buffers, and are sent in turn with their own send()
+    method.
+
+    The queue of a packet socket, like a SOCK_SEQPACKET Unix socket,
+    is created with packets set to True. Every buffer is then sent as
+    a packet of its own instead of being gathered with the others.
+
+    The deque holding the buffers is only there while something is
+    queued, an empty queue is just a few counters.
+    """
+
+    __slots__ = ('_queue', '_size', '_packets', '_segments', '_segmentsize')
+
+    def __init__(self, packets=False):
+        self._queue = None
+        self._size = 0
+        self._packets = packets
+
+        # The number of segments queued and their bytes
+        self._segments = 0
+        self._segmentsize = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def buffered(self):
+        """ Returns the number of queued bytes held in memory """
+        return self._size - self._segmentsize
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _advance(self, count):
+        # Drop count bytes from the front of the queue
+        if self._segments:
+            return self._advancesegments(count)
+
+        queue = self._queue
+        self._size -= count
+
+        while count:
+            view = queue[0]
+            if count < len(view):
+                queue[0] = view[count:]
+                break
+
+            count -= len(view)
+            queue.popleft()
+
+        if not self._size:
+            self._queue = None
+
+    def _advancesegments(self, count):
+        # _advance() for a queue with segments in it
+        queue = self._queue
+        self._size -= count
+
+        while count:
+            item = queue[0]
+            size = len(item)
+            segment = type(item) is not memoryview
+
+            if count < size:
+                if segment:
+                    item.advance(count)
+                    self._segmentsize -= count
+                else:
+                    queue[0] = item[count:]
+                break
+
+            count -= size
+            queue.popleft()
+            if segment:
+                item.close()
+                self._segments -= 1
+                self._segmentsize -= size
+
+        if not self._size:
+            self._queue = None
+
+    def _sendsegments(self, sock):
+        # send() for a queue with segments in it, sending either
+        # the segment first in the queue, or the buffers up to the
+        # next segment.
+        queue = self._queue
+        head = queue[0]
+
+        if type(head) is not memoryview:
+            sent = head.send(sock)
+        else:
+            buffers = []
+            for item in islice(queue, IOV_MAX):
+                if type(item) is not memoryview:
+                    break
+                buffers.append(item)
+
+            if len(buffers) == 1:
+                sent = sock.send(head)
+            else:
+                sent = sock.sendmsg(buffers)
+
+        self._advance(sent)
+        return sent
+
+    def _sendpackets(self, sock):
+        # send() for a packet socket, sending the queued buffers one
+        # packet at a time until the socket is full.
+        queue = self._queue
+        sent = 0
+
+        try:
+            while queue:
+                head = queue[0]
+                if type(head) is memoryview:
+                    count = sock.send(head)
+                else:
+                    count = head.send(sock)
+                self._advance(count)
+                sent += count
+        except (BlockingIOError, InterruptedError):
+            if not sent:
+                raise
+
+        return sent
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def append(self, data):
+        """
+        Queue data at the end of the sendqueue.
+        """
+
+        view = memoryview(data)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+
+        if view:
+            if self._queue is None:
+                self._queue = deque()
+            self._queue.append(view)
+            self._size += len(view)
+
+    def appendsegment(self, segment):
+        """
+        Queue a segment at the end of the sendqueue.
+        """
+
+        if len(segment):
+            if self._queue is None:
+                self._queue = deque()
+            self._queue.append(segment)
+            self._size += len(segment)
+            self._segments += 1
+            self._segmentsize += len(segment)
+
+    def send(self, sock):
+        """
+        Write as much of the queue as the socket accepts and return
+        the number of bytes sent.
+        """
+
+        queue = self._queue
+        if not queue:
+            return 0
+
+        if self._packets:
+            return self._sendpackets(sock)
+
+        if self._segments:
+            return self._sendsegments(sock)
+
+        if len(queue) == 1:
+            sent = sock.send(queue[0])
+        else:
+            sent = sock.sendmsg(list(islice(queue, IOV_MAX)))
+
+        self._advance(sent)
+        return sent
+
+    def clear(self):
+        """
+        Discard everything in the queue.
+        """
+
+        if self._queue is not None:
+            for item in self._queue:
+                if type(item) is not memoryview:
+                    item.close()
+
+        self._queue = None
+        self._size = 0
+        self._segments = 0
+        self._segmentsize = 0
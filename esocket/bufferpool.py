@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    A pool of receive buffers shared by the connections on a loop.
+
+    Connections on a loop with a BufferPool borrow the storage of
+    their receivebuffers from it, and give it back as soon as the
+    buffer has been drained or the connection is closed. A request
+    and response over a short-lived connection then reuses storage
+    left by earlier connections instead of allocating its own.
+
+    Buffers come in size classes of powers of two, and requests are
+    rounded up to the next class. Sizes above the largest class are
+    allocated and freed as usual. The pool holds at most maxsize bytes
+    of free buffers, evicting free buffers of the largest classes
+    first to make room.
+
+    Since storage moves between connections, a view returned by
+    peek() must not be kept after the data has been read, or it may
+    show data received by another connection.
+"""
+
+# The smallest and largest size class, both powers of two
+MIN_CLASS = 1024
+MAX_CLASS = 1048576
+
+# The most bytes of free buffers held by a pool
+POOL_SIZE = 16777216
+
+class BufferPool(object):
+    """
+    Free lists of bytearrays in size classes, capped at maxsize bytes.
+
+    The counters are plain attributes: hits and misses count the
+    buffers acquired from a free list and allocated, oversize counts
+    the requests larger than the largest class, and evictions counts
+    the free buffers dropped to stay within maxsize.
+    """
+
+    __slots__ = ('_free', '_classes', '_maxsize', '_pooled',
+                 'hits', 'misses', 'oversize', 'evictions')
+
+    def __init__(self, maxsize=POOL_SIZE, minclass=MIN_CLASS,
+                 maxclass=MAX_CLASS):
+
+        self._classes = []
+        size = minclass
+        while size <= maxclass:
+            self._classes.append(size)
+            size <<= 1
+
+        self._free = {size: [] for size in self._classes}
+        self._maxsize = maxsize
+        self._pooled = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.oversize = 0
+        self.evictions = 0
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _classof(self, size):
+        # The smallest class holding size bytes, or None
+        if size <= self._classes[0]:
+            return self._classes[0]
+        size = 1 << (size - 1).bit_length()
+        if size > self._classes[-1]:
+            return None
+        return size
+
+    def _evict(self, size):
+        # Drop free buffers, largest first, until size bytes fit
+        for cls in reversed(self._classes):
+            free = self._free[cls]
+            while free and self._pooled + size > self._maxsize:
+                free.pop()
+                self._pooled -= cls
+                self.evictions += 1
+            if self._pooled + size <= self._maxsize:
+                return True
+        return False
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def maxsize(self):
+        """
+        The most bytes of free buffers held by the pool. Lowering it
+        evicts free buffers right away.
+        """
+
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, size):
+        self._maxsize = size
+        self._evict(0)
+
+    @property
+    def pooled(self):
+        """ Returns the number of bytes held in free buffers """
+        return self._pooled
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def acquire(self, size):
+        """
+        Returns a bytearray of at least size bytes, from a free list
+        when there is one of its class. Its contents are undefined.
+        """
+
+        cls = self._classof(size)
+        if cls is None:
+            self.oversize += 1
+            return bytearray(size)
+
+        free = self._free[cls]
+        if free:
+            self.hits += 1
+            self._pooled -= cls
+            return free.pop()
+
+        self.misses += 1
+        return bytearray(cls)
+
+    def release(self, buf):
+        """
+        Give a buffer from acquire() back to the pool. The buffer must
+        not be used afterwards.
+        """
+
+        size = len(buf)
+        free = self._free.get(size)
+        if free is None or size > self._maxsize:
+            return
+
+        if self._pooled + size > self._maxsize and not self._evict(size):
+            return
+
+        free.append(buf)
+        self._pooled += size
+
+    def clear(self):
+        """
+        Drop every free buffer.
+        """
+
+        for free in self._free.values():
+            del free[:]
+        self._pooled = 0
+
+    def snapshot(self):
+        """
+        Returns the counters, the bytes held and the number of free
+        buffers of each class as a dict.
+        """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'oversize': self.oversize,
+            'evictions': self.evictions,
+            'pooled': self._pooled,
+            'free': {cls: len(free) for cls, free in self._free.items()},
+        }
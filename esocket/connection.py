@@ -14,48 +14,402 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
 import sys
+import errno
+import os
+import functools
 import _socket as socket
 
 from esocket.baseconnection import BaseConnection
+from esocket.eventloop import EV_READ, EV_WRITE
+
+# Seconds to wait for a connection attempt before starting an attempt
+# to the next address in parallel.
+CONNECT_DELAY = 0.25
+
+# connect_ex() results meaning the connection is under way
+_INPROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN,
+               errno.EINTR)
+
+def _isaddress(host):
+    # True if host is an IP address rather than a name
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (OSError, ValueError):
+            pass
+    return False
 
 class Connection(BaseConnection):
 
+    __slots__ = ('_attempts', '_addresses', '_socketused', '_resolving',
+                 '_econnect', '_enext', '_connectdelay')
+
     def __init__(self, eloop, family, type, proto, connhandler):
 
         super().__init__(eloop, socket.socket(family, type, proto),
                          connhandler)
 
-    def _connect(self, address, timeout):
+        # Sockets and watchers of the connection attempts in progress,
+        # and the addresses not tried yet.
+        self._attempts = []
+        self._addresses = []
+        self._socketused = False
+        self._resolving = None
+        self._econnect = None
+        self._enext = None
+        self._connectdelay = CONNECT_DELAY
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _adopt(self, sock):
+        # Replace the socket of the connection, and the watchers on it
+        if self._esend is not None:
+            self._esend.stop()
+            self._esend = None
+        self._erecv.stop()
+        self._socket.close()
+
+        sock.setblocking(False)
+        self._socket = sock
+        self._erecv = self._eloop.io(self._socket, EV_READ,
+                                     self._recvhandler)
+
+    def _attempt(self):
+        # Start connecting to the next address. The first attempt uses
+        # the socket of the connection, the others get a socket and
+        # a watcher of their own.
+        # An address connect_ex() rejects, like a malformed tuple, fails
+        # the attempt like an unreachable one.
+        address = self._addresses.pop(0)
+        sock = None
         try:
-            self._socket.settimeout(timeout)
-            self._socket.connect(address)
-            self._socket.settimeout(None)
-            self._erecv.start()
-            self._active = True
-            self._dispatchconnected()
-        except socket.error as e:
-            self._dispatcherror(e)
+            if not self._socketused:
+                self._socketused = True
+                sock = self._socket
+                watcher = self._sendwatcher()
+            else:
+                sock = socket.socket(self.family, self.type, self.proto)
+                sock.setblocking(False)
+                watcher = self._eloop.io(sock, EV_WRITE,
+                                         self._connecthandler)
+            err = sock.connect_ex(address)
+        except Exception as e:
+            if sock is not None and sock is not self._socket:
+                sock.close()
+            if self._addresses:
+                self._attempt()
+            elif not self._attempts:
+                self._connectfailed(e)
+            return
+
+        attempt = (sock, watcher)
+        self._attempts.append(attempt)
+
+        if err == 0:
+            self._connected(attempt)
+        elif err in _INPROGRESS:
+            watcher.start()
+            if self._addresses:
+                self._enext.stop()
+                self._enext.set(self._connectdelay, 0)
+                self._enext.start()
+        else:
+            self._failed(attempt, OSError(err, os.strerror(err)))
+
+    def _connected(self, attempt):
+        # An attempt succeeded, give up on the others and use its socket
+        self._stopconnecting(attempt)
+
+        sock, watcher = attempt
+        watcher.stop()
+        if sock is not self._socket:
+            self._adopt(sock)
+
+        # Open connections hold the loop for send_threadsafe()
+        self._eloop.hold()
+        self._active = True
+        self._updatereading()
+        self._dispatchconnected()
+
+        # Send whatever was queued while connecting
+        if self._active and self._sendbuf:
+            BaseConnection._sendhandler(self, None, None)
+
+    def _failed(self, attempt, error):
+        # An attempt failed, try the next address right away instead
+        # of waiting for the delay.
+        sock, watcher = attempt
+        watcher.stop()
+        self._attempts.remove(attempt)
+        if sock is not self._socket:
+            sock.close()
+
+        if self._addresses:
+            self._attempt()
+        elif not self._attempts:
+            self._connectfailed(error)
+
+    def _connectfailed(self, error):
+        # Every attempt failed or timed out. A socket which has
+        # failed to connect can not be connected again, so replace it
+        # to let the connection try once more.
+        self._stopconnecting()
+        self._adopt(socket.socket(self.family, self.type, self.proto))
+        self._dispatcherror(error)
+
+    def _stopconnecting(self, keep=None):
+        # Stop every attempt but keep, and the connect timers
+        for attempt in self._attempts:
+            if attempt is keep:
+                continue
+            sock, watcher = attempt
+            watcher.stop()
+            if sock is not self._socket:
+                sock.close()
+
+        self._attempts = []
+        self._addresses = []
+        self._resolving = None
+
+        for timer in (self._econnect, self._enext):
+            if timer is not None:
+                timer.stop()
+        self._econnect = None
+        self._enext = None
+
+    def _sortaddresses(self, infos):
+        # Returns the addresses of getaddrinfo() results, in the order
+        # they are to be tried.
+        addresses = []
+        for family, type, proto, canonname, address in infos:
+            if address not in addresses:
+                addresses.append(address)
+        return addresses
+
+    def _resolve(self, host, port, family, timeout):
+        # Connect to every address host resolves to. Names are looked
+        # up by a resolver thread, the lookup counting towards the
+        # timeout, while addresses are used right away.
+        if self._sendbuf is None:
+            raise ValueError('connect on a closed connection')
+        if self._active or self._attempts or self._resolving is not None:
+            self._dispatcherror(socket.error(errno.EISCONN,
+                                             os.strerror(errno.EISCONN)))
+            return
+
+        if _isaddress(host):
+            try:
+                infos = socket.getaddrinfo(host, port, family,
+                                           socket.SOCK_STREAM, 0,
+                                           socket.AI_NUMERICHOST)
+            except socket.gaierror as e:
+                self._dispatcherror(e)
+                return
+            self._connect(self._sortaddresses(infos), timeout)
+            return
+
+        if timeout is not None:
+            self._econnect = self._eloop.timer(timeout, 0,
+                                               self._connecttimeouthandler)
+            self._econnect.start()
+
+        self._resolving = resolving = object()
+        self._eloop.getaddrinfo(functools.partial(self._resolved, resolving),
+                                host, port, family, socket.SOCK_STREAM)
+
+    def _connect(self, addresses, timeout):
+        # Connect to the first of addresses to accept the connection.
+        # Attempts are started connectdelay seconds apart, each as
+        # soon as the previous one fails, and race each other until
+        # one succeeds or timeout seconds have passed, counted from
+        # the start of the lookup if there was one.
+        if self._sendbuf is None:
+            raise ValueError('connect on a closed connection')
+        if self._active or self._attempts or self._resolving is not None:
+            self._dispatcherror(socket.error(errno.EISCONN,
+                                             os.strerror(errno.EISCONN)))
+            return
+
+        self._addresses = list(addresses)
+        if not self._addresses:
+            self._stopconnecting()
+            self._dispatcherror(socket.error(errno.EADDRNOTAVAIL,
+                                             os.strerror(errno.EADDRNOTAVAIL)))
+            return
+
+        self._socketused = False
+        if timeout is not None and self._econnect is None:
+            self._econnect = self._eloop.timer(timeout, 0,
+                                               self._connecttimeouthandler)
+            self._econnect.start()
+        if len(self._addresses) > 1:
+            self._enext = self._eloop.timer(self._connectdelay, 0,
+                                            self._nexthandler)
+
+        self._attempt()
+
+#-----------------------------------------------------------------------
+# Private Event handlers and dispatchers
+#-----------------------------------------------------------------------
+
+    def _sendhandler(self, watcher, event):
+        # While connecting, the send watcher waits for the first
+        # attempt to complete instead.
+        if self._attempts:
+            if watcher is not None:
+                self._connecthandler(watcher, event)
+        else:
+            BaseConnection._sendhandler(self, watcher, event)
+
+    def _connecthandler(self, watcher, event):
+        # A connection attempt completed, successfully or not
+        for attempt in self._attempts:
+            if attempt[1] is watcher:
+                break
+        else:
+            watcher.stop()
+            return
+
+        err = attempt[0].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._failed(attempt, OSError(err, os.strerror(err)))
+        else:
+            self._connected(attempt)
+
+    def _resolved(self, resolving, infos, error):
+        # The lookup of a host name is done, unless the connection has
+        # been closed or has timed out since.
+        if resolving is not self._resolving:
+            return
+        self._resolving = None
+
+        if error is not None:
+            self._stopconnecting()
+            self._dispatcherror(error)
+        else:
+            self._connect(self._sortaddresses(infos), None)
+
+    def _nexthandler(self, watcher, event):
+        # The attempts so far are slow, start the next one alongside
+        if self._addresses:
+            self._attempt()
+
+    def _connecttimeouthandler(self, watcher, event):
+        self._connectfailed(socket.timeout('timed out'))
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def connectdelay(self):
+        """
+        Seconds to wait for a connection attempt to an address before
+        also trying the next address, when there are several.
+        """
+
+        return self._connectdelay
+
+    @connectdelay.setter
+    def connectdelay(self, seconds):
+        self._connectdelay = seconds
+
+    @property
+    def isconnecting(self):
+        """
+        Returns True while the host is looked up or connection
+        attempts are in progress
+        """
+
+        return bool(self._attempts) or self._resolving is not None
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
 
     def connect(self, address, timeout=1):
         """
-        Connects to the given address. Timeout specifies how
-        long the connection attempt should last before giving up.
+        Connects to the given address without blocking. The connected
+        event is dispatched once the connection is established, and
+        the error event if it fails or takes more than timeout seconds.
+
+        address may also be a list of addresses, which are tried in
+        parallel connectdelay seconds apart until one accepts.
         """
-        self._connect(address, timeout)
+
+        if isinstance(address, list):
+            self._connect(address, timeout)
+        else:
+            self._connect([address], timeout)
+
+    def close(self):
+        # Closed while connecting, give up on every attempt and close
+        # the socket of the first, which may still be connecting,
+        # dropping whatever was queued meanwhile.
+        if self._attempts or self._resolving is not None:
+            self._stopconnecting()
+            self._teardown()
+        else:
+            super().close()
 
 
 class PeerConnection(BaseConnection):
     """
     When a Listener socket accepts a new connection, it creates
-    a new PeerConnection object.
+    a new PeerConnection object. The peer starts reading and
+    dispatches connected once the listener has set it up and
+    registered it.
     """
 
+    __slots__ = ('_listener', '_peerid', '_peeraddress')
+
     def __init__(self, eloop, sock, connhandler):
 
         super().__init__(eloop, sock, connhandler)
 
-        self._erecv.start()
+        # The listener which accepted the peer, told when it goes,
+        # and the id and address its registry knows it by.
+        self._listener = None
+        self._peerid = None
+        self._peeraddress = None
+
+    def _start(self):
+        # Open connections hold the loop for send_threadsafe()
+        self._eloop.hold()
         self._active = True
+        self._updatereading()
         self._dispatchconnected()
+
+    def _dispatchdisconnected(self, data=None):
+        super()._dispatchdisconnected(data)
+
+        listener = self._listener
+        if listener is not None:
+            self._listener = None
+            listener._disconnecthandler(self, data)
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def peerid(self):
+        """
+        Returns the id of the peer in the registry of its listener,
+        or None if it has none.
+        """
+
+        return self._peerid
+
+    @property
+    def peeraddress(self):
+        """
+        Returns the address the peer was accepted from, or None if
+        it is not known.
+        """
+
+        return self._peeraddress
@@ -18,6 +18,10 @@
 
 class ConnectionHandler(object):
 
+    # Subclasses declaring __slots__ of their own make handlers
+    # without a __dict__, see benchmarks/memory.py
+    __slots__ = ()
+
     def connected(self, sock, data):
         """ Called when the socket is connected to a peer"""
         raise NotImplementedError
@@ -26,6 +30,13 @@ class ConnectionHandler(object):
         """ Called when new data is available from the socket """
         raise NotImplementedError
 
+    def frame(self, sock, data):
+        """
+        Called with each complete frame when the socket has a framer,
+        instead of data()
+        """
+        raise NotImplementedError
+
     def timeout(self, sock, data):
         """ Called when a timeout occured on the connection """
         raise NotImplementedError
@@ -37,3 +48,59 @@ class ConnectionHandler(object):
     def disconnected(self, sock, data):
         """ Called when the connection has been lost """
         raise NotImplementedError
+
+    def pause_writing(self, sock, data):
+        """
+        Called with the size of the sendqueue when it grows past the
+        connections writehigh, the handler should stop sending until
+        resume_writing is called
+        """
+        pass
+
+    def resume_writing(self, sock, data):
+        """ Called when the sendqueue is back down to writelow """
+        pass
+
+    def draining(self, sock, data):
+        """
+        Called with the drain timeout when the listener of the peer
+        is draining. Return True to keep the connection open and close
+        it when done, otherwise it is closed once its data is sent
+        """
+        pass
+
+
+class DatagramHandler(object):
+
+    __slots__ = ()
+
+    def connected(self, sock, data):
+        """ Called when the socket has been bound """
+        raise NotImplementedError
+
+    def datagram(self, sock, data, addr):
+        """
+        Called with every datagram received and the address it came
+        from. The data is a memoryview of a buffer reused for the next
+        datagram, copy it with bytes(data) to keep it.
+        """
+        raise NotImplementedError
+
+    def error(self, sock, data):
+        """ Called when something went wrong """
+        raise NotImplementedError
+
+    def disconnected(self, sock, data):
+        """ Called when the socket has been closed """
+        raise NotImplementedError
+
+    def pause_writing(self, sock, data):
+        """
+        Called with the number of bytes queued when the sendqueue
+        grows past writehigh
+        """
+        pass
+
+    def resume_writing(self, sock, data):
+        """ Called when the sendqueue is back down to writelow """
+        pass
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import _socket as socket
+from collections import deque
+
+import esocket.error
+from esocket.baseesocket import BaseEsocket, Handled
+from esocket.eventloop import EV_READ, EV_WRITE
+
+# The most datagrams read per readiness event before other sockets on
+# the loop get their turn.
+RECV_BUDGET = 256
+
+# The largest datagram received, larger datagrams are truncated.
+DATAGRAM_SIZE = 65535
+
+# Sendqueue sizes at which the handler is asked to pause and resume
+# sending.
+WRITE_HIGH = 262144
+WRITE_LOW = 65536
+
+class DatagramEndpoint(Handled, BaseEsocket):
+    """
+    A datagram socket, sending datagrams to and receiving them from
+    any address.
+
+    The endpoint supports the following events:
+    * Connected - Dispatched when the endpoint has been bound
+    * Disconnected - Dispatched when the endpoint has been closed
+    * Error - Dispatched when an error occured
+
+    In addition, it will call the datagramhandler object with
+    the following events:
+    * Connected, Disconnected and Error, as above
+    * Datagram - Dispatched with the data and address of every
+      datagram received
+    * Pause_writing - Dispatched when the sendqueue grows past
+      writehigh
+    * Resume_writing - Dispatched when the sendqueue is back down to
+      writelow
+    """
+
+    __slots__ = ('_handler', '_esend', '_erecv', '_recvbuf', '_recvview',
+                 '_recvbudget', '_sendqueue', '_queued', '_reuseport',
+                 '_writehigh', '_writelow', '_writepaused')
+
+    def __init__(self, eloop, family, type, proto, handler):
+
+        super().__init__(eloop, socket.socket(family, type, proto))
+        self._handler = handler
+
+        self._esend = self._eloop.io(self._socket, EV_WRITE,
+                                     self._sendhandler)
+        self._erecv = self._eloop.io(self._socket, EV_READ,
+                                     self._recvhandler)
+
+        # Every datagram is received into the same buffer, borrowed
+        # from the loops BufferPool if it has one, and datagrams
+        # waiting to be sent are queued with their address.
+        pool = self._eloop.bufferpool
+        if pool is None:
+            self._recvbuf = bytearray(DATAGRAM_SIZE)
+        else:
+            self._recvbuf = pool.acquire(DATAGRAM_SIZE)
+        self._recvview = memoryview(self._recvbuf)
+        self._recvbudget = RECV_BUDGET
+        self._sendqueue = deque()
+        self._queued = 0
+
+        self._reuseport = False
+        self._writehigh = WRITE_HIGH
+        self._writelow = WRITE_LOW
+        self._writepaused = False
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _bind(self, address):
+        if self._reuseport:
+            self._socket.setsockopt(socket.SOL_SOCKET,
+                                    socket.SO_REUSEPORT, 1)
+        self._socket.bind(address)
+        self._erecv.start()
+        self._active = True
+
+        self._dispatchconnected()
+
+#-----------------------------------------------------------------------
+# Private Event handlers and dispatchers
+#-----------------------------------------------------------------------
+
+    def _recvhandler(self, watcher, event):
+        # Read datagrams until the socket is drained or the budget is
+        # spent, dispatching each one as it is read. Python has no
+        # recvmmsg(), but draining many datagrams per readiness event
+        # spreads the cost of the event over all of them.
+        view = self._recvview
+        received = 0
+        count = 0
+        again = False
+
+        try:
+            while count < self._recvbudget and self._active:
+                try:
+                    size, address = self._socket.recvfrom_into(view)
+                except (BlockingIOError, InterruptedError):
+                    again = True
+                    break
+                except socket.error as e:
+                    # Errors like ECONNREFUSED belong to an earlier
+                    # datagram, not to the endpoint.
+                    count += 1
+                    self._dispatcherror(e)
+                    continue
+
+                count += 1
+                received += size
+                self._dispatchdatagram(view[:size], address)
+        finally:
+            m = self._metrics
+            if m is not None:
+                m.recvcalls += count + again
+                m.bytesin += received
+                if again:
+                    m.eagain += 1
+
+    def _sendhandler(self, watcher, event):
+        # Send queued datagrams until the socket is full
+        queue = self._sendqueue
+        m = self._metrics
+
+        while queue:
+            data, address = queue[0]
+            try:
+                self._socket.sendto(data, address)
+            except (BlockingIOError, InterruptedError):
+                if m is not None:
+                    m.eagain += 1
+                break
+            except socket.error as e:
+                # The datagram can not be sent, drop it
+                self._dispatcherror(e)
+            else:
+                if m is not None:
+                    m.sendcalls += 1
+                    m.bytesout += len(data)
+
+            queue.popleft()
+            self._queued -= len(data)
+            if not self._active:
+                return
+
+        if not queue:
+            self._esend.stop()
+
+        if self._writepaused and self._queued <= self._writelow:
+            self._writepaused = False
+            self._dispatchresumewriting(self._queued)
+
+    def _dispatchconnected(self, data=None):
+        self._ecall('connected', data)
+        self._hcall('connected', data)
+
+    def _dispatcherror(self, data=None):
+        self._hcall('error', data)
+        self._ecall('error', data)
+
+    def _dispatchdisconnected(self, data=None):
+        self._hcall('disconnected', data)
+        self._handler = None
+
+        self._ecall('disconnected', data)
+        self._data = None
+
+    def _dispatchdatagram(self, data, address):
+        self._hcall('datagram', data, address)
+
+    def _dispatchpausewriting(self, data=None):
+        self._hcall('pause_writing', data)
+
+    def _dispatchresumewriting(self, data=None):
+        self._hcall('resume_writing', data)
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def recvbudget(self):
+        """
+        The most datagrams read per readiness event. When the budget
+        is spent, the rest are read on the next loop iteration so
+        other sockets get their turn.
+        """
+
+        return self._recvbudget
+
+    @recvbudget.setter
+    def recvbudget(self, count):
+        self._recvbudget = count
+
+    @property
+    def reuseport(self):
+        """
+        When True, SO_REUSEPORT is set before binding, so several
+        endpoints can bind the same address and have the kernel
+        spread the datagrams between them. Must be set before the
+        endpoint is bound.
+        """
+
+        return self._reuseport
+
+    @reuseport.setter
+    def reuseport(self, reuse):
+        self._reuseport = reuse
+
+    @property
+    def queued(self):
+        """ Returns the number of bytes waiting to be sent """
+        return self._queued
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def sendto(self, data, address):
+        """
+        Send data as one datagram to address. The datagram is sent
+        right away if the socket accepts it, and queued otherwise.
+        A datagram which would take the queue past maxsend is dropped
+        with a SendOverflowError.
+
+        Queued data is kept by reference, so a mutable buffer must
+        not be changed after it has been passed to sendto().
+        """
+
+        if not self._sendqueue:
+            try:
+                self._socket.sendto(data, address)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except socket.error as e:
+                self._dispatcherror(e)
+                return
+            else:
+                m = self._metrics
+                if m is not None:
+                    m.sendcalls += 1
+                    m.bytesout += len(data)
+                return
+
+        size = len(data)
+        if self._queued + size > self._maxsend:
+            self._dispatcherror(esocket.error.SendOverflowError())
+            return
+
+        self._sendqueue.append((data, address))
+        self._queued += size
+        self._esend.start()
+
+        m = self._metrics
+        if m is not None and self._queued > m.queuehigh:
+            m.queuehigh = self._queued
+
+        if not self._writepaused and self._writehigh is not None and \
+                self._queued > self._writehigh:
+            self._writepaused = True
+            self._dispatchpausewriting(self._queued)
+
+    def close(self):
+        if self._active:
+            self._esend.stop()
+            self._erecv.stop()
+            self._esend = None
+            self._erecv = None
+
+            self._close()
+
+            self._sendqueue.clear()
+            self._queued = 0
+            self._active = False
+
+            pool = self._eloop.bufferpool
+            if pool is not None:
+                self._recvview.release()
+                pool.release(self._recvbuf)
+                self._recvbuf = self._recvview = None
+            self._dispatchdisconnected()
@@ -26,3 +26,20 @@ class ReceiveOverflowError(OverflowError):
 
 class SendOverflowError(OverflowError):
     pass
+
+class FrameError(ESocketError):
+    pass
+
+class ShortFileError(ESocketError, EOFError):
+
+    def __init__(self, missing):
+        super().__init__('file ended {} bytes before the end of its '
+                         'segment'.format(missing))
+        self.missing = missing
+
+class IncompleteReadError(ESocketError, EOFError):
+
+    def __init__(self, partial):
+        super().__init__('connection closed with {} bytes of an '
+                         'incomplete read'.format(len(partial)))
+        self.partial = partial
@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Event loop backends for esocket.
+
+    An esocket may be created with either a pyev loop or an asyncio
+    loop (including uvloop). The loop is wrapped in an EventLoop,
+    which creates watchers with the pyev watcher interface: start(),
+    stop(), the active and data attributes, and a callback that is
+    called with the watcher and the events that occured.
+"""
+
+import os
+import weakref
+import threading
+import traceback
+import _socket as socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from esocket.bufferpool import BufferPool
+from esocket.timerwheel import TimerWheel
+
+try:
+    import pyev
+except ImportError:
+    pyev = None
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+# Event masks for io watchers, the same values on every backend.
+if pyev is not None:
+    EV_READ = pyev.EV_READ
+    EV_WRITE = pyev.EV_WRITE
+else:
+    EV_READ = 1
+    EV_WRITE = 2
+
+# Threads resolving host names, shared by every loop
+RESOLVER_THREADS = 4
+
+_resolver = None
+_resolverlock = threading.Lock()
+
+def _resetresolver():
+    # A forked child has none of the resolver threads of its parent,
+    # so it makes a pool of its own on first use.
+    global _resolver, _resolverlock
+    _resolver = None
+    _resolverlock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_resetresolver)
+
+# EventLoop wrappers for the loops seen so far, so every esocket on a
+# loop shares the same wrapper for as long as it is in use. Loops are
+# looked up by id, as pyev loops can not be weakly referenced, which
+# stays valid while the wrapper keeps its loop alive.
+_loops = weakref.WeakValueDictionary()
+
+def wrap(eloop):
+    """
+    Returns the EventLoop wrapping eloop, which may be a pyev loop,
+    an asyncio loop or an EventLoop. The wrapper is freed with the
+    last esocket on the loop, so keep a reference to it when its
+    settings, like the profiler, should outlive them.
+    """
+
+    if isinstance(eloop, EventLoop):
+        return eloop
+
+    wrapper = _loops.get(id(eloop))
+    if wrapper is None or wrapper._loop is not eloop:
+        if pyev is not None and isinstance(eloop, pyev.Loop):
+            wrapper = PyevLoop(eloop)
+        elif asyncio is not None and \
+                isinstance(eloop, asyncio.AbstractEventLoop):
+            wrapper = AsyncioLoop(eloop)
+        else:
+            raise TypeError('unsupported event loop: {!r}'.format(eloop))
+        _loops[id(eloop)] = wrapper
+
+    return wrapper
+
+def _getaddrinfo(eloop, callback, host, port, family, type):
+    # Runs in a resolver thread, hands the result to the loop
+    try:
+        infos = socket.getaddrinfo(host, port, family, type)
+    except OSError as e:
+        eloop.call_soon_threadsafe(eloop._resolved, callback, None, e)
+    else:
+        eloop.call_soon_threadsafe(eloop._resolved, callback, infos, None)
+
+
+class EventLoop(object):
+    """
+    Abstract event loop wrapper, creating watchers on the wrapped
+    loop.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._timerwheel = None
+        self._profiler = None
+        self._bufferpool = None
+
+        # Calls made from other threads, run by a single wakeup of the
+        # loop. The wakeup watcher is only active while the loop is
+        # held, so a loop which never uses threads still returns once
+        # its other watchers are done. The lock keeps calls from being
+        # queued once the last hold has been released.
+        self._calls = deque()
+        self._callslock = threading.Lock()
+        self._callswoken = False
+        self._ecalls = None
+        self._holds = 0
+
+        # Calls deferred to the end of the loop iteration
+        self._deferred = []
+        self._edeferred = self.prepare(self._deferredhandler)
+
+    def _callshandler(self, watcher, event):
+        # Clear the flag before draining, so a call queued after the
+        # drain has started wakes the loop again.
+        with self._callslock:
+            self._callswoken = False
+        calls = self._calls
+
+        for i in range(len(calls)):
+            callback, args = calls.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def _resolved(self, callback, infos, error):
+        self.release()
+        callback(infos, error)
+
+    @property
+    def loop(self):
+        """ Returns the wrapped loop """
+        return self._loop
+
+    @property
+    def timerwheel(self):
+        """
+        Returns the TimerWheel shared by the connection timeouts on
+        this loop.
+        """
+
+        if self._timerwheel is None:
+            self._timerwheel = TimerWheel(self)
+        return self._timerwheel
+
+    @property
+    def profiler(self):
+        """
+        A Profiler from esocket.profiling, timing every callback
+        dispatched by the esockets on this loop. None (default)
+        disables profiling.
+        """
+
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler):
+        if self._profiler is not None:
+            self._profiler.stop()
+        self._profiler = profiler
+        if profiler is not None:
+            profiler.start()
+
+    @property
+    def bufferpool(self):
+        """
+        A BufferPool from esocket.bufferpool, lending receivebuffer
+        storage to the connections on this loop. Set to True for a
+        pool with the default settings, or to None (default) for
+        connections to allocate their own. Connections use the pool
+        set when they were created.
+        """
+
+        return self._bufferpool
+
+    @bufferpool.setter
+    def bufferpool(self, pool):
+        if pool is True:
+            pool = BufferPool()
+        elif not pool:
+            pool = None
+        self._bufferpool = pool
+
+    def _deferredhandler(self, watcher, event):
+        # Calls deferred while running these are run at the end of
+        # the next iteration.
+        deferred = self._deferred
+        self._deferred = []
+        self._edeferred.stop()
+
+        for callback, args in deferred:
+            try:
+                callback(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def defer(self, callback, *args):
+        """
+        Call callback(*args) at the end of the current loop iteration,
+        once the events of the iteration have been handled and before
+        the loop waits for more.
+        """
+
+        if not self._deferred:
+            self._edeferred.start()
+        self._deferred.append((callback, args))
+
+    def hold(self):
+        """
+        Keep the loop running the calls made with call_soon_threadsafe()
+        until release() has been called as many times. Open
+        connections and host name lookups hold the loop themselves.
+        Must be called on the loop thread.
+        """
+
+        with self._callslock:
+            self._holds += 1
+            if self._holds == 1:
+                if self._ecalls is None:
+                    self._ecalls = self.wakeup(self._callshandler)
+                self._ecalls.start()
+
+    def release(self):
+        """
+        Undo a hold(), see hold(). Calls queued before the last hold is
+        released still run, at the end of the loop iteration.
+        """
+
+        with self._callslock:
+            self._holds -= 1
+            if self._holds:
+                return
+            self._ecalls.stop()
+            pending = self._callswoken
+
+        if pending:
+            self.defer(self._callshandler, None, None)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Call callback(*args) on the loop, from any thread. Calls are
+        run in the order they were made, and the loop is only woken
+        once for all the calls made before it gets to them.
+
+        The loop has to be held, see hold(), or nothing would wake it
+        for the call. Raises RuntimeError if it is not.
+        """
+
+        with self._callslock:
+            if not self._holds:
+                raise RuntimeError('call_soon_threadsafe() on a loop '
+                                   'which is not held')
+            self._calls.append((callback, args))
+            if not self._callswoken:
+                self._callswoken = True
+                self._ecalls.send()
+
+    def getaddrinfo(self, callback, host, port, family=0, type=0):
+        """
+        Resolve host and port with getaddrinfo() in a resolver thread,
+        so a slow lookup does not hold up the loop, and call
+        callback(infos, None) on the loop with the result, or
+        callback(None, error) if the lookup failed.
+        """
+
+        global _resolver
+        self.hold()
+        if _resolver is None:
+            with _resolverlock:
+                if _resolver is None:
+                    _resolver = ThreadPoolExecutor(RESOLVER_THREADS,
+                                                   'esocket-resolver')
+
+        _resolver.submit(_getaddrinfo, self, callback, host, port,
+                         family, type)
+
+    def now(self):
+        """ Returns the current loop time in seconds """
+        raise NotImplementedError
+
+    def run(self):
+        """ Runs the loop until stop() is called """
+        raise NotImplementedError
+
+    def stop(self):
+        """ Makes run() return """
+        raise NotImplementedError
+
+    def io(self, fd, events, callback, data=None):
+        """
+        Returns a watcher calling callback when fd is ready for the
+        given events, EV_READ and/or EV_WRITE.
+        """
+        raise NotImplementedError
+
+    def timer(self, after, repeat, callback, data=None):
+        """
+        Returns a watcher calling callback after <after> seconds, and
+        then every <repeat> seconds unless repeat is 0.
+        """
+        raise NotImplementedError
+
+    def idle(self, callback, data=None):
+        """
+        Returns a watcher calling callback on every loop iteration.
+        """
+        raise NotImplementedError
+
+    def prepare(self, callback, data=None):
+        """
+        Returns a watcher calling callback on every loop iteration,
+        before the loop waits for events.
+        """
+        raise NotImplementedError
+
+    def check(self, callback, data=None):
+        """
+        Returns a watcher calling callback on every loop iteration,
+        after the loop has waited for events.
+        """
+        raise NotImplementedError
+
+    def signal(self, signum, callback, data=None):
+        """
+        Returns a watcher calling callback when the process receives
+        the signal signum.
+        """
+        raise NotImplementedError
+
+    def wakeup(self, callback, data=None):
+        """
+        Returns an async watcher calling callback on the loop after
+        its send() method has been called, which may be done from any
+        thread. Several sends before the callback runs are merged
+        into one call.
+        """
+        raise NotImplementedError
+
+    def future(self):
+        """
+        Returns a future bound to the loop, for use by coroutines.
+        """
+        raise NotImplementedError('coroutines require an asyncio loop')
+
+
+class PyevLoop(EventLoop):
+    """
+    EventLoop for pyev loops, the watchers are plain pyev watchers.
+    """
+
+    def now(self):
+        return self._loop.now()
+
+    def run(self):
+        self._loop.loop()
+
+    def stop(self):
+        self._loop.unloop()
+
+    def io(self, fd, events, callback, data=None):
+        return pyev.Io(fd, events, self._loop, callback, data)
+
+    def timer(self, after, repeat, callback, data=None):
+        return pyev.Timer(after, repeat, self._loop, callback, data)
+
+    def idle(self, callback, data=None):
+        return pyev.Idle(self._loop, callback, data)
+
+    def prepare(self, callback, data=None):
+        return pyev.Prepare(self._loop, callback, data)
+
+    def check(self, callback, data=None):
+        return pyev.Check(self._loop, callback, data)
+
+    def signal(self, signum, callback, data=None):
+        return pyev.Signal(signum, self._loop, callback, data)
+
+    def wakeup(self, callback, data=None):
+        return pyev.Async(self._loop, callback, data)
+
+
+class AsyncioLoop(EventLoop):
+    """
+    EventLoop for asyncio loops, the watchers are built on
+    add_reader(), add_writer() and call_later().
+    """
+
+    def now(self):
+        return self._loop.time()
+
+    def run(self):
+        self._loop.run_forever()
+
+    def stop(self):
+        self._loop.stop()
+
+    def io(self, fd, events, callback, data=None):
+        return AsyncioIo(self._loop, fd, events, callback, data)
+
+    def timer(self, after, repeat, callback, data=None):
+        return AsyncioTimer(self._loop, after, repeat, callback, data)
+
+    def idle(self, callback, data=None):
+        return AsyncioIdle(self._loop, callback, data)
+
+    def prepare(self, callback, data=None):
+        return AsyncioPrepare(self._loop, callback, data)
+
+    def check(self, callback, data=None):
+        return AsyncioCheck(self._loop, callback, data)
+
+    def signal(self, signum, callback, data=None):
+        return AsyncioSignal(self._loop, signum, callback, data)
+
+    def wakeup(self, callback, data=None):
+        return AsyncioWakeup(self._loop, callback, data)
+
+    def future(self):
+        return self._loop.create_future()
+
+
+class AsyncioWatcher(object):
+
+    __slots__ = ('_loop', '_active', 'callback', 'data')
+
+    def __init__(self, loop, callback, data):
+        self._loop = loop
+        self._active = False
+        self.callback = callback
+        self.data = data
+
+    @property
+    def active(self):
+        return self._active
+
+
+class AsyncioIo(AsyncioWatcher):
+
+    __slots__ = ('_fd', '_events')
+
+    def __init__(self, loop, fd, events, callback, data=None):
+        super().__init__(loop, callback, data)
+        self._fd = fd
+        self._events = events
+
+    def _ready(self, events):
+        self.callback(self, events)
+
+    def set(self, fd, events):
+        active = self._active
+        self.stop()
+        self._fd = fd
+        self._events = events
+        if active:
+            self.start()
+
+    def start(self):
+        if not self._active:
+            if self._events & EV_READ:
+                self._loop.add_reader(self._fd, self._ready, EV_READ)
+            if self._events & EV_WRITE:
+                self._loop.add_writer(self._fd, self._ready, EV_WRITE)
+            self._active = True
+
+    def stop(self):
+        if self._active:
+            if self._events & EV_READ:
+                self._loop.remove_reader(self._fd)
+            if self._events & EV_WRITE:
+                self._loop.remove_writer(self._fd)
+            self._active = False
+
+
+class AsyncioTimer(AsyncioWatcher):
+
+    __slots__ = ('_after', 'repeat', '_handle')
+
+    def __init__(self, loop, after, repeat, callback, data=None):
+        super().__init__(loop, callback, data)
+        self._after = after
+        self.repeat = repeat
+        self._handle = None
+
+    def _schedule(self, delay):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self._loop.call_later(delay, self._expired)
+        self._active = True
+
+    def _expired(self):
+        if self.repeat:
+            self._schedule(self.repeat)
+        else:
+            self._handle = None
+            self._active = False
+        self.callback(self, 0)
+
+    def set(self, after, repeat):
+        self._after = after
+        self.repeat = repeat
+
+    def start(self):
+        if not self._active:
+            self._schedule(self._after)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._active = False
+
+    def again(self):
+        if self.repeat:
+            self._schedule(self.repeat)
+        else:
+            self.stop()
+
+
+class AsyncioIdle(AsyncioWatcher):
+
+    __slots__ = ('_handle',)
+
+    def __init__(self, loop, callback, data=None):
+        super().__init__(loop, callback, data)
+        self._handle = None
+
+    def _idle(self):
+        self._handle = self._loop.call_soon(self._idle)
+        self.callback(self, 0)
+
+    def start(self):
+        if not self._active:
+            self._handle = self._loop.call_soon(self._idle)
+            self._active = True
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._active = False
+
+
+class AsyncioPrepare(AsyncioIdle):
+    # asyncio has no hook around its poll. Callbacks scheduled with
+    # call_soon() run after the events of the current iteration, and
+    # keep the loop from blocking while the watcher is active.
+    __slots__ = ()
+
+
+class AsyncioCheck(AsyncioIdle):
+    __slots__ = ()
+
+
+class AsyncioSignal(AsyncioWatcher):
+
+    __slots__ = ('_signum',)
+
+    def __init__(self, loop, signum, callback, data=None):
+        super().__init__(loop, callback, data)
+        self._signum = signum
+
+    def _signalled(self):
+        self.callback(self, 0)
+
+    def start(self):
+        if not self._active:
+            self._loop.add_signal_handler(self._signum, self._signalled)
+            self._active = True
+
+    def stop(self):
+        if self._active:
+            self._loop.remove_signal_handler(self._signum)
+            self._active = False
+
+
+class AsyncioWakeup(AsyncioWatcher):
+
+    __slots__ = ('_pending',)
+
+    def __init__(self, loop, callback, data=None):
+        super().__init__(loop, callback, data)
+        self._pending = False
+
+    def _woken(self):
+        self._pending = False
+        if self._active:
+            self.callback(self, 0)
+
+    def send(self):
+        # Called from any thread, only the first send before the
+        # callback runs schedules it.
+        if not self._pending:
+            self._pending = True
+            try:
+                self._loop.call_soon_threadsafe(self._woken)
+            except RuntimeError:
+                # The loop has been closed
+                self._pending = False
+
+    def start(self):
+        self._active = True
+
+    def stop(self):
+        self._active = False
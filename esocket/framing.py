@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Message framing for esocket connections.
+
+    When a connection has a framer, the framer cuts the receivebuffer
+    into frames and the connection dispatches the 'frame' event to its
+    ConnectionHandler once for every complete frame, instead of the
+    'data' event. Frames are cut one at a time, so whatever is left
+    when a handler closes the connection stays in the receivebuffer.
+
+    A framer keeps state about the receivebuffer between data events,
+    so every connection needs a framer of its own. A listener gives
+    each of its peers a copy of its own framer.
+"""
+
+import copy
+from collections import deque
+
+import esocket.error
+
+class Framer(object):
+    """
+    Abstract framer.
+    """
+
+    def frame(self, recvbuf):
+        """
+        Remove the next complete frame from recvbuf, a ReceiveBuffer,
+        and return it as a bytes object, or None if there is no
+        complete frame. Raises FrameError if the data can not be
+        framed.
+        """
+        raise NotImplementedError
+
+    def frames(self, recvbuf):
+        """
+        Remove every complete frame from recvbuf and return them as
+        a list of bytes objects.
+        """
+
+        frames = []
+        while True:
+            frame = self.frame(recvbuf)
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def reset(self):
+        """
+        Forget any state kept about the receivebuffer, called when
+        data has been removed from it by others.
+        """
+        pass
+
+    def packet(self, size, fds=None):
+        """
+        Called with the size of every packet added to the
+        receivebuffer of a packet socket, like SOCK_SEQPACKET, and
+        the file descriptors which came with it, if any.
+        """
+        pass
+
+    def copy(self):
+        """
+        Returns a new framer with the same settings.
+        """
+
+        framer = copy.copy(self)
+        framer.reset()
+        return framer
+
+
+class DelimiterFramer(Framer):
+    """
+    Frames ending with a terminator, like lines ending with b'\\n'.
+
+    The framer remembers how far it has searched, so data which
+    arrives in many pieces is only searched once. When strip is True,
+    the terminator is removed from the frames. A frame larger than
+    maxsize raises FrameError.
+    """
+
+    def __init__(self, term=b'\n', strip=False, maxsize=None):
+        if not term:
+            raise ValueError('empty terminator')
+
+        self._term = bytes(term)
+        self._strip = strip
+        self._maxsize = maxsize
+        self._scanned = 0
+
+    def frame(self, recvbuf):
+        termsize = len(self._term)
+
+        index = recvbuf.find(self._term, self._scanned)
+        if index < 0:
+            # Next time, only search the data not searched yet, keeping
+            # enough of the end for a terminator split between reads.
+            self._scanned = max(0, len(recvbuf) - termsize + 1)
+
+            if self._maxsize is not None and len(recvbuf) > self._maxsize:
+                raise esocket.error.FrameError(
+                    'no terminator in {} bytes'.format(len(recvbuf)))
+            return None
+
+        end = index + termsize
+        if self._maxsize is not None and end > self._maxsize:
+            raise esocket.error.FrameError(
+                'frame of {} bytes exceeds {}'.format(end, self._maxsize))
+
+        self._scanned = 0
+        if self._strip:
+            frame = recvbuf.read(index)
+            recvbuf.skip(termsize)
+            return frame
+        return recvbuf.read(end)
+
+    def reset(self):
+        self._scanned = 0
+
+
+class LengthPrefixFramer(Framer):
+    """
+    Frames preceded by their length as an unsigned integer of size
+    bytes, in big (network) or little endian byteorder.
+
+    The prefix is removed from the frames unless prefix is True. A
+    frame larger than maxsize raises FrameError.
+    """
+
+    def __init__(self, size=4, byteorder='big', prefix=False, maxsize=None):
+        if byteorder not in ('big', 'little'):
+            raise ValueError('byteorder must be big or little')
+
+        self._size = size
+        self._byteorder = byteorder
+        self._prefix = prefix
+        self._maxsize = maxsize
+        self._length = None
+
+    def frame(self, recvbuf):
+        if self._length is None:
+            if len(recvbuf) < self._size:
+                return None
+
+            with recvbuf.peek(self._size) as view:
+                length = int.from_bytes(view, self._byteorder)
+
+            if self._maxsize is not None and length > self._maxsize:
+                raise esocket.error.FrameError(
+                    'frame of {} bytes exceeds {}'.format(length,
+                                                          self._maxsize))
+            self._length = length
+
+        if len(recvbuf) < self._size + self._length:
+            return None
+
+        length = self._length
+        self._length = None
+        if self._prefix:
+            return recvbuf.read(self._size + length)
+        recvbuf.skip(self._size)
+        return recvbuf.read(length)
+
+    def reset(self):
+        self._length = None
+
+
+class FixedSizeFramer(Framer):
+    """
+    Frames of a fixed number of bytes.
+    """
+
+    def __init__(self, size):
+        if size <= 0:
+            raise ValueError('frame size must be positive')
+
+        self._size = size
+
+    def frame(self, recvbuf):
+        if len(recvbuf) < self._size:
+            return None
+        return recvbuf.read(self._size)
+
+
+class PacketFramer(Framer):
+    """
+    Frames which are the packets of a packet socket, like a
+    SOCK_SEQPACKET Unix socket, keeping the boundaries the socket
+    received them with. It is the default framer of such sockets.
+
+    File descriptors passed with a packet are kept with it, and handed
+    out by takefds() once its frame has been cut.
+    """
+
+    def __init__(self):
+        # The size and descriptors of every packet not cut yet, and
+        # the descriptors of the frames cut but not taken.
+        self._sizes = deque()
+        self._fds = None
+
+    def frame(self, recvbuf):
+        if not self._sizes or len(recvbuf) < self._sizes[0][0]:
+            return None
+
+        size, fds = self._sizes.popleft()
+        if fds:
+            if self._fds is None:
+                self._fds = []
+            self._fds.extend(fds)
+        return recvbuf.read(size)
+
+    def packet(self, size, fds=None):
+        self._sizes.append((size, fds))
+
+    def takefds(self):
+        """
+        Returns a list of the file descriptors of the frames cut so
+        far, the last one included, and forgets them.
+        """
+
+        fds = self._fds or []
+        self._fds = None
+        return fds
+
+    def reset(self):
+        # The boundaries are lost, but not the descriptors
+        for size, fds in self._sizes:
+            if fds:
+                if self._fds is None:
+                    self._fds = []
+                self._fds.extend(fds)
+        self._sizes = deque()
+
+    def copy(self):
+        return PacketFramer()
@@ -20,11 +20,14 @@ import sys
 import _socket as socket
 
 from esocket.connection import Connection
+from esocket.datagram import DatagramEndpoint
 from esocket.listener import Listener
 
 
 class TCPConnection(Connection):
 
+    __slots__ = ()
+
     def __init__(self, eloop, connhandler, events=None):
 
         super().__init__(eloop, socket.AF_INET, socket.SOCK_STREAM, 0,
@@ -42,17 +45,25 @@ class TCPConnection(Connection):
             except:
                 raise ValueError
 
-    def connect(self, host=socket.INADDR_ANY, port=0, timeout=1):
+    def connect(self, host='127.0.0.1', port=0, timeout=1):
 
         # Support the same conventions as the normal py-socket
         if host == '<broadcast>':
-            host = socket.INADDR_BROADCAST
+            host = '255.255.255.255'
 
-        self._connect((host, port), timeout)
+        if not isinstance(host, str):
+            self._connect([(host, port)], timeout)
+            return
+
+        # Every address the host resolves to is tried, so a host with
+        # an unreachable address still connects through the others.
+        self._resolve(host, port, socket.AF_INET, timeout)
 
 
 class TCPListener(Listener):
 
+    __slots__ = ()
+
     def __init__(self, eloop, handlercls, events=None):
 
         super().__init__(eloop, socket.AF_INET, socket.SOCK_STREAM, 0,
@@ -77,3 +88,38 @@ class TCPListener(Listener):
             host = socket.INADDR_BROADCAST
 
         self._listen((host, port), backlog)
+
+
+class UDPEndpoint(DatagramEndpoint):
+
+    __slots__ = ()
+
+    def __init__(self, eloop, handler, events=None):
+
+        super().__init__(eloop, socket.AF_INET, socket.SOCK_DGRAM, 0,
+                         handler)
+
+        if events is not None:
+            try:
+                for e, f in events.items():
+                    if e == 'onconnected':
+                        self.onconnected = f
+                    elif e == 'ondisconnected':
+                        self.ondisconnected = f
+                    elif e == 'onerror':
+                        self.onerror = f
+            except:
+                raise ValueError
+
+    def bind(self, host='', port=0):
+        """
+        Bind the endpoint to host and port and start receiving.
+        """
+
+        if host == '<broadcast>':
+            host = '255.255.255.255'
+
+        try:
+            self._bind((host, port))
+        except socket.error as e:
+            self._dispatcherror(e)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+    IPv6 transports.
+
+    Listeners and endpoints are dual-stack by default: with v6only
+    False they also take IPv4 peers, which show up with IPv4-mapped
+    addresses like '::ffff:192.0.2.1'. Connections resolve both
+    families and race the addresses, reaching IPv4 hosts through
+    mapped addresses.
+"""
+
+import _socket as socket
+
+from esocket.connection import Connection
+from esocket.datagram import DatagramEndpoint
+from esocket.listener import Listener
+
+def _mapped(address):
+    # The address of an IPv6 socket to reach address with
+    if len(address) == 2:
+        return ('::ffff:' + address[0], address[1], 0, 0)
+    return address
+
+def _v6only(sock, v6only):
+    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, int(v6only))
+
+
+class TCPConnection(Connection):
+
+    __slots__ = ()
+
+    def __init__(self, eloop, connhandler, events=None):
+
+        super().__init__(eloop, socket.AF_INET6, socket.SOCK_STREAM, 0,
+                         connhandler)
+
+        if events is not None:
+            try:
+                for e, f in events.items():
+                    if e == 'onconnected':
+                        self.onconnected = f
+                    elif e == 'ondisconnected':
+                        self.ondisconnected = f
+                    elif e == 'onerror':
+                        self.onerror = f
+            except:
+                raise ValueError
+
+    def _sortaddresses(self, infos):
+        # Every address of either family is tried, alternating between
+        # the families so a broken IPv6 route does not hold up IPv4.
+        families = {socket.AF_INET6: [], socket.AF_INET: []}
+        for family, type, proto, canonname, address in infos:
+            addresses = families.get(family)
+            address = _mapped(address)
+            if addresses is not None and address not in addresses:
+                addresses.append(address)
+
+        addresses = []
+        v6, v4 = families[socket.AF_INET6], families[socket.AF_INET]
+        for i in range(max(len(v6), len(v4))):
+            addresses.extend(v6[i:i+1])
+            addresses.extend(v4[i:i+1])
+        return addresses
+
+    def connect(self, host='::1', port=0, timeout=1):
+        self._resolve(host, port, socket.AF_UNSPEC, timeout)
+
+
+class TCPListener(Listener):
+
+    __slots__ = ('_v6only',)
+
+    def __init__(self, eloop, handlercls, events=None):
+
+        super().__init__(eloop, socket.AF_INET6, socket.SOCK_STREAM, 0,
+                         handlercls)
+
+        self._v6only = False
+
+        if events is not None:
+            try:
+                for e, f in events.items():
+                    if e == 'onconnected':
+                        self.onconnected = f
+                    elif e == 'ondisconnected':
+                        self.ondisconnected = f
+                    elif e == 'onerror':
+                        self.onerror = f
+                    elif e == 'onpeer':
+                        self.onpeer = f
+            except:
+                raise ValueError
+
+    def _listen(self, address, backlog):
+        _v6only(self._socket, self._v6only)
+        super()._listen(address, backlog)
+
+    @property
+    def v6only(self):
+        """
+        When False (default), the listener also accepts IPv4 peers.
+        Must be set before listen() is called.
+        """
+
+        return self._v6only
+
+    @v6only.setter
+    def v6only(self, v6only):
+        self._v6only = v6only
+
+    def listen(self, host='::', port=0, backlog=5):
+        self._listen((host, port), backlog)
+
+
+class UDPEndpoint(DatagramEndpoint):
+
+    __slots__ = ('_v6only',)
+
+    def __init__(self, eloop, handler, events=None):
+
+        super().__init__(eloop, socket.AF_INET6, socket.SOCK_DGRAM, 0,
+                         handler)
+
+        self._v6only = False
+
+        if events is not None:
+            try:
+                for e, f in events.items():
+                    if e == 'onconnected':
+                        self.onconnected = f
+                    elif e == 'ondisconnected':
+                        self.ondisconnected = f
+                    elif e == 'onerror':
+                        self.onerror = f
+            except:
+                raise ValueError
+
+    @property
+    def v6only(self):
+        """
+        When False (default), the endpoint also exchanges datagrams
+        with IPv4 addresses, which must be given to sendto() mapped.
+        Must be set before bind() is called.
+        """
+
+        return self._v6only
+
+    @v6only.setter
+    def v6only(self, v6only):
+        self._v6only = v6only
+
+    def bind(self, host='::', port=0):
+        """
+        Bind the endpoint to host and port and start receiving.
+        """
+
+        try:
+            _v6only(self._socket, self._v6only)
+            self._bind((host, port))
+        except socket.error as e:
+            self._dispatcherror(e)
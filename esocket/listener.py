@@ -16,13 +16,104 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 import sys
+import subprocess
 import _socket as socket
 
-import pyev
-
 from esocket.baseesocket import BaseEsocket
 from esocket.connection import PeerConnection
+from esocket.eventloop import EV_READ
+from esocket.metrics import Metrics, ListenerMetrics
+from esocket.registry import PeerRegistry
+
+# The most connections accepted per readiness event before the peers
+# already connected get their turn.
+ACCEPT_BUDGET = 64
+
+# What broadcast() does with peers that have more than the slow limit
+# of bytes waiting in their sendqueue.
+SLOW_QUEUE = 'queue'
+SLOW_SKIP = 'skip'
+SLOW_DROP = 'drop'
+SLOW_LIMIT = 65536
+
+# Seconds drain() gives the peers before closing them
+DRAIN_TIMEOUT = 30.0
+
+# The environment variable telling a process started by restart()
+# the file descriptors of the listening sockets handed to it.
+LISTEN_FDS = 'ESOCKET_LISTEN_FDS'
+
+# Listening sockets handed to this process, read from the environment
+# on first use and taken by the listeners listening on their address.
+_inherited = None
+
+def _sameaddress(bound, address):
+    # True if a socket bound to bound is listening on address, as
+    # given to listen().
+    if not isinstance(address, tuple):
+        return os.fsencode(bound) == os.fsencode(address)
+
+    if bound[1] != address[1]:
+        return False
+
+    host = address[0]
+    if host in ('', '0.0.0.0', '::', socket.INADDR_ANY):
+        return bound[0] in ('0.0.0.0', '::')
+    return bound[0] in (host, '::ffff:' + str(host))
+
+def _inherit(family, type, address):
+    # Returns the listening socket handed to this process for
+    # address, or None.
+    global _inherited
+    if _inherited is None:
+        _inherited = []
+        for fd in os.environ.pop(LISTEN_FDS, '').split(','):
+            try:
+                _inherited.append(socket.socket(fileno=int(fd)))
+            except (ValueError, OSError):
+                pass
+
+    for sock in _inherited:
+        try:
+            bound = sock.getsockname()
+        except socket.error:
+            continue
+
+        if sock.family == family and sock.type == type and \
+                _sameaddress(bound, address):
+            _inherited.remove(sock)
+            os.set_inheritable(sock.fileno(), False)
+            return sock
+
+    return None
+
+def restart(listeners, args=None, env=None, timeout=DRAIN_TIMEOUT):
+    """
+    Start a new process running args, by default this program with
+    the same arguments, hand it the listening sockets of listeners,
+    and drain them. Returns the subprocess.Popen of the new process.
+
+    Listeners of the new process listening on the address of one of
+    the sockets take it over instead of binding a socket of their
+    own. Connections keep queueing on the socket while the new
+    process starts, so none are refused during the restart.
+    """
+
+    fds = [listener.handoff() for listener in listeners]
+
+    env = dict(os.environ if env is None else env)
+    env[LISTEN_FDS] = ','.join(str(fd) for fd in fds)
+    if args is None:
+        args = [sys.executable] + sys.argv
+
+    process = subprocess.Popen(args, env=env, pass_fds=fds)
+
+    for listener in listeners:
+        listener.drain(timeout)
+
+    return process
 
 class Listener(BaseEsocket):
     """
@@ -39,43 +130,163 @@ class Listener(BaseEsocket):
     * Disconnected - Fired when the listener is closed for business
     * Error - Fired when an error occured on the listener
     * Peer - Fired when a new peer tries to connect
+
+    The peers are kept in a PeerRegistry, see registry, where they
+    can be looked up by id and address and tagged into groups.
+
+    Instead of closing, a listener can drain(), letting its peers
+    finish before they are closed. A program can also restart() with
+    the listening sockets handed to the new process.
     """
 
+    __slots__ = ('_peers', '_peercount', '_maxpeers', '_accepting',
+                 '_reuseport', '_acceptbudget', '_deferaccept', '_framer',
+                 '_coalesce', '_slowpolicy', '_slowlimit', '_clshandler',
+                 '_draining', '_handedoff', '_edrain', '_eaccept')
+
+    # The connection type of the peers
+    _peerclass = PeerConnection
+
     def __init__(self, eloop, family, type, proto, clshandler):
 
         super().__init__(eloop, socket.socket(family, type, proto))
 
-        self._peers = set()
+        self._peers = PeerRegistry()
         self._peercount = 0
         self._maxpeers = sys.maxsize
         self._accepting = False
-
-        self._edelay = None
-        self._eaccept = pyev.Io(self._socket, pyev.EV_READ,
-                                self._eloop, self._accepthandler,
-                                clshandler)
+        self._reuseport = False
+        self._acceptbudget = ACCEPT_BUDGET
+        self._deferaccept = None
+        self._framer = None
+        self._coalesce = False
+        self._slowpolicy = SLOW_QUEUE
+        self._slowlimit = SLOW_LIMIT
+
+        self._clshandler = clshandler
+        self._draining = False
+        self._handedoff = False
+        self._edrain = None
+        self._eaccept = self._eloop.io(self._socket, EV_READ,
+                                       self._accepthandler)
 
 #-----------------------------------------------------------------------
 # Private Methods
 #-----------------------------------------------------------------------
 
     # Handler for a peers disconnect event, the connection was
-    # terminated so remove it from the set of connections
+    # terminated so remove it from the registry
     def _disconnecthandler(self, caller, data):
+        # Keep the counters of the peer in the listeners total
+        if self._metrics is not None and caller._metrics is not None:
+            self._metrics.merge(caller._metrics)
+            caller._metrics = None
+
         self._peers.remove(caller)
         self._peercount -= 1
         assert(self.peers == len(self._peers))
 
+        if self._draining and not self._peercount:
+            self._drained()
+
     def _listen(self, address, backlog):
-        # self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.bind(address)
-        self._socket.listen(backlog)
+        sock = _inherit(self.family, self.type, address)
+        if sock is not None:
+            # Take over the socket handed to this process by the one
+            # it replaces, which is already listening.
+            self._socket.close()
+            sock.setblocking(False)
+            self._socket = sock
+            self._eaccept = self._eloop.io(self._socket, EV_READ,
+                                           self._accepthandler)
+        else:
+            self._bind(address, backlog)
+
         self._eaccept.start()
         self._active = True
         self._accepting = True
 
         self._dispatchconnected()
 
+    def _bind(self, address, backlog):
+        # self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self._reuseport:
+            self._socket.setsockopt(socket.SOL_SOCKET,
+                                    socket.SO_REUSEPORT, 1)
+        if self._deferaccept and hasattr(socket, 'TCP_DEFER_ACCEPT') \
+                and self.type == socket.SOCK_STREAM \
+                and self.family in (socket.AF_INET, socket.AF_INET6):
+            self._socket.setsockopt(socket.IPPROTO_TCP,
+                                    socket.TCP_DEFER_ACCEPT,
+                                    int(self._deferaccept))
+        self._socket.bind(address)
+        self._socket.listen(backlog)
+
+    def _stopaccepting(self):
+        # Close the listening socket. A socket handed to another
+        # process is only closed here, not shut down.
+        self._accepting = False
+        self._eaccept.stop()
+        self._eaccept = None
+
+        if self._handedoff:
+            self._socket.close()
+        else:
+            self._close()
+
+    def _drained(self):
+        # Every peer is gone, the listener is done
+        if self._edrain is not None:
+            self._edrain.stop()
+            self._edrain = None
+        self._draining = False
+        self._active = False
+        self._dispatchdisconnected()
+
+    def _newpeer(self, sock):
+        # Returns a new peer connection of a connected socket
+        return self._peerclass(self._eloop, sock, self._clshandler())
+
+    def _addpeer(self, sock, address=None):
+        # Make a peer connection of a socket connected from address,
+        # set up like the listener, and return it. The peer is
+        # registered before it dispatches connected, so a handler
+        # closing it right away still removes it again.
+        peer = self._newpeer(sock)
+
+        if self._metrics is not None:
+            self._metrics.accepts += 1
+            peer.metrics = Metrics()
+
+        if self._etimeout is not None:
+            peer.timeout = self._etimeout
+        if self._maxsend is not None:
+            peer.maxsend = self._maxsend
+        if self._maxrecv is not None:
+            peer.maxrecv = self._maxrecv
+        if self._framer is not None:
+            peer.framer = self._framer.copy()
+        if self._coalesce:
+            peer.coalesce = True
+        if self._data is not None:
+            peer.data = self._data
+        else:
+            peer.data = self
+
+        # The listener wants to be notified when a peer
+        # disconnects, so cleanup can be performed
+        peer._listener = self
+
+        # Add the peer connection to the listeners registry
+        # of connections.
+        self._peers.add(peer, address)
+        self._peercount += 1
+
+        assert(self._peercount == len(self._peers))
+
+        peer._start()
+        return peer
+
     def _dispatchpeer(self, data=None):
         return self._ecall('peer', data)
 
@@ -85,59 +296,49 @@ class Listener(BaseEsocket):
 
     def _accepthandler(self, watcher, event):
         # There might be more that one connection waiting, so
-        # loop until accept() returns an error or until listener
-        # is no longer accepting connections.
-        while self._accepting and not self._peercount > self._maxpeers:
+        # loop until accept() returns an error, until the accept
+        # budget for this event is spent or until listener is no
+        # longer accepting connections. Connections left in the
+        # backlog are accepted on the next loop iteration.
+        budget = self._acceptbudget
+        m = self._metrics
+
+        while budget > 0 and self._accepting and \
+                not self._peercount > self._maxpeers:
+            budget -= 1
+
             try:
+                # The accepted socket is already close-on-exec,
+                # BaseEsocket makes it non-blocking.
                 fd, addr = self._socket._accept()
-                sock = socket.socket(self.family, self.type,
-                                     self.proto, fileno=fd)
-
-                # Ask the peerhandler if its okay to accept connection
-                if self._dispatchpeer(addr):
-                    peerhandler = watcher.data()
-                    peer = PeerConnection(self._eloop,
-                                          sock,
-                                          peerhandler)
-
-                    if self._etimeout is not None:
-                        peer.timeout = self._timeout
-                    if self._maxsend is not None:
-                        peer.maxsend = self._maxsend
-                    if self._maxrecv is not None:
-                        peer.maxrecv = self._maxrecv
-                    if self._data is not None:
-                        peer.data = self._data
-                    else:
-                        peer.data = self
-
-                    # The listener wants to be notified when a peer
-                    # disconnects, so cleanup can be performed
-                    peer.ondisconnected = self._disconnecthandler
-
-                    # Add the peer connection to the listeners set
-                    # of connections.
-                    self._peers.add(peer)
-                    self._peercount += 1
-
-                    assert(self._peercount == len(self._peers))
-                else:
-                    # Accepthandler indicated that the connection
-                    # is not wanted, close the socket.
-                    sock.shutdown(socket.SHUT_RDWR)
-                    sock.close()
-
+            except (BlockingIOError, InterruptedError):
+                if m is not None:
+                    m.eagain += 1
+                break
             except socket.error:
                 break
 
-    # Delayed disconnected handler, does not signal the listener
-    # is disconnected until no more peers are connected.
-    def _delayhandler(self):
-        if not self.peers:
-            assert(len(self._peers) == 0)
-            self._edelay.stop()
-            self._edelay = None
-            self._dispatchdisconnected
+            sock = socket.socket(self.family, self.type,
+                                 self.proto, fileno=fd)
+
+            # Ask the peerhandler if its okay to accept connection
+            if self._dispatchpeer(addr):
+                self._addpeer(sock, addr)
+            else:
+                # Accepthandler indicated that the connection
+                # is not wanted, close the socket.
+                if m is not None:
+                    m.rejected += 1
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                sock.close()
+
+    def _drainhandler(self, watcher, event):
+        # The drain timeout has passed, close the peers left
+        self._edrain = None
+        self.closepeers()
 
 #-----------------------------------------------------------------------
 # Public Properties
@@ -152,6 +353,15 @@ class Listener(BaseEsocket):
 
         return self._accepting
 
+    @property
+    def isdraining(self):
+        """
+        Returns True while the listener waits for its peers to
+        disconnect, after drain() or close(delay=True).
+        """
+
+        return self._draining
+
     @property
     def peers(self):
         """
@@ -161,6 +371,15 @@ class Listener(BaseEsocket):
 
         return self._peercount
 
+    @property
+    def registry(self):
+        """
+        Returns the PeerRegistry of the peers connected through this
+        listener, see esocket.registry.
+        """
+
+        return self._peers
+
     @property
     def maxpeers(self):
         """
@@ -174,17 +393,136 @@ class Listener(BaseEsocket):
     def maxpeers(self, peernum):
         self._maxpeers = peernum
 
+    @property
+    def framer(self):
+        """
+        A framer from esocket.framing, copied to every peer that
+        connects. See BaseConnection.framer.
+        """
+
+        return self._framer
+
+    @framer.setter
+    def framer(self, framer):
+        self._framer = framer
+
+    @property
+    def coalesce(self):
+        """
+        Whether peers coalesce their sends, see
+        BaseConnection.coalesce.
+        """
+
+        return self._coalesce
+
+    @coalesce.setter
+    def coalesce(self, coalesce):
+        self._coalesce = coalesce
+
+    @property
+    def slowpolicy(self):
+        """
+        What broadcast() does with slow peers, those with more than
+        slowlimit bytes waiting to be sent: SLOW_QUEUE (default)
+        queues the payload anyway, SLOW_SKIP leaves them out and
+        SLOW_DROP closes them.
+        """
+
+        return self._slowpolicy
+
+    @slowpolicy.setter
+    def slowpolicy(self, policy):
+        if policy not in (SLOW_QUEUE, SLOW_SKIP, SLOW_DROP):
+            raise ValueError('unknown slow peer policy: {!r}'.format(policy))
+        self._slowpolicy = policy
+
+    @property
+    def slowlimit(self):
+        """
+        Bytes a peer may have waiting in its sendqueue before
+        broadcast() considers it slow.
+        """
+
+        return self._slowlimit
+
+    @slowlimit.setter
+    def slowlimit(self, size):
+        self._slowlimit = size
+
+    @property
+    def acceptbudget(self):
+        """
+        The most connections accepted per readiness event. Keeping
+        this bounded lets the peers already connected be served
+        during connection storms.
+        """
+
+        return self._acceptbudget
+
+    @acceptbudget.setter
+    def acceptbudget(self, count):
+        self._acceptbudget = count
+
+    @property
+    def deferaccept(self):
+        """
+        When set to a number of seconds, TCP listeners use
+        TCP_DEFER_ACCEPT, so connections are only accepted once the
+        peer has sent data or the time has passed. None (default)
+        disables it. Must be set before listen() is called, and has
+        no effect on platforms without TCP_DEFER_ACCEPT.
+        """
+
+        return self._deferaccept
+
+    @deferaccept.setter
+    def deferaccept(self, seconds):
+        self._deferaccept = seconds
+
+    @property
+    def reuseport(self):
+        """
+        When True, the listener sets SO_REUSEPORT before binding, so
+        several listeners, usually in different processes, can listen
+        on the same address and have the kernel spread connections
+        between them. Must be set before listen() is called.
+        """
+
+        return self._reuseport
+
+    @reuseport.setter
+    def reuseport(self, reuse):
+        self._reuseport = reuse
+
+    @property
+    def metrics(self):
+        """
+        The ListenerMetrics of the listener, see esocket.metrics. Set
+        to True to start counting for the listener and every peer
+        connecting after it is set, or to None (default) to stop.
+        """
+
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, metrics):
+        if metrics is True:
+            metrics = ListenerMetrics(self._peers, self._eloop.now)
+        elif not metrics:
+            metrics = None
+        self._metrics = metrics
+
 #-----------------------------------------------------------------------
 # Public Events
 #-----------------------------------------------------------------------
 
     @property
     def onpeer(self):
-        return self._eventmap.get('peer')
+        return self._getevent('peer')
 
     @onpeer.setter
     def onpeer(self, fn):
-        self._eventmap['peer'] = fn
+        self._setevent('peer', fn)
 
 #-----------------------------------------------------------------------
 # Public Methods
@@ -207,34 +545,179 @@ class Listener(BaseEsocket):
         """
         Closes the listening socket.
 
-        If delay is False, peers already connected through the
-        listener will be allowed to remain connected. They can be
+        If delay is False, the peers are closed with the listener.
+        If it is True, peers already connected through the listener
+        will be allowed to remain connected, and the disconnected
+        event is dispatched once they are all gone. They can be
         forcibly removed later with the closepeers() method.
         """
 
         if self._accepting:
-            self._accepting = False
-            self._eaccept.stop()
-            self._eaccept = None
-            self._close()
+            self._stopaccepting()
 
             if delay:
-                self._edelay = pyev.Idle(self._eloop, self._delayhandler)
-                self._edelay.start()
+                self._draining = True
+                if not self._peercount:
+                    self._drained()
             else:
                 self.closepeers()
                 self._active = False
                 self._dispatchdisconnected()
 
+        elif self._draining and not delay:
+            self.closepeers()
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Stop accepting connections and close the peers as they finish.
+
+        The handler of every peer gets the draining event with the
+        timeout. Peers whose handler returns True are left to close
+        themselves. The others are closed right away if they have
+        nothing left to send, or else as soon as it has been sent.
+        Peers still connected after timeout seconds are closed, unless
+        timeout is None. The disconnected event is dispatched once
+        every peer is gone.
+        """
+
+        if not self._active:
+            return
+
+        if self._accepting:
+            self._stopaccepting()
+        self._draining = True
+
+        if self._edrain is not None:
+            self._edrain.stop()
+            self._edrain = None
+        if timeout is not None:
+            self._edrain = self._eloop.timer(timeout, 0, self._drainhandler)
+            self._edrain.start()
+
+        # Peers closed while iterating are skipped by the registry
+        for peer in self._peers:
+            if not peer._active or peer._dispatchdraining(timeout):
+                continue
+
+            peer.flush()
+            if peer._sendbuf:
+                peer._closedrained = True
+            else:
+                peer.close()
+
+        if not self._peercount and self._draining:
+            self._drained()
+
+    def handoff(self):
+        """
+        Make the listening socket inheritable and return its file
+        descriptor, for a process started by this one to take over,
+        see restart(). The listener keeps accepting until it is
+        drained or closed, and then leaves the socket to the new
+        process.
+        """
+
+        if not self._accepting:
+            raise ValueError('listener is not listening')
+
+        self._handedoff = True
+        os.set_inheritable(self._socket.fileno(), True)
+        return self._socket.fileno()
+
+    def broadcast(self, payload, filter=None, tag=None):
+        """
+        Send payload to every peer, or to the peers in the registry
+        group of tag, and only to those for which filter(peer)
+        returns True if filter is given. Every peer queues the same
+        buffer, so the payload is never copied and must not be
+        modified until it has been sent.
+
+        Slow peers, and peers whose sendqueue has no room for the
+        payload, are handled according to slowpolicy. Returns a tuple
+        of the number of peers the payload was written to right away,
+        the number it was queued for, and the number of peers skipped
+        or dropped, including those closed while it was sent.
+        """
+
+        view = memoryview(payload)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+
+        policy = self._slowpolicy
+        limit = self._slowlimit
+        written = queued = skipped = 0
+        dropped = []
+
+        # A peer can be closed by its handler while sending, which
+        # the registry and its groups allow while iterating.
+        peers = self._peers if tag is None else self._peers.group(tag)
+        for peer in peers:
+            if not peer._active:
+                continue
+            if filter is not None and not filter(peer):
+                continue
+
+            if policy != SLOW_QUEUE and len(peer._sendbuf) > limit:
+                skipped += 1
+                if policy == SLOW_DROP:
+                    dropped.append(peer)
+                continue
+
+            # Like send(), but knowing whether the payload was taken
+            pending = bool(peer._sendbuf)
+            if not peer._enqueue(view):
+                skipped += 1
+                if policy == SLOW_DROP and peer._active:
+                    dropped.append(peer)
+                continue
+            if not pending:
+                peer._sendsoon()
+
+            if peer._sendbuf is None:
+                skipped += 1
+            elif peer._sendbuf:
+                queued += 1
+            else:
+                written += 1
+
+        for peer in dropped:
+            peer.close()
+
+        return written, queued, skipped
+
+    def adopt(self, sock):
+        """
+        Make a peer of a socket connected elsewhere, like a socket
+        accepted by another process and passed on over a Unix socket.
+        sock is a socket object or a file descriptor, which the peer
+        takes ownership of. The peer is set up like the peers the
+        listener accepts itself, without asking the peer event, and
+        returned.
+
+        The socket may be of another family than the listener, and
+        the listener need not be listening.
+        """
+
+        if isinstance(sock, int):
+            sock = socket.socket(fileno=sock)
+
+        try:
+            address = sock.getpeername()
+        except socket.error:
+            address = None
+
+        return self._addpeer(sock, address)
+
     def closepeers(self):
         """
         Disconnects all peers who connected through this listener.
         """
 
+        # Peers closed while iterating are skipped by the registry
         for peer in self._peers:
             peer.close()
 
         self._peercount = 0
 
-        if self._edelay is not None and self._edelay.active:
-            self._delayhandler()
+        if self._draining:
+            self._drained()
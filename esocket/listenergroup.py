@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import signal
+import traceback
+from multiprocessing.sharedctypes import RawArray
+
+import esocket.eventloop
+
+try:
+    import pyev
+except ImportError:
+    pyev = None
+    import asyncio
+
+# Seconds between each workers report of its peer count
+REPORT_INTERVAL = 1.0
+
+# Workers exiting sooner than this after being started are restarted
+# after a delay instead of immediately.
+RESTART_DELAY = 1.0
+
+def _newloop():
+    # Each worker gets a new loop of its own
+    if pyev is not None:
+        return pyev.Loop()
+    return asyncio.new_event_loop()
+
+class ListenerGroup(object):
+    """
+    Runs a listener in several worker processes.
+
+    Each worker is a forked process with its own event loop and its
+    own listener, listening with SO_REUSEPORT on the same address, so
+    the kernel spreads incoming connections over all the workers and
+    every worker can run on its own core.
+
+    The factory is called in each worker with the workers loop, and
+    must return a listener which has not started listening yet. The
+    group then calls listen() on it with the given arguments.
+
+    The parent process supervises the workers and restarts any that
+    exit. On SIGTERM or SIGINT the workers drain their listeners, see
+    Listener.drain(), giving their peers drain seconds to finish
+    before the remaining peers are closed.
+    """
+
+    def __init__(self, factory, listenargs, workers=None, drain=30.0,
+                 loopfactory=_newloop):
+
+        self._factory = factory
+        self._listenargs = tuple(listenargs)
+        self._workers = workers or os.cpu_count() or 1
+        self._drain = drain
+        self._loopfactory = loopfactory
+
+        self._pids = {}
+        self._started = {}
+        self._stopping = False
+
+        # Peer counts reported by each worker slot
+        self._peercounts = RawArray('q', self._workers)
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self._pids[pid] = slot
+            self._started[slot] = time.monotonic()
+
+            # Stopped from another thread while forking
+            if self._stopping:
+                os.kill(pid, signal.SIGTERM)
+            return
+
+        status = 1
+        try:
+            self._worker(slot)
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def _worker(self, slot):
+        # Runs in the worker process until its listener has drained
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        eloop = esocket.eventloop.wrap(self._loopfactory())
+        listener = self._factory(eloop)
+        listener.reuseport = True
+        listener.listen(*self._listenargs)
+
+        if not listener.isactive:
+            raise RuntimeError('worker {} failed to listen'.format(slot))
+
+        def report(watcher, event):
+            self._peercounts[slot] = listener.peers
+
+        def terminate(watcher, event):
+            if listener.isaccepting:
+                listener.drain(self._drain)
+
+        # The worker is done once the listener has drained
+        ondisconnected = listener.ondisconnected
+
+        def disconnected(caller, data):
+            if ondisconnected is not None:
+                ondisconnected(caller, data)
+            eloop.stop()
+
+        listener.ondisconnected = disconnected
+
+        watchers = [eloop.timer(0, REPORT_INTERVAL, report),
+                    eloop.signal(signal.SIGTERM, terminate)]
+        for watcher in watchers:
+            watcher.start()
+
+        eloop.run()
+
+        self._peercounts[slot] = 0
+
+    def _reap(self, pid, status):
+        slot = self._pids.pop(pid, None)
+        if slot is None:
+            return
+
+        self._peercounts[slot] = 0
+        if self._stopping:
+            return
+
+        # Restart the worker, backing off if it died right away
+        if time.monotonic() - self._started[slot] < RESTART_DELAY:
+            time.sleep(RESTART_DELAY)
+        if not self._stopping:
+            self._spawn(slot)
+
+    def _terminate(self, signum, frame):
+        if self._stopping:
+            return
+
+        # The pids change as run() reaps workers, which may happen in
+        # another thread than stop() is called from.
+        self._stopping = True
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        # Workers still running after the drain period are killed
+        signal.alarm(int(self._drain) + 2)
+
+    def _kill(self, signum, frame):
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def workers(self):
+        """ Returns the number of worker processes """
+        return self._workers
+
+    @property
+    def pids(self):
+        """ Returns the process ids of the running workers """
+        return list(self._pids)
+
+    @property
+    def peers(self):
+        """
+        Returns the number of peers connected to all the workers,
+        as last reported by each worker.
+        """
+
+        return sum(self._peercounts)
+
+    @property
+    def isactive(self):
+        """
+        Returns True while the group is running and not stopping.
+        """
+
+        return bool(self._pids) and not self._stopping
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def run(self):
+        """
+        Start the workers and supervise them until the group is
+        stopped and every worker has exited.
+        """
+
+        self._stopping = False
+        previous = {s: signal.signal(s, self._terminate)
+                    for s in (signal.SIGTERM, signal.SIGINT)}
+        previous[signal.SIGALRM] = signal.signal(signal.SIGALRM, self._kill)
+
+        try:
+            for slot in range(self._workers):
+                self._spawn(slot)
+
+            while self._pids:
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except ChildProcessError:
+                    break
+                self._reap(pid, status)
+
+        finally:
+            signal.alarm(0)
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+    def stop(self):
+        """
+        Stop the group, letting every worker drain its peers. May be
+        called from any thread while run() is running.
+        """
+
+        self._terminate(signal.SIGTERM, None)
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Counters for esocket connections and listeners.
+
+    Metrics are off by default. Setting the metrics property of a
+    connection or listener to True gives it a Metrics object, which
+    the connection updates as it works. The counters are plain
+    attributes, so keeping them costs an addition here and there.
+
+    A listener with metrics gives each of its peers a Metrics object
+    of their own, and its ListenerMetrics adds up the counters of
+    every peer, connected or gone.
+"""
+
+from bisect import bisect_left
+
+# Upper bounds in seconds of the handler latency histogram buckets
+LATENCY_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                  0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Counters and their names and help texts in the Prometheus export
+COUNTERS = (
+    ('bytesin', 'received_bytes_total', 'Bytes received'),
+    ('bytesout', 'sent_bytes_total', 'Bytes sent'),
+    ('recvcalls', 'recv_calls_total', 'Receive system calls'),
+    ('sendcalls', 'send_calls_total', 'Send system calls'),
+    ('partialwrites', 'partial_writes_total',
+     'Sends leaving data in the sendqueue'),
+    ('eagain', 'eagain_total', 'System calls that would have blocked'),
+    ('exceptions', 'handler_exceptions_total',
+     'Exceptions raised by handlers and swallowed'),
+)
+
+LISTENER_COUNTERS = (
+    ('accepts', 'accepted_total', 'Connections accepted'),
+    ('rejected', 'rejected_total', 'Connections rejected by the peer event'),
+)
+
+class Histogram(object):
+    """
+    A histogram of values counted in buckets with the given upper
+    bounds, plus one for anything larger.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Count a value.
+        """
+
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        """
+        Add the values counted by another histogram with the same
+        bounds.
+        """
+
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def snapshot(self):
+        """
+        Returns the histogram as a dict, with the cumulative count of
+        values up to each bound.
+        """
+
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics(object):
+    """
+    The counters of a connection.
+
+    queuehigh is the largest the sendqueue has been, and latency
+    holds a Histogram of the seconds spent in the handler for each
+    event.
+    """
+
+    __slots__ = tuple(c[0] for c in COUNTERS) + ('queuehigh', 'latency')
+
+    def __init__(self):
+        for name, export, text in COUNTERS:
+            setattr(self, name, 0)
+        self.queuehigh = 0
+        self.latency = {}
+
+    def observe(self, event, seconds):
+        """
+        Count the seconds a handler spent on an event.
+        """
+
+        histogram = self.latency.get(event)
+        if histogram is None:
+            histogram = self.latency[event] = Histogram()
+        histogram.observe(seconds)
+
+    def merge(self, other):
+        """
+        Add the counters of other to these.
+        """
+
+        for name, export, text in COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.queuehigh = max(self.queuehigh, other.queuehigh)
+
+        for event, histogram in other.latency.items():
+            mine = self.latency.get(event)
+            if mine is None:
+                mine = self.latency[event] = Histogram(histogram.bounds)
+            mine.merge(histogram)
+
+    def snapshot(self):
+        """
+        Returns the counters as a dict.
+        """
+
+        snapshot = {name: getattr(self, name) for name, e, t in COUNTERS}
+        snapshot['queuehigh'] = self.queuehigh
+        snapshot['latency'] = {event: histogram.snapshot()
+                               for event, histogram in self.latency.items()}
+        return snapshot
+
+    def prometheus(self, prefix='esocket', labels=None):
+        """
+        Returns the counters in the Prometheus text exposition format.
+        labels is a dict of labels added to every sample.
+        """
+
+        return _prometheus(self.snapshot(), prefix, labels)
+
+
+class ListenerMetrics(Metrics):
+    """
+    The counters of a listener, which include the counters of every
+    peer that has connected through it.
+
+    acceptrate in the snapshot is the number of connections accepted
+    per second since the previous snapshot which reset the window.
+    """
+
+    __slots__ = tuple(c[0] for c in LISTENER_COUNTERS) + \
+        ('_peers', '_clock', '_lasttime', '_lastaccepts')
+
+    def __init__(self, peers, clock):
+        super().__init__()
+        for name, export, text in LISTENER_COUNTERS:
+            setattr(self, name, 0)
+
+        self._peers = peers
+        self._clock = clock
+        self._lasttime = clock()
+        self._lastaccepts = 0
+
+    def total(self):
+        """
+        Returns a Metrics with the counters of the listener and every
+        peer added up.
+        """
+
+        total = Metrics()
+        total.merge(self)
+        for peer in self._peers:
+            if peer._metrics is not None:
+                total.merge(peer._metrics)
+        return total
+
+    def snapshot(self, reset=True):
+        """
+        Returns the counters as a dict. With reset False, acceptrate
+        is reported without starting a new window for it.
+        """
+
+        snapshot = self.total().snapshot()
+        for name, export, text in LISTENER_COUNTERS:
+            snapshot[name] = getattr(self, name)
+        snapshot['peers'] = len(self._peers)
+
+        now = self._clock()
+        elapsed = now - self._lasttime
+        if elapsed > 0:
+            snapshot['acceptrate'] = \
+                (self.accepts - self._lastaccepts) / elapsed
+        else:
+            snapshot['acceptrate'] = 0.0
+
+        if reset:
+            self._lasttime = now
+            self._lastaccepts = self.accepts
+
+        return snapshot
+
+    def prometheus(self, prefix='esocket', labels=None):
+        """
+        Like Metrics.prometheus(), but leaves the window of acceptrate
+        to the readers of snapshot(), so scrapes do not change it.
+        """
+
+        return _prometheus(self.snapshot(reset=False), prefix, labels)
+
+
+def _labels(labels, extra=None):
+    # Format a label set as {name="value",...}
+    items = list(labels.items()) if labels else []
+    if extra:
+        items.extend(extra)
+    if not items:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                  .replace('"', '\\"')
+                                  .replace('\n', '\\n'))
+        for k, v in items) + '}'
+
+def _prometheus(snapshot, prefix, labels):
+    lines = []
+
+    def sample(name, kind, text, value):
+        name = '{}_{}'.format(prefix, name)
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+    for name, export, text in COUNTERS + LISTENER_COUNTERS:
+        if name in snapshot:
+            sample(export, 'counter', text, snapshot[name])
+
+    sample('sendqueue_high_bytes', 'gauge',
+           'Largest size of a sendqueue', snapshot['queuehigh'])
+    if 'peers' in snapshot:
+        sample('peers', 'gauge', 'Connected peers', snapshot['peers'])
+        sample('accept_rate', 'gauge',
+               'Connections accepted per second', snapshot['acceptrate'])
+
+    if snapshot['latency']:
+        name = '{}_handler_seconds'.format(prefix)
+        lines.append('# HELP {} Seconds spent in handlers'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for event, histogram in sorted(snapshot['latency'].items()):
+            for bound, count in histogram['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels, [('event', event), ('le', le)]),
+                    count))
+            lines.append('{}_sum{} {}'.format(
+                name, _labels(labels, [('event', event)]), histogram['sum']))
+            lines.append('{}_count{} {}'.format(
+                name, _labels(labels, [('event', event)]),
+                histogram['count']))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Offloading of CPU heavy request handling from the loop.
+
+    An OffloadHandler hands the data received on a connection to a
+    concurrent.futures executor, and sends the results back to the
+    peer from the loop, in the order the data arrived. The loop keeps
+    doing the I/O while a thread or process pool does the work.
+"""
+
+from collections import deque
+
+class OffloadHandler(object):
+    """
+    A ConnectionHandler running work(data) in executor for every
+    data or frame event, and sending whatever it returns, unless it
+    returns None.
+
+    Results are sent in the order the data was received, even when
+    the executor finishes them out of order. An exception raised by
+    work is dispatched to the error event. Results of a connection
+    which closes meanwhile are dropped.
+
+    Every other event is passed on to handler, if there is one, which
+    is also where the error events go. For a process pool, work and
+    the data must be picklable.
+
+    Each connection needs an OffloadHandler of its own. A listener
+    can be given one as a factory, e.g.
+    functools.partial(OffloadHandler, executor, work, handler).
+    """
+
+    def __init__(self, executor, work, handler=None):
+        self._executor = executor
+        self._work = work
+        self._handler = handler
+
+        # Futures of the submitted work, oldest first, and the
+        # connection they are for.
+        self._pending = deque()
+        self._sock = None
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _forward(self, event, sock, data):
+        if self._handler is not None:
+            return getattr(self._handler, event)(sock, data)
+
+    def _submit(self, sock, data):
+        self._sock = sock
+        future = self._executor.submit(self._work, data)
+        self._pending.append(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        # Called in the executor's thread, or right away in the loop's
+        # thread if the work was already done. Nothing is delivered
+        # once the connection has disconnected.
+        sock = self._sock
+        if sock is None or future.cancelled():
+            return
+
+        try:
+            sock._eloop.call_soon_threadsafe(self._deliver, sock)
+        except RuntimeError:
+            # The connection closed and nothing else holds the loop
+            pass
+
+    def _deliver(self, sock):
+        # Send the results that are done, up to the first that is not
+        pending = self._pending
+
+        while pending and pending[0].done():
+            future = pending.popleft()
+            if not sock.isactive:
+                continue
+
+            try:
+                result = future.result()
+            except Exception as e:
+                self._forward('error', sock, e)
+                continue
+
+            if result is not None:
+                sock.send(result)
+
+    def _cancel(self):
+        self._sock = None
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def pending(self):
+        """ Returns the number of results not sent yet """
+        return len(self._pending)
+
+#-----------------------------------------------------------------------
+# Public Events
+#-----------------------------------------------------------------------
+
+    def connected(self, sock, data):
+        return self._forward('connected', sock, data)
+
+    def data(self, sock, data):
+        self._submit(sock, sock.recv(data))
+
+    def frame(self, sock, data):
+        self._submit(sock, data)
+
+    def timeout(self, sock, data):
+        return self._forward('timeout', sock, data)
+
+    def pause_writing(self, sock, data):
+        return self._forward('pause_writing', sock, data)
+
+    def resume_writing(self, sock, data):
+        return self._forward('resume_writing', sock, data)
+
+    def error(self, sock, data):
+        return self._forward('error', sock, data)
+
+    def disconnected(self, sock, data):
+        self._cancel()
+        return self._forward('disconnected', sock, data)
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import _socket as socket
+from collections import deque
+
+import esocket.eventloop
+from esocket.ipv4 import TCPConnection
+from esocket.baseconnection import WRITE_HIGH, WRITE_LOW
+
+def peekprobe(conn):
+    """
+    The default probe for idle connections. An idle connection is
+    alive if the peer has neither closed it nor sent anything.
+    """
+
+    try:
+        return not conn._socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+        return True
+    except socket.error:
+        return False
+
+
+class PoolHandler(object):
+    """
+    The connectionhandler of pooled connections. It passes the
+    events of a connection on to the handler of whoever has acquired
+    it, and reports back to the pool.
+    """
+
+    def __init__(self, pool, key):
+        self._pool = pool
+        self._key = key
+        self.target = None
+
+    def _forward(self, event, sock, data):
+        if self.target is not None:
+            return getattr(self.target, event)(sock, data)
+
+    def connected(self, sock, data):
+        if self.target is None:
+            # Opened by the pool itself, keep it for later
+            self._pool._putidle(self._key, sock)
+        else:
+            return self._forward('connected', sock, data)
+
+    def data(self, sock, data):
+        if self.target is None:
+            # Nobody asked for this data, the connection is unusable
+            sock.close()
+        else:
+            return self._forward('data', sock, data)
+
+    def frame(self, sock, data):
+        if self.target is None:
+            sock.close()
+        else:
+            return self._forward('frame', sock, data)
+
+    def timeout(self, sock, data):
+        return self._forward('timeout', sock, data)
+
+    def pause_writing(self, sock, data):
+        return self._forward('pause_writing', sock, data)
+
+    def resume_writing(self, sock, data):
+        return self._forward('resume_writing', sock, data)
+
+    def error(self, sock, data):
+        try:
+            return self._forward('error', sock, data)
+        finally:
+            if not sock.isactive:
+                # Failed to connect, wait for the next probe before
+                # trying again. The connection is dropped, so close the
+                # socket it got to try again with.
+                self._pool._evict(self._key, sock, False)
+                sock._close()
+
+    def disconnected(self, sock, data):
+        self._pool._evict(self._key, sock)
+        return self._forward('disconnected', sock, data)
+
+
+class ConnectionPool(object):
+    """
+    A pool of outgoing TCPConnections, kept open and reused between
+    requests to the same (host, port).
+
+    acquire() hands a connection to a ConnectionHandler, which gets
+    the 'connected' event once the connection is its to use, and every
+    event of the connection until it is given back with release(). A
+    connection that is closed instead is removed from the pool.
+
+    There are at most maxsize connections to an address, and the pool
+    keeps at least minsize connections to addresses it has been asked
+    for. Every probeinterval seconds, connections idle for more than
+    idletime seconds are closed down to minsize, and the remaining
+    idle connections are checked with the probe, closing those that
+    fail it.
+    """
+
+    def __init__(self, eloop, minsize=0, maxsize=16, idletime=60.0,
+                 probeinterval=5.0, probe=peekprobe, connecttimeout=1):
+
+        self._eloop = esocket.eventloop.wrap(eloop)
+        self._minsize = minsize
+        self._maxsize = maxsize
+        self._idletime = idletime
+        self._probe = probe
+        self._connecttimeout = connecttimeout
+
+        # Connections per address, all of them and the idle ones
+        # with the time they became idle.
+        self._conns = {}
+        self._idle = {}
+        self._waiters = {}
+        self._closed = False
+
+        self._eprobe = self._eloop.timer(probeinterval, probeinterval,
+                                         self._probehandler)
+        self._eprobe.start()
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _open(self, key, handler):
+        # Open a new connection to key, which is given to handler
+        # once connected, or kept idle if handler is None.
+        poolhandler = PoolHandler(self, key)
+        poolhandler.target = handler
+
+        conn = TCPConnection(self._eloop, poolhandler)
+        self._conns.setdefault(key, set()).add(conn)
+        conn.connect(key[0], key[1], self._connecttimeout)
+
+    def _fill(self, key):
+        # Open connections until there are minsize of them
+        while not self._closed and \
+                len(self._conns.get(key, ())) < self._minsize:
+            self._open(key, None)
+
+    def _handout(self, conn, handler):
+        # The handler gets connected like any other event, so its
+        # exceptions stay out of the pool.
+        conn._handler.target = handler
+        conn._hcall('connected', None)
+
+    def _reset(self, conn):
+        # Undo the settings of the last owner of a released connection
+        conn.framer = None
+        conn.timeout = None
+        conn.readhigh = None
+        conn.upstream = None
+        conn.coalesce = False
+        conn.writehigh = WRITE_HIGH
+        conn.writelow = WRITE_LOW
+        if conn._corked:
+            conn.uncork()
+        while conn._readpauses:
+            conn.resumereading()
+
+    def _putidle(self, key, conn):
+        # A connection has been released or opened by the pool, give
+        # it to the next waiter or keep it idle.
+        waiters = self._waiters.get(key)
+        if waiters:
+            self._handout(conn, waiters.popleft())
+        else:
+            conn._handler.target = None
+            self._idle.setdefault(key, {})[conn] = self._eloop.now()
+
+    def _evict(self, key, conn, reopen=True):
+        # Forget a connection which has been closed or failed
+        conns = self._conns.get(key)
+        if not conns or conn not in conns:
+            return
+
+        conns.discard(conn)
+        self._idle.get(key, {}).pop(conn, None)
+
+        if reopen:
+            self._refill(key)
+
+    def _refill(self, key):
+        # Open connections for anyone waiting, and up to minsize
+        waiters = self._waiters.get(key)
+        while waiters and not self._closed and \
+                len(self._conns[key]) < self._maxsize:
+            self._open(key, waiters.popleft())
+
+        self._fill(key)
+
+    def _probehandler(self, watcher, event):
+        now = self._eloop.now()
+
+        for key, idle in list(self._idle.items()):
+            for conn, since in list(idle.items()):
+                # Closing a connection evicts it from the pool
+                if now - since > self._idletime and \
+                        len(self._conns[key]) > self._minsize:
+                    conn.close()
+                elif not self._probe(conn):
+                    conn.close()
+
+        for key in list(self._conns):
+            self._refill(key)
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def minsize(self):
+        """ The number of connections kept open to each address """
+        return self._minsize
+
+    @minsize.setter
+    def minsize(self, size):
+        self._minsize = size
+
+    @property
+    def maxsize(self):
+        """ The most connections opened to an address at a time """
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, size):
+        self._maxsize = size
+
+    def size(self, host, port):
+        """
+        Returns the number of connections open or opening to
+        (host, port), idle or not.
+        """
+
+        return len(self._conns.get((host, port), ()))
+
+    def idle(self, host, port):
+        """
+        Returns the number of idle connections to (host, port).
+        """
+
+        return len(self._idle.get((host, port), ()))
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def acquire(self, host, port, handler):
+        """
+        Get a connection to (host, port) for handler. The handler's
+        connected() method is called with the connection as soon as
+        one is available, which may be immediately.
+        """
+
+        if self._closed:
+            raise ValueError('acquire from a closed pool')
+
+        key = (host, port)
+        idle = self._idle.get(key)
+        if idle:
+            # Reuse the most recently used connection, it is the
+            # least likely to have been dropped by the peer.
+            conn, since = idle.popitem()
+            self._handout(conn, handler)
+        elif len(self._conns.get(key, ())) < self._maxsize:
+            self._open(key, handler)
+        else:
+            self._waiters.setdefault(key, deque()).append(handler)
+
+    def release(self, conn):
+        """
+        Give an acquired connection back to the pool. Connections
+        with unread data are closed instead, since whatever the peer
+        sends next would be mistaken for the next reply. The framer,
+        timeout, flow control and corking set by the owner are reset
+        for the next.
+        """
+
+        if not conn.isactive:
+            return
+
+        if not isinstance(conn._handler, PoolHandler):
+            raise ValueError('connection is not from a pool')
+
+        if self._closed or conn._recvbuf:
+            conn.close()
+        else:
+            self._reset(conn)
+            self._putidle(conn._handler._key, conn)
+
+    def warm(self, host, port):
+        """
+        Open connections to (host, port) until there are minsize.
+        """
+
+        self._fill((host, port))
+
+    def close(self):
+        """
+        Close every idle connection and stop pooling. Acquired
+        connections are closed when they are released.
+        """
+
+        self._closed = True
+        self._eprobe.stop()
+        self._waiters.clear()
+
+        for idle in list(self._idle.values()):
+            for conn in list(idle):
+                conn.close()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    Profiling of ConnectionHandler callbacks.
+
+    Every handler callback runs on the loop, so one slow callback
+    delays every other socket on it. A Profiler set on an EventLoop
+    times every callback dispatched by the esockets on that loop,
+    keeping a histogram per event and handler class, and logs the
+    callbacks taking longer than its threshold together with the
+    address of the connection.
+
+    With a sample interval, a watchdog thread also looks at the loop
+    every interval seconds, and logs the stack of a callback which
+    has been running for longer than the threshold, while it is
+    still running.
+"""
+
+import sys
+import time
+import logging
+import threading
+import traceback
+
+from esocket.metrics import Histogram
+
+logger = logging.getLogger('esocket.profiling')
+
+def _address(sock):
+    # The peer address of a connection, or the address of a listener
+    try:
+        return sock._socket.getpeername()
+    except (OSError, AttributeError):
+        pass
+
+    try:
+        return sock._socket.getsockname()
+    except (OSError, AttributeError):
+        return None
+
+def _name(target):
+    # The name a handler or event callback is recorded under
+    if hasattr(target, '__qualname__'):
+        return '{}.{}'.format(target.__module__, target.__qualname__)
+
+    cls = type(target)
+    return '{}.{}'.format(cls.__module__, cls.__qualname__)
+
+
+class Profiler(object):
+    """
+    Times the callbacks dispatched on a loop. Set it with
+    eloop.profiler = Profiler(), where eloop is the EventLoop of
+    the esockets, from esocket.eventloop.wrap(loop).
+    """
+
+    def __init__(self, threshold=0.05, sampleinterval=None, logger=logger):
+        self._threshold = threshold
+        self._sampleinterval = sampleinterval
+        self._logger = logger
+
+        # Histograms by (event, handler name) and the number of
+        # callbacks over the threshold
+        self._histograms = {}
+        self._slowcalls = 0
+
+        # Callbacks running on the loop, outermost first, as lists of
+        # [start, thread, esocket, event, name, sampled]
+        self._running = []
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _enter(self, sock, event, target, start):
+        self._running.append([start, threading.get_ident(), sock, event,
+                              target, False])
+
+    def _leave(self, elapsed):
+        start, thread, sock, event, target, sampled = self._running.pop()
+
+        name = _name(target)
+        key = (event, name)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(elapsed)
+
+        if elapsed > self._threshold:
+            self._slowcalls += 1
+            if self._logger is not None:
+                self._logger.warning(
+                    'slow callback: %s %s took %.3fs on %s',
+                    name, event, elapsed, _address(sock))
+
+    def _watch(self):
+        # Runs in the watchdog thread
+        while not self._stopped.wait(self._sampleinterval):
+            try:
+                running = self._running[0]
+            except IndexError:
+                continue
+
+            start, thread, sock, event, target, sampled = running
+            if sampled or time.perf_counter() - start <= self._threshold:
+                continue
+
+            frame = sys._current_frames().get(thread)
+            if frame is None:
+                continue
+
+            # Only log the first sample of each callback
+            running[5] = True
+            if self._logger is not None:
+                self._logger.warning(
+                    'callback %s %s running for %.3fs on %s:\n%s',
+                    _name(target), event, time.perf_counter() - start,
+                    _address(sock), ''.join(traceback.format_stack(frame)))
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def threshold(self):
+        """ Seconds a callback may take before it is logged as slow """
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, seconds):
+        self._threshold = seconds
+
+    @property
+    def slowcalls(self):
+        """ Returns the number of callbacks over the threshold """
+        return self._slowcalls
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def start(self):
+        """
+        Start the watchdog thread, if there is a sample interval.
+        Called when the profiler is set on a loop.
+        """
+
+        if self._sampleinterval and self._watchdog is None:
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch,
+                                              name='esocket-watchdog',
+                                              daemon=True)
+            self._watchdog.start()
+
+    def stop(self):
+        """
+        Stop the watchdog thread. Called when the profiler is removed
+        from its loop.
+        """
+
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._watchdog.join()
+            self._watchdog = None
+
+    def snapshot(self):
+        """
+        Returns a dict of histogram snapshots by (event, handler).
+        """
+
+        return {key: histogram.snapshot()
+                for key, histogram in self._histograms.items()}
+
+    def report(self, count=10):
+        """
+        Returns a table of the count callbacks with the most total
+        time spent in them.
+        """
+
+        rows = sorted(self._histograms.items(),
+                      key=lambda item: item[1].sum, reverse=True)
+
+        lines = ['{:>10} {:>10} {:>10}  {}'.format('calls', 'total',
+                                                   'mean', 'callback')]
+        for (event, name), histogram in rows[:count]:
+            lines.append('{:>10} {:>9.3f}s {:>8.3f}ms  {} {}'.format(
+                histogram.count, histogram.sum,
+                histogram.sum / histogram.count * 1000, name, event))
+
+        return '\n'.join(lines)
+
+    def reset(self):
+        """
+        Forget everything recorded so far.
+        """
+
+        self._histograms.clear()
+        self._slowcalls = 0
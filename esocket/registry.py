@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    The peer registry of a listener.
+
+    A listener keeps its peers in a PeerRegistry, which gives every
+    peer an id when it is added, never reused by the registry, and
+    forgets the peer when it disconnects. Peers can be looked up by
+    id or by address, and tagged to put them in groups, like the
+    subscribers of a channel. Tagging, untagging and lookups are O(1),
+    and a peer leaves all of its groups when it disconnects.
+
+    Groups can be iterated while peers are added, removed, tagged or
+    untagged, for instance by handlers called while sending to every
+    peer of a group. Peers removed from the group while it is being
+    iterated are skipped, and peers added are not visited until the
+    next iteration. The changes are settled once the last iteration
+    of the group is done, so an iteration should be run to the end
+    or closed.
+"""
+
+class PeerGroup(object):
+    """
+    An ordered set of peers, keyed by their ids, which can change
+    while it is iterated.
+    """
+
+    __slots__ = ('_members', '_size', '_iterating', '_dead', '_pending',
+                 '_registry', '_tag')
+
+    def __init__(self, registry=None, tag=None):
+        # Peers removed while iterating are left as None until the
+        # iteration is done, and peers added are kept aside.
+        self._members = {}
+        self._size = 0
+        self._iterating = 0
+        self._dead = None
+        self._pending = None
+
+        # The registry which has the group for tag, told when the
+        # group is left empty after an iteration.
+        self._registry = registry
+        self._tag = tag
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, peer):
+        return self.get(peer._peerid) is peer
+
+    def __iter__(self):
+        self._iterating += 1
+        try:
+            for peer in self._members.values():
+                if peer is not None:
+                    yield peer
+        finally:
+            self._iterating -= 1
+            if not self._iterating:
+                if self._dead or self._pending:
+                    self._settle()
+                if not self._size and self._registry is not None:
+                    self._registry._dropgroup(self)
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _add(self, peer):
+        key = peer._peerid
+        if self.get(key) is not None:
+            return
+
+        self._size += 1
+        if key in self._members or not self._iterating:
+            self._members[key] = peer
+        else:
+            if self._pending is None:
+                self._pending = {}
+            self._pending[key] = peer
+
+    def _discard(self, peer):
+        key = peer._peerid
+        if self._members.get(key) is not None:
+            self._size -= 1
+            if not self._iterating:
+                del self._members[key]
+            else:
+                self._members[key] = None
+                if self._dead is None:
+                    self._dead = []
+                self._dead.append(key)
+
+        elif self._pending and key in self._pending:
+            self._size -= 1
+            del self._pending[key]
+
+    def _settle(self):
+        # The last iteration is done, apply the changes made during it
+        members = self._members
+        if self._dead:
+            for key in self._dead:
+                if key in members and members[key] is None:
+                    del members[key]
+        if self._pending:
+            members.update(self._pending)
+
+        self._dead = None
+        self._pending = None
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def get(self, peerid):
+        """
+        Returns the peer with the id, or None if it is not in the
+        group.
+        """
+
+        peer = self._members.get(peerid)
+        if peer is None and self._pending:
+            peer = self._pending.get(peerid)
+        return peer
+
+
+# The group of tags nobody has
+_NOGROUP = PeerGroup()
+
+class PeerRegistry(object):
+    """
+    The peers of a listener, by id, by address and in groups by tag.
+
+    Iterating the registry goes through every peer, like iterating a
+    group, and len() is the number of peers.
+    """
+
+    __slots__ = ('_peers', '_addresses', '_groups', '_tags', '_nextid')
+
+    def __init__(self):
+        self._peers = PeerGroup()
+
+        # The address index is only made once it is used. Tags are
+        # kept by peer id for the peers which have any.
+        self._addresses = None
+        self._groups = {}
+        self._tags = {}
+        self._nextid = 0
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __iter__(self):
+        return iter(self._peers)
+
+    def __contains__(self, peer):
+        return peer in self._peers
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _leave(self, tag, peer):
+        # Take peer out of the group of tag, dropping the group once
+        # it is empty. A group being iterated is dropped when the
+        # iteration is done.
+        group = self._groups[tag]
+        group._discard(peer)
+        if not group._size and not group._iterating:
+            del self._groups[tag]
+
+    def _dropgroup(self, group):
+        # An iteration left group empty
+        if self._groups.get(group._tag) is group:
+            del self._groups[group._tag]
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def add(self, peer, address=None):
+        """
+        Add a peer connected from address, giving it the next id,
+        which is returned.
+        """
+
+        self._nextid += 1
+        peer._peerid = self._nextid
+        peer._peeraddress = address
+        self._peers._add(peer)
+
+        if self._addresses is not None and address:
+            self._addresses[address] = peer
+
+        return self._nextid
+
+    def remove(self, peer):
+        """
+        Remove a peer, taking it out of all its groups.
+        """
+
+        if peer not in self._peers:
+            return
+
+        self._peers._discard(peer)
+
+        address = peer._peeraddress
+        if self._addresses is not None and address and \
+                self._addresses.get(address) is peer:
+            del self._addresses[address]
+
+        tags = self._tags.pop(peer._peerid, None)
+        if tags:
+            for tag in tags:
+                self._leave(tag, peer)
+
+    def get(self, peerid):
+        """
+        Returns the peer with the id, or None.
+        """
+
+        return self._peers.get(peerid)
+
+    def find(self, address):
+        """
+        Returns the peer connected from address, or None. Peers of
+        Unix sockets usually have no address to find them by.
+        """
+
+        if self._addresses is None:
+            self._addresses = {}
+            for peer in self._peers:
+                if peer._peeraddress:
+                    self._addresses[peer._peeraddress] = peer
+
+        return self._addresses.get(address)
+
+    def tag(self, peer, tag):
+        """
+        Put a peer in the group of tag.
+        """
+
+        if peer not in self._peers:
+            raise ValueError('peer is not in the registry')
+
+        tags = self._tags.get(peer._peerid)
+        if tags is None:
+            tags = self._tags[peer._peerid] = set()
+        elif tag in tags:
+            return
+        tags.add(tag)
+
+        group = self._groups.get(tag)
+        if group is None:
+            group = self._groups[tag] = PeerGroup(self, tag)
+        group._add(peer)
+
+    def untag(self, peer, tag):
+        """
+        Take a peer out of the group of tag.
+        """
+
+        tags = self._tags.get(peer._peerid)
+        if tags is None or tag not in tags:
+            return
+
+        tags.remove(tag)
+        if not tags:
+            del self._tags[peer._peerid]
+        self._leave(tag, peer)
+
+    def tags(self, peer):
+        """
+        Returns a frozenset of the tags of a peer.
+        """
+
+        return frozenset(self._tags.get(peer._peerid, ()))
+
+    def group(self, tag):
+        """
+        Returns the PeerGroup of the peers tagged with tag. The group
+        follows the peers being tagged and untagged, as long as it
+        has any, and a tag with no peers has an empty group.
+        """
+
+        return self._groups.get(tag, _NOGROUP)
+
+    def groups(self):
+        """
+        Returns an iterator over the tags which have peers.
+        """
+
+        return iter(self._groups)
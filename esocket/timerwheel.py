@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    A hierarchical timer wheel for large numbers of timeouts.
+
+    Every timer on a loop shares a single loop timer, which advances
+    the wheel once per tick while any timers are pending. Timers are
+    kept in buckets by the tick they expire on. Each of the LEVELS
+    levels has SLOTS buckets, each level covering SLOTS times the span
+    of the level below, and buckets are cascaded down a level as the
+    wheel turns.
+
+    Refreshing a timer only moves its deadline. The timer stays in its
+    bucket and is moved to the right one when that bucket is reached,
+    so refreshing is O(1) and can be done on every bit of activity.
+"""
+
+import math
+
+# Seconds per tick
+RESOLUTION = 0.1
+
+SLOTBITS = 6
+SLOTS = 1 << SLOTBITS
+SLOTMASK = SLOTS - 1
+LEVELS = 4
+
+# Timers further away than the wheel can hold are parked at the far
+# end and rescheduled when they get there.
+MAXTICKS = (1 << (SLOTBITS * LEVELS)) - 1
+
+class WheelTimer(object):
+    """
+    A repeating timer in a TimerWheel.
+
+    The callback is called with the timer and 0, like a pyev watcher
+    callback, every <timeout> seconds unless the timer is refreshed.
+    """
+
+    __slots__ = ('_wheel', '_ticks', '_deadline', '_bucket',
+                 'timeout', 'callback', 'data')
+
+    def __init__(self, wheel, timeout, callback, data=None):
+        self._wheel = wheel
+        self._ticks = max(1, int(math.ceil(timeout / wheel.resolution)))
+        self._deadline = 0
+        self._bucket = None
+
+        self.timeout = timeout
+        self.callback = callback
+        self.data = data
+
+    @property
+    def active(self):
+        """ Returns True until the timer is cancelled """
+        return self._bucket is not None
+
+    def refresh(self):
+        """
+        Restart the timeout from now.
+        """
+
+        self._deadline = self._wheel._current + self._ticks
+
+    def cancel(self):
+        """
+        Stop the timer and remove it from the wheel.
+        """
+
+        if self._bucket is not None:
+            self._bucket.discard(self)
+            self._bucket = None
+            self._wheel._release()
+
+
+class TimerWheel(object):
+    """
+    A hierarchical timer wheel driven by a single loop timer.
+    """
+
+    def __init__(self, eloop, resolution=RESOLUTION):
+        self._eloop = eloop
+        self._resolution = resolution
+        self._buckets = [[set() for i in range(SLOTS)]
+                         for j in range(LEVELS)]
+        self._current = 0
+        self._count = 0
+
+        self._etick = eloop.timer(resolution, resolution, self._tickhandler)
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _now(self):
+        return int(self._eloop.now() / self._resolution)
+
+    def _insert(self, timer):
+        # Put the timer in the bucket for its deadline. A deadline
+        # of the current tick is only inserted while cascading, before
+        # the current bucket on level 0 is handled.
+        delta = timer._deadline - self._current
+        if delta < 0:
+            delta = 0
+        elif delta > MAXTICKS:
+            delta = MAXTICKS
+
+        deadline = self._current + delta
+        level = 0
+        while delta >= SLOTS and level < LEVELS - 1:
+            delta >>= SLOTBITS
+            level += 1
+
+        bucket = self._buckets[level][(deadline >> (SLOTBITS * level))
+                                      & SLOTMASK]
+        bucket.add(timer)
+        timer._bucket = bucket
+
+    def _cascade(self, level):
+        # Move the timers of the current bucket on a level to the
+        # levels below.
+        index = (self._current >> (SLOTBITS * level)) & SLOTMASK
+        bucket = self._buckets[level][index]
+        self._buckets[level][index] = set()
+
+        for timer in bucket:
+            self._insert(timer)
+
+        return index
+
+    def _release(self):
+        self._count -= 1
+        if not self._count:
+            self._etick.stop()
+
+    def _tickhandler(self, watcher, event):
+        # Turn the wheel up to the current time, collecting every
+        # timer that expired, and fire them as one batch.
+        now = self._now()
+        expired = []
+
+        while self._current < now:
+            self._current += 1
+
+            level = 1
+            while level < LEVELS and \
+                    not self._current & ((1 << (SLOTBITS * level)) - 1):
+                self._cascade(level)
+                level += 1
+
+            index = self._current & SLOTMASK
+            bucket = self._buckets[0][index]
+            if not bucket:
+                continue
+
+            self._buckets[0][index] = set()
+            for timer in bucket:
+                if timer._deadline <= self._current:
+                    expired.append(timer)
+                else:
+                    # Refreshed since it was put in this bucket
+                    self._insert(timer)
+
+        for timer in expired:
+            # An earlier callback in the batch may have cancelled
+            # or refreshed this timer.
+            if timer._bucket is None:
+                continue
+            if timer._deadline > self._current:
+                self._insert(timer)
+                continue
+
+            timer._deadline = self._current + timer._ticks
+            self._insert(timer)
+            timer.callback(timer, 0)
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def resolution(self):
+        """ Returns the number of seconds per tick """
+        return self._resolution
+
+    def __len__(self):
+        return self._count
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def add(self, timeout, callback, data=None):
+        """
+        Returns a started WheelTimer, calling callback every <timeout>
+        seconds unless it is refreshed.
+        """
+
+        if not self._count:
+            self._current = self._now()
+            self._etick.start()
+
+        timer = WheelTimer(self, timeout, callback, data)
+        timer._deadline = self._current + timer._ticks
+        self._insert(timer)
+        self._count += 1
+
+        return timer
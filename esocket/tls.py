@@ -0,0 +1,612 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+    TLS over TCP connections.
+
+    The TLS records are produced and taken apart by an ssl.SSLObject
+    working on a pair of memory BIOs, so the connections read and
+    write their sockets in the same non-blocking way as plain ones.
+    Data received is decrypted straight into the receivebuffer, and
+    data sent is queued as plaintext and encrypted as the socket
+    drains, with runs of small sends joined so they go out in as few
+    records as possible.
+
+    The handshake runs once the TCP connection is made, and the
+    connected event is dispatched when it has completed. Clients keep
+    the sessions of the servers they connect to, and resume them with
+    the session tickets of the server to skip the full handshake on
+    the next connection.
+
+    Files sent over TLS have to be encrypted, so sendfile() reads or
+    maps them instead of using os.sendfile().
+"""
+
+import ssl
+import weakref
+import _socket as socket
+from collections import OrderedDict
+from itertools import islice
+
+from esocket.buffer import SendQueue, FileSegment
+from esocket.connection import PeerConnection, _isaddress
+from esocket.ipv4 import TCPConnection, TCPListener
+
+# The most plaintext in a single TLS record
+RECORD_SIZE = 16384
+
+# The most plaintext encrypted at a time as the socket drains
+BATCH_SIZE = 65536
+
+# The number of sessions kept per context
+SESSION_CACHE = 256
+
+# Session caches of the client contexts, and the default context
+_caches = weakref.WeakKeyDictionary()
+_context = None
+
+def _defaultcontext():
+    # The context of clients not given one, made on first use since
+    # loading the trusted certificates takes a while.
+    global _context
+    if _context is None:
+        _context = ssl.create_default_context()
+    return _context
+
+def sessioncache(context):
+    """
+    Returns the SessionCache shared by the clients using context.
+    """
+
+    cache = _caches.get(context)
+    if cache is None:
+        cache = _caches[context] = SessionCache()
+    return cache
+
+
+class SessionCache(object):
+    """
+    The TLS sessions of the most recently connected servers, by
+    (hostname, port), dropping the least recently used beyond
+    maxsize. Sessions can only be resumed with the context they were
+    made with, so every context needs a cache of its own.
+    """
+
+    __slots__ = ('_sessions', '_maxsize')
+
+    def __init__(self, maxsize=SESSION_CACHE):
+        self._sessions = OrderedDict()
+        self._maxsize = maxsize
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, key):
+        """
+        Returns the session kept for key, or None.
+        """
+
+        session = self._sessions.get(key)
+        if session is not None:
+            self._sessions.move_to_end(key)
+        return session
+
+    def put(self, key, session):
+        """
+        Keep session for key, replacing any kept before.
+        """
+
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self._maxsize:
+            self._sessions.popitem(False)
+
+    def discard(self, key):
+        """
+        Forget the session kept for key.
+        """
+
+        self._sessions.pop(key, None)
+
+    def clear(self):
+        """
+        Forget every session.
+        """
+
+        self._sessions.clear()
+
+
+class _SegmentWriter(object):
+    # Takes the place of the socket when a segment is sent through
+    # TLS, encrypting up to room bytes of what it is given.
+
+    __slots__ = ('_sslobj', 'room')
+
+    def __init__(self, sslobj):
+        self._sslobj = sslobj
+        self.room = 0
+
+    def send(self, data):
+        return self._sslobj.write(data[:self.room])
+
+
+class TLSSendQueue(SendQueue):
+    """
+    A sendqueue holding plaintext, which is encrypted as the socket
+    drains. Its length is the number of bytes waiting to be written,
+    plaintext once the handshake has completed, and the records
+    encrypted but not sent yet.
+
+    Until the handshake has completed, the queue only writes what the
+    handshake produces and keeps the plaintext queued.
+    """
+
+    __slots__ = ('_sslobj', '_outbio', '_writer', '_cipher', '_established')
+
+    def __init__(self):
+        super().__init__()
+        self._sslobj = None
+        self._outbio = None
+        self._writer = None
+        self._cipher = None
+        self._established = False
+
+    def __len__(self):
+        size = len(self._cipher) if self._cipher is not None else 0
+        if self._outbio is not None:
+            size += self._outbio.pending
+        if self._established:
+            size += self._size
+        return size
+
+    @property
+    def buffered(self):
+        size = self._size - self._segmentsize
+        if self._cipher is not None:
+            size += len(self._cipher)
+        return size
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _start(self, sslobj, outbio):
+        # The handshake has started, write what it produces
+        self._sslobj = sslobj
+        self._outbio = outbio
+        self._writer = _SegmentWriter(sslobj)
+
+    def _encrypt(self):
+        # Encrypt up to BATCH_SIZE bytes from the front of the queue.
+        # Runs of buffers are joined and written together, so a lot
+        # of small sends make a few full records and not one each.
+        write = self._sslobj.write
+        room = BATCH_SIZE
+
+        while self._size and room > 0:
+            head = self._queue[0]
+
+            if type(head) is not memoryview:
+                self._writer.room = room
+                count = head.send(self._writer)
+            else:
+                buffers = [head]
+                size = len(head)
+                for item in islice(self._queue, 1, None):
+                    if type(item) is not memoryview or \
+                            size + len(item) > room:
+                        break
+                    buffers.append(item)
+                    size += len(item)
+
+                if len(buffers) == 1:
+                    count = write(head[:room])
+                else:
+                    count = write(b''.join(buffers))
+
+            self._advance(count)
+            room -= count
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def send(self, sock):
+        """
+        Write as many records to the socket as it accepts, encrypting
+        more of the queue as they are written, and return the number
+        of bytes sent.
+        """
+
+        if self._outbio is None:
+            return 0
+
+        sent = 0
+        try:
+            while True:
+                if self._cipher is None:
+                    if self._established and self._size:
+                        self._encrypt()
+                    data = self._outbio.read()
+                    if not data:
+                        break
+                    self._cipher = memoryview(data)
+
+                count = sock.send(self._cipher)
+                sent += count
+                if count < len(self._cipher):
+                    self._cipher = self._cipher[count:]
+                    break
+                self._cipher = None
+
+        except (BlockingIOError, InterruptedError):
+            if not sent:
+                raise
+
+        return sent
+
+    def shutdown(self, sock):
+        """
+        Write a close_notify alert to the socket, if nothing else is
+        half written. It is only attempted once, whether it fits in
+        the socket or not.
+        """
+
+        if self._sslobj is None or self._cipher is not None:
+            return
+
+        try:
+            self._sslobj.unwrap()
+        except (ssl.SSLError, ValueError):
+            pass
+
+        try:
+            data = self._outbio.read()
+            if data:
+                sock.send(data)
+        except socket.error:
+            pass
+
+    def clear(self):
+        super().clear()
+        self._cipher = None
+        if self._outbio is not None and self._outbio.pending:
+            self._outbio.read()
+
+
+class TLS(object):
+    """
+    TLS for a connection, shared by TLSConnection and the peers of a
+    TLSListener. The classes using it declare its attributes in their
+    own __slots__, and whether they are the server in _serverside.
+    """
+
+    __slots__ = ()
+
+    _serverside = False
+
+    def __init__(self, *args, context=None, hostname=None, **kwargs):
+        self._context = context
+        self._hostname = hostname
+        self._sslobj = None
+        self._inbio = None
+        self._outbio = None
+        self._established = False
+        self._sessions = None
+        self._sessionkey = None
+
+        super().__init__(*args, **kwargs)
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _newsendqueue(self):
+        return TLSSendQueue()
+
+    def _starttls(self):
+        # Wrap the connected socket and start the handshake. Clients
+        # offer the last session of the server, if there is one.
+        self._inbio = ssl.MemoryBIO()
+        self._outbio = ssl.MemoryBIO()
+
+        try:
+            self._sslobj = self._context.wrap_bio(
+                self._inbio, self._outbio, self._serverside, self._hostname)
+
+            if self._sessions is not None:
+                address = self._socket.getpeername()
+                self._sessionkey = (self._hostname or address[0], address[1])
+                session = self._sessions.get(self._sessionkey)
+                if session is not None:
+                    self._sslobj.session = session
+        except (ValueError, ssl.SSLError, socket.error) as e:
+            self._dispatcherror(e)
+            self.close()
+            return
+
+        self._sendbuf._start(self._sslobj, self._outbio)
+        self._handshake()
+
+    def _handshake(self):
+        # Take the handshake a step further with what has arrived,
+        # writing what it produces. Once complete, dispatch the
+        # connected event and any data which came with the handshake.
+        try:
+            self._sslobj.do_handshake()
+        except ssl.SSLWantReadError:
+            self._flushtls()
+            return
+        except ssl.SSLError as e:
+            # Let the peer know with the alert, if there is one
+            self._flushtls()
+            self._dispatcherror(e)
+            self.close()
+            return
+
+        self._established = True
+        self._sendbuf._established = True
+        if self._sessionkey is not None:
+            self._savesession()
+
+        # The rest of the handshake and the data sent while it ran
+        self._flushtls()
+        super()._dispatchconnected()
+
+        if self._active and self._inbio.pending:
+            if not self._decrypt():
+                self.close()
+            elif self._recvbuf:
+                self._dispatchdata(len(self._recvbuf))
+
+    def _decrypt(self):
+        # Decrypt every complete record in the incoming BIO into the
+        # receivebuffer. Returns False once the peer has closed the
+        # session with a close_notify alert.
+        read = self._sslobj.read
+        recvbuf = self._recvbuf
+
+        try:
+            while True:
+                # The plaintext is never larger than the records it
+                # came in, so only that much room is reserved.
+                size = self._inbio.pending + self._sslobj.pending()
+                if not size or not recvbuf.fill(read, min(size,
+                                                          RECORD_SIZE)):
+                    break
+        except ssl.SSLWantReadError:
+            pass
+        except ssl.SSLZeroReturnError:
+            return False
+
+        # TLS 1.3 servers send their session tickets after the
+        # handshake, and either side may have something to answer.
+        if self._sessionkey is not None:
+            self._savesession()
+        if self._outbio.pending:
+            self._flushtls()
+        return True
+
+    def _savesession(self):
+        # Keep the session for the next connection to the server,
+        # once the server has given it a ticket.
+        session = self._sslobj.session
+        if session is not None and session.has_ticket:
+            self._sessions.put(self._sessionkey, session)
+            self._sessionkey = None
+
+    def _flushtls(self):
+        # Write what TLS has produced, along with any data queued
+        if self._sendbuf and not self._sendwaiting():
+            self._sendhandler(None, None)
+
+    def _recvinto(self, size):
+        # Read records from the socket and decrypt them into the
+        # receivebuffer, returning the number of bytes read from the
+        # socket, or 0 when the session is over.
+        data = self._socket.recv(size)
+        if not data:
+            return 0
+
+        self._inbio.write(data)
+        if not self._decrypt():
+            return 0
+        return len(data)
+
+#-----------------------------------------------------------------------
+# Private Event handlers and dispatchers
+#-----------------------------------------------------------------------
+
+    def _recvhandler(self, watcher, event):
+        if self._established:
+            super()._recvhandler(watcher, event)
+        else:
+            self._handshakehandler()
+
+    def _handshakehandler(self):
+        # Records of the handshake have arrived
+        try:
+            data = self._socket.recv(self._recvsize)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as e:
+            self._dispatcherror(e)
+            self.close()
+            return
+
+        if not data:
+            self._dispatcherror(ssl.SSLEOFError(
+                'connection closed during the TLS handshake'))
+            self.close()
+            return
+
+        if self._etimeout is not None:
+            self._etimeout.refresh()
+
+        self._inbio.write(data)
+        self._handshake()
+
+    def _dispatchconnected(self, data=None):
+        # The TCP connection is made, the connected event waits for
+        # the handshake.
+        if self._sslobj is None:
+            self._starttls()
+        else:
+            super()._dispatchconnected(data)
+
+    def _dispatchdata(self, data=None):
+        # Records which held no data, like session tickets, are not
+        # worth an event.
+        if self._recvbuf:
+            super()._dispatchdata(data)
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def context(self):
+        """ Returns the ssl.SSLContext of the connection """
+        return self._context
+
+    @property
+    def sslobject(self):
+        """
+        Returns the ssl.SSLObject of the connection, which tells the
+        cipher, version and certificate of the peer, or None before
+        the handshake has started.
+        """
+
+        return self._sslobj
+
+    @property
+    def isestablished(self):
+        """ Returns True once the handshake has completed """
+        return self._established
+
+    @property
+    def resumed(self):
+        """
+        Returns True if the handshake resumed an earlier session.
+        """
+
+        return self._established and self._sslobj.session_reused
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def sendfile(self, fileobj, offset=0, count=None):
+        """
+        Like BaseConnection.sendfile(), but the file has to go through
+        TLS, so it is always mapped or read a piece at a time.
+        """
+
+        segment = FileSegment(fileobj, offset, count, sendfile=False)
+
+        pending = bool(self._sendbuf)
+        self._sendbuf.appendsegment(segment)
+        if not pending and self._sendbuf:
+            self._sendsoon()
+
+    def close(self):
+        if self._active and self._established:
+            self._sendbuf.shutdown(self._socket)
+        super().close()
+
+
+class TLSConnection(TLS, TCPConnection):
+    """
+    A TCPConnection speaking TLS with the context, by default
+    ssl.create_default_context(). The hostname is checked against the
+    certificate of the server, and defaults to the host given to
+    connect() unless that is an address.
+
+    Clients with the same context share a SessionCache, which can be
+    replaced through sessions, or set to None to disable resumption.
+    """
+
+    __slots__ = ('_context', '_hostname', '_sslobj', '_inbio', '_outbio',
+                 '_established', '_sessions', '_sessionkey')
+
+    def __init__(self, eloop, connhandler, context=None, hostname=None,
+                 events=None):
+
+        if context is None:
+            context = _defaultcontext()
+
+        super().__init__(eloop, connhandler, events, context=context,
+                         hostname=hostname)
+
+        self._sessions = sessioncache(context)
+
+    @property
+    def sessions(self):
+        """
+        The SessionCache the connection resumes sessions from and
+        keeps its own in, or None.
+        """
+
+        return self._sessions
+
+    @sessions.setter
+    def sessions(self, cache):
+        self._sessions = cache
+
+    def connect(self, host='127.0.0.1', port=0, timeout=1):
+        if self._hostname is None and isinstance(host, str) and \
+                not _isaddress(host):
+            self._hostname = host
+
+        super().connect(host, port, timeout)
+
+
+class TLSPeerConnection(TLS, PeerConnection):
+    """
+    The peers of a TLSListener.
+    """
+
+    __slots__ = ('_context', '_hostname', '_sslobj', '_inbio', '_outbio',
+                 '_established', '_sessions', '_sessionkey')
+
+    _serverside = True
+
+
+class TLSListener(TCPListener):
+    """
+    A TCPListener whose peers speak TLS with the context, which needs
+    a certificate and its key loaded, see SSLContext.load_cert_chain().
+    """
+
+    __slots__ = ('_context',)
+
+    _peerclass = TLSPeerConnection
+
+    def __init__(self, eloop, handlercls, context, events=None):
+
+        super().__init__(eloop, handlercls, events)
+
+        self._context = context
+
+    def _newpeer(self, sock):
+        return self._peerclass(self._eloop, sock, self._clshandler(),
+                               context=self._context)
+
+    @property
+    def context(self):
+        """ Returns the ssl.SSLContext of the peers """
+        return self._context
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+    Unix domain socket transports.
+
+    Connections and listeners over AF_UNIX, either SOCK_STREAM, or
+    SOCK_SEQPACKET which keeps the boundaries of every message. A path
+    starting with a null byte is an address in the abstract namespace
+    of Linux, which has no file and disappears with the socket.
+
+    Unix connections can pass file descriptors, like accepted TCP
+    sockets, to the process at the other end with sendfds(). The
+    receiving connection needs maxfds set to take them, and collects
+    them with recvfds() when the data they came with arrives. On a
+    SOCK_SEQPACKET connection framed by its PacketFramer, they are
+    handed out with the frame of the packet they were sent with.
+"""
+
+import os
+import array
+import errno
+import struct
+import _socket as socket
+
+from esocket.buffer import FDSegment, RETAIN_SIZE
+from esocket.connection import Connection, PeerConnection
+from esocket.framing import PacketFramer
+from esocket.listener import Listener
+
+# The largest packet read from a SOCK_SEQPACKET socket
+PACKET_SIZE = 65536
+
+# Bytes per file descriptor in SCM_RIGHTS ancillary data
+_FD_SIZE = array.array('i').itemsize
+
+def _abstract(path):
+    # Addresses in the abstract namespace start with a null byte, and
+    # an empty address is given one by the kernel.
+    return not path or path[0] in ('\0', 0)
+
+class FDPassing(object):
+    """
+    File descriptor passing and packet reads, shared by the Unix
+    connections and their peers. The classes using it declare its
+    attributes in their own __slots__.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        # Descriptors received, the list is made when some arrive
+        self._fds = None
+        self._maxfds = 0
+        self._packetsize = PACKET_SIZE
+
+        super().__init__(*args, **kwargs)
+
+        if not self._streaming:
+            self._retainpacket()
+
+#-----------------------------------------------------------------------
+# Private Methods
+#-----------------------------------------------------------------------
+
+    def _recvinto(self, size):
+        # A plain read unless there may be descriptors or a packet
+        # to take whole.
+        if self._streaming and not self._maxfds:
+            return self._recvbuf.recv(self._socket, size)
+
+        if not self._streaming:
+            size = self._packetsize
+
+        ancbufsize = 0
+        if self._maxfds:
+            ancbufsize = socket.CMSG_SPACE(self._maxfds * _FD_SIZE)
+
+        received, ancdata, flags = self._recvbuf.recvmsg(
+            self._socket, size, ancbufsize,
+            getattr(socket, 'MSG_CMSG_CLOEXEC', 0))
+
+        fds = None
+        for level, type, cmsg in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                if fds is None:
+                    fds = array.array('i')
+                fds.frombytes(cmsg[:len(cmsg) - len(cmsg) % _FD_SIZE])
+
+        if flags & socket.MSG_CTRUNC:
+            self._dispatcherror(OSError(errno.EMSGSIZE,
+                'file descriptors were discarded, maxfds is too small'))
+        if flags & socket.MSG_TRUNC:
+            self._dispatcherror(OSError(errno.EMSGSIZE,
+                'packet was truncated, packetsize is too small'))
+
+        # A PacketFramer keeps the descriptors with their packet,
+        # otherwise they wait for recvfds().
+        packets = not self._streaming and self._framer is not None
+        if fds and not (received and packets and
+                        isinstance(self._framer, PacketFramer)):
+            if self._fds is None:
+                self._fds = []
+            self._fds.extend(fds)
+            fds = None
+
+        if received and packets:
+            self._framer.packet(received, fds and list(fds))
+
+        return received
+
+    def _retainpacket(self):
+        # Every packet read asks for packetsize bytes, keep that much
+        # storage instead of allocating it for every read.
+        if self._recvbuf is not None:
+            self._recvbuf.retain = max(RETAIN_SIZE, self._packetsize)
+
+    def _closefds(self):
+        if isinstance(self._framer, PacketFramer):
+            self._framer.reset()
+        for fd in self.recvfds():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+#-----------------------------------------------------------------------
+# Public Properties
+#-----------------------------------------------------------------------
+
+    @property
+    def maxfds(self):
+        """
+        The most file descriptors taken from a single read. When 0
+        (default), descriptors passed by the peer are discarded by
+        the kernel.
+        """
+
+        return self._maxfds
+
+    @maxfds.setter
+    def maxfds(self, count):
+        self._maxfds = count
+
+    @property
+    def packetsize(self):
+        """
+        The largest packet read from a SOCK_SEQPACKET connection.
+        Larger packets are truncated, with an error event.
+        """
+
+        return self._packetsize
+
+    @packetsize.setter
+    def packetsize(self, size):
+        self._packetsize = size
+        if not self._streaming:
+            self._retainpacket()
+
+    @property
+    def peercred(self):
+        """
+        Returns the (pid, uid, gid) of the process at the other end,
+        as it was when the connection was made.
+        """
+
+        creds = self._socket.getsockopt(socket.SOL_SOCKET,
+                                        socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+        return struct.unpack('3i', creds)
+
+#-----------------------------------------------------------------------
+# Public Methods
+#-----------------------------------------------------------------------
+
+    def sendfds(self, fds, data=b'\0'):
+        """
+        Pass the file descriptors, or objects with a fileno(), to the
+        peer along with data, after the data sent so far. Duplicates
+        are sent, so the caller may close its own right away.
+        """
+
+        if self.family != socket.AF_UNIX:
+            raise ValueError('file descriptors can only be passed over '
+                             'Unix sockets')
+
+        segment = FDSegment(fds, data)
+
+        pending = bool(self._sendbuf)
+        self._sendbuf.appendsegment(segment)
+        if not pending and self._sendbuf:
+            self._sendsoon()
+
+    def recvfds(self):
+        """
+        Returns a list of the file descriptors received so far, which
+        the caller takes ownership of. Descriptors arrive with the
+        data they were sent with, and those not taken when the
+        connection closes are closed.
+
+        When a PacketFramer frames the connection, the descriptors of
+        a packet are only returned once its frame has been cut, so in
+        a frame handler they are those of the frame, after any left
+        from earlier frames.
+        """
+
+        fds = self._fds or []
+        self._fds = None
+        if isinstance(self._framer, PacketFramer):
+            fds.extend(self._framer.takefds())
+        return fds
+
+    def close(self):
+        super().close()
+        self._closefds()
+
+
+class UnixConnection(FDPassing, Connection):
+
+    __slots__ = ('_fds', '_maxfds', '_packetsize')
+
+    def __init__(self, eloop, connhandler, events=None,
+                 type=socket.SOCK_STREAM):
+
+        super().__init__(eloop, socket.AF_UNIX, type, 0, connhandler)
+
+        if type == socket.SOCK_SEQPACKET:
+            self._framer = PacketFramer()
+
+        if events is not None:
+            try:
+                for e, f in events.items():
+                    if e == 'onconnected':
+                        self.onconnected = f
+                    elif e == 'ondisconnected':
+                        self.ondisconnected = f
+                    elif e == 'onerror':
+                        self.onerror = f
+            except:
+                raise ValueError
+
+    def connect(self, path, timeout=1):
+        self._connect([path], timeout)
+
+
+class UnixPeerConnection(FDPassing, PeerConnection):
+    """
+    The peers of a UnixListener.
+    """
+
+    __slots__ = ('_fds', '_maxfds', '_packetsize')
+
+
+class UnixListener(Listener):
+
+    __slots__ = ('_path', '_maxfds')
+
+    _peerclass = UnixPeerConnection
+
+    def __init__(self, eloop, handlercls, events=None,
+                 type=socket.SOCK_STREAM):
+
+        super().__init__(eloop, socket.AF_UNIX, type, 0, handlercls)
+
+        self._path = None
+        self._maxfds = 0
+        if type == socket.SOCK_SEQPACKET:
+            self._framer = PacketFramer()
+
+        if events is not None:
+            try:
+                for e, f in events.items():
+                    if e == 'onconnected':
+                        self.onconnected = f
+                    elif e == 'ondisconnected':
+                        self.ondisconnected = f
+                    elif e == 'onerror':
+                        self.onerror = f
+                    elif e == 'onpeer':
+                        self.onpeer = f
+            except:
+                raise ValueError
+
+    def _newpeer(self, sock):
+        peer = super()._newpeer(sock)
+        if self._maxfds:
+            peer.maxfds = self._maxfds
+        return peer
+
+    @property
+    def maxfds(self):
+        """
+        The maxfds of every peer, see FDPassing.maxfds.
+        """
+
+        return self._maxfds
+
+    @maxfds.setter
+    def maxfds(self, count):
+        self._maxfds = count
+
+    def listen(self, path, backlog=5):
+        """
+        Start listening on path. The socket file is removed when the
+        listener is closed or drained, unless path is an abstract
+        address or the socket has been handed off.
+        """
+
+        super().listen(path, backlog)
+
+        if self._accepting and not _abstract(path):
+            self._path = path
+
+    def _stopaccepting(self):
+        super()._stopaccepting()
+
+        if self._path is not None:
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+            self._path = None
+
+    def handoff(self):
+        # The socket file now belongs to the new process
+        fd = super().handoff()
+        self._path = None
+        return fd
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2010 Espen Rønnevik <brightside@quasinet.org>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+
+from esocket.ipv4 import TCPListener
+from esocket.connectionhandler import ConnectionHandler
+from esocket.error import IncompleteReadError
+
+
+async def echo(caller):
+    # Serve a peer with the coroutine api instead of data events
+    while True:
+        try:
+            line = await caller.readuntil(b'\n')
+        except IncompleteReadError:
+            break
+
+        if line == b'!SHUTDOWN\n':
+            print('Recieved shutdown command, stopping server')
+            caller.data.close()
+            break
+
+        caller.send(line)
+        await caller.drain()
+
+
+class EchoServer(ConnectionHandler):
+
+    def connected(self, caller, data):
+        asyncio.ensure_future(echo(caller))
+
+    def data(self, caller, data):
+        # Data is consumed by the coroutine
+        pass
+
+    def disconnected(self, caller, data):
+        pass
+
+    def error(self, caller, data):
+        print('Peer Error: {}'.format(data))
+
+    def timeout(self, caller, data):
+        pass
+
+def sockpeer(caller, data):
+    return True
+
+def sockdisconnected(caller, data):
+    loop.stop()
+
+if __name__ == '__main__':
+
+    loop = asyncio.new_event_loop()
+
+    l = TCPListener(loop, EchoServer,
+        {'ondisconnected': sockdisconnected, 'onpeer': sockpeer})
+
+    print('listening')
+    l.listen('localhost', 9000)
+    loop.run_forever()